@@ -0,0 +1,273 @@
+'''
+Benchmarks for the hot paths of ``rom``: saving and fetching entities, the
+different kinds of queries, and the index maintenance utilities. Each run
+starts its own throwaway ``redis-server``, so no existing data is touched.
+
+Usage::
+
+    python benchmarks/hot_paths.py [--entities N] [--repeat N]
+        [--redis-server PATH] [--output FILE] [--compare FILE]
+        [--only NAME [NAME ...]]
+
+Every benchmark reports throughput and latency percentiles in milliseconds.
+With ``--output``, results are also written as JSON along with the ``rom``,
+Python, and Redis versions, and a previous results file can be passed with
+``--compare`` to print the change in throughput of each benchmark, to spot
+regressions between releases.
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+from six.moves import range
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rom
+from rom import util
+
+def _free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+class RedisServer(object):
+    '''
+    Starts a ``redis-server`` on a free port with persistence disabled, and
+    removes it and its working directory on exit.
+    '''
+    def __init__(self, executable='redis-server'):
+        self.executable = executable
+        self.port = _free_port()
+        self.process = None
+        self.directory = None
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix='rom-bench-')
+        self.process = subprocess.Popen([self.executable,
+            '--port', str(self.port), '--bind', '127.0.0.1', '--save', '',
+            '--appendonly', 'no', '--dir', self.directory],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        conn = redis.Redis(port=self.port)
+        for i in range(100):
+            try:
+                conn.ping()
+                return conn
+            except redis.ConnectionError:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(.05)
+        self.__exit__()
+        raise RuntimeError("Could not start %s on port %i"%(self.executable, self.port))
+
+    def __exit__(self, *exc):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class RomBenchEntity(rom.Model):
+    # keyword queries and clean_old_index() need the tracked index data
+    track_indexes = True
+    body = rom.Text(index=True)
+    email = rom.Text(prefix=True, suffix=True, keygen=lambda v: [v.lower()])
+    category = rom.Integer(index=True)
+    score = rom.Float(index=True)
+
+def _word(rand, size=None):
+    return ''.join(rand.choice(string.ascii_lowercase)
+        for i in range(size or rand.randint(3, 9)))
+
+def make_rows(count, seed=0):
+    '''
+    Generates column data for *count* entities, with a small vocabulary for
+    the text column so that text queries match a realistic number of rows.
+    '''
+    rand = random.Random(seed)
+    words = [_word(rand) for i in range(500)]
+    return [dict(
+        body=' '.join(rand.choice(words) for j in range(8)),
+        email='%s.%s@%s.com'%(_word(rand), _word(rand), rand.choice(words[:20])),
+        category=rand.randrange(20),
+        score=rand.random() * 1000,
+    ) for i in range(count)]
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def measure(call, count, repeat, items=1):
+    '''
+    Times *count* calls of *call(i)*, keeping the best of *repeat* runs, and
+    returns throughput and latency statistics. *items* is the number of
+    entities handled by each call.
+    '''
+    best = None
+    for r in range(repeat):
+        latencies = []
+        started = time.time()
+        for i in range(count):
+            start = time.time()
+            call(i)
+            latencies.append(time.time() - start)
+        elapsed = time.time() - started
+        if best is None or elapsed < best[0]:
+            best = elapsed, latencies
+    elapsed, latencies = best
+    latencies.sort()
+    return {
+        'calls': count,
+        'items': count * items,
+        'seconds': elapsed,
+        'calls_per_second': count / elapsed if elapsed else None,
+        'items_per_second': count * items / elapsed if elapsed else None,
+        'mean_ms': 1000 * sum(latencies) / len(latencies),
+        'p50_ms': 1000 * _percentile(latencies, .5),
+        'p95_ms': 1000 * _percentile(latencies, .95),
+        'p99_ms': 1000 * _percentile(latencies, .99),
+        'max_ms': 1000 * latencies[-1],
+    }
+
+def benchmarks(rows, repeat):
+    '''
+    Yields ``(name, run)`` pairs in the order they need to be run, since
+    later benchmarks query the entities saved by earlier ones.
+    '''
+    ids = []
+    rand = random.Random(1)
+    queries = min(len(rows), 200)
+
+    def save_new(i):
+        entity = RomBenchEntity(**rows[i % len(rows)])
+        entity.save()
+        ids.append(entity.id)
+    def run_save_new():
+        # only the first run creates the entities queried by later benchmarks
+        return measure(save_new, len(rows), 1)
+    yield 'save_new', run_save_new
+
+    def save_update(i):
+        entity = RomBenchEntity.get(ids[i])
+        entity.score = rand.random() * 1000
+        entity.save()
+    yield 'save_update', lambda: measure(save_update, len(ids), repeat)
+
+    for size in (1, 10, 100):
+        def get_batch(i, size=size):
+            util.session.rollback()
+            start = (i * size) % max(1, len(ids) - size)
+            RomBenchEntity.get(ids[start:start + size])
+        yield 'get_batch_%i'%size, (lambda get_batch=get_batch, size=size:
+            measure(get_batch, queries, repeat, items=size))
+
+    words = [row['body'].split()[0] for row in rows[:queries]]
+    emails = [row['email'] for row in rows[:queries]]
+    def query(build):
+        def call(i):
+            util.session.rollback()
+            build(i).limit(0, 20).all()
+        return lambda: measure(call, queries, repeat)
+
+    yield 'filter_by', lambda: measure(
+        lambda i: (util.session.rollback(), RomBenchEntity.filter_by(category=i % 20)),
+        queries // 10 or 1, repeat)
+    yield 'query_text', query(lambda i: RomBenchEntity.query.filter(body=words[i]))
+    yield 'query_range', query(lambda i: RomBenchEntity.query.filter(
+        score=(i * 5, i * 5 + 50)).order_by('score'))
+    yield 'query_text_range', query(lambda i: RomBenchEntity.query.filter(
+        body=words[i], score=(0, 500)).order_by('-score'))
+    yield 'query_prefix', query(lambda i: RomBenchEntity.query.startswith(email=emails[i][:3]))
+    yield 'query_suffix', query(lambda i: RomBenchEntity.query.endswith(email=emails[i][-8:]))
+    yield 'query_pattern', query(lambda i: RomBenchEntity.query.like(
+        email=emails[i][:2] + '*' + emails[i].split('@')[1][:3]))
+
+    def iter_result(i):
+        util.session.rollback()
+        for entity in RomBenchEntity.query.filter(category=i % 20).iter_result():
+            pass
+    yield 'iter_result', lambda: measure(iter_result, 20, repeat, items=len(ids) // 20 or 1)
+
+    def drain(utility):
+        def call(i):
+            for progress in utility(RomBenchEntity, block_size=100):
+                pass
+        return lambda: measure(call, 1, repeat, items=len(ids))
+    yield 'refresh_indices', drain(util.refresh_indices)
+    yield 'clean_old_index', drain(util.clean_old_index)
+
+def compare(results, previous):
+    print()
+    print("%-18s %14s %14s %8s"%('change', 'previous/s', 'current/s', 'ratio'))
+    for name, result in results.items():
+        old = previous.get('results', {}).get(name)
+        if not old or not old.get('calls_per_second') or not result.get('calls_per_second'):
+            continue
+        print("%-18s %14.1f %14.1f %7.2fx"%(name, old['calls_per_second'],
+            result['calls_per_second'], result['calls_per_second'] / old['calls_per_second']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--entities', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--redis-server', default='redis-server')
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare against")
+    parser.add_argument('--only', nargs='+', help="only report these benchmarks")
+    args = parser.parse_args()
+
+    rows = make_rows(args.entities)
+    results = {}
+    with RedisServer(args.redis_server) as conn:
+        util.CONNECTION = conn
+        meta = {
+            'rom': rom.VERSION,
+            'python': platform.python_version(),
+            'redis': conn.info()['redis_version'],
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'entities': args.entities,
+            'repeat': args.repeat,
+        }
+        print("%-18s %8s %12s %9s %9s %9s %9s"%(
+            'benchmark', 'calls', 'calls/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for name, run in benchmarks(rows, args.repeat):
+            try:
+                result = run()
+            except Exception as e:
+                # keep going, so one broken path doesn't hide the others
+                result = {'error': '%s: %s'%(type(e).__name__, e)}
+            finally:
+                util.session.rollback()
+            # earlier benchmarks create data for later ones, so they always run
+            if args.only and name not in args.only:
+                continue
+            results[name] = result
+            if 'error' in result:
+                print("%-18s %s"%(name, result['error']))
+                continue
+            print("%-18s %8i %12.1f %9.3f %9.3f %9.3f %9.3f"%(name,
+                result['calls'], result['calls_per_second'], result['mean_ms'],
+                result['p50_ms'], result['p95_ms'], result['p99_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'meta': meta, 'results': results}, out, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as inp:
+            compare(results, json.load(inp))
+
+if __name__ == '__main__':
+    main()
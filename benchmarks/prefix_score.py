@@ -0,0 +1,81 @@
+'''
+Micro-benchmark for ``rom.util._prefix_score()``, comparing the current
+implementation against the original pure-Python version.
+
+Usage::
+
+    python benchmarks/prefix_score.py [--tokens N] [--repeat N]
+
+'''
+from __future__ import print_function
+import argparse
+import os
+import random
+import string
+import sys
+import timeit
+
+import six
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rom import util
+
+def _original_bigint_to_float(v):
+    sign = -1 if v < 0 else 1
+    v *= sign
+    exponent, mantissa = divmod(v, 2**52)
+    return sign * (2**52 + mantissa) * 2.0**(exponent-52-1022)
+
+def _original_prefix_score(v, next=False):
+    if isinstance(v, six.text_type):
+        v = v.encode('utf-8')
+    score = 0
+    for ch in six.iterbytes(v[:7]):
+        score *= 258
+        score += ch + 1
+    if next:
+        score += 1
+    score *= 258 ** max(0, 7-len(v))
+    return repr(_original_bigint_to_float(score))
+
+def make_tokens(count, vocabulary=5000, seed=0):
+    '''
+    Generates tokens drawn from a vocabulary with a roughly Zipfian
+    distribution, like the words in a text column.
+    '''
+    rand = random.Random(seed)
+    words = [''.join(rand.choice(string.ascii_lowercase)
+        for i in range(rand.randint(2, 12))) for j in range(vocabulary)]
+    return [words[min(int(rand.paretovariate(1)) - 1, vocabulary - 1)]
+        for i in range(count)]
+
+def run(fn, tokens, repeat, clear=False):
+    def job():
+        if clear:
+            util._PREFIX_SCORES.clear()
+        for token in tokens:
+            fn(token)
+    return min(timeit.repeat(job, number=1, repeat=repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--tokens', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.tokens)
+    for token in tokens[:1000]:
+        assert util._prefix_score(token) == _original_prefix_score(token)
+        assert util._prefix_score(token, True) == _original_prefix_score(token, True)
+
+    original = run(_original_prefix_score, tokens, args.repeat)
+    cold = run(util._prefix_score, tokens, args.repeat, clear=True)
+    warm = run(util._prefix_score, tokens, args.repeat)
+    print("%i tokens, best of %i runs"%(len(tokens), args.repeat))
+    for name, elapsed in [('original', original), ('cold cache', cold), ('warm cache', warm)]:
+        print("%-12s %8.4fs %10.0f tokens/s %6.1fx"%(
+            name, elapsed, len(tokens) / elapsed, original / elapsed))
+
+if __name__ == '__main__':
+    main()
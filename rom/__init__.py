@@ -135,12 +135,16 @@ import six
 
 from .columns import (Column, Integer, Boolean, Float, Decimal, DateTime,
     Date, Time, Text, Json, Point, RouteCol, PrimaryKey, ManyToOne, ForeignModel, OneToMany,
-    MODELS, _on_delete, SKIP_ON_DELETE)
+    MODELS, _on_delete, SKIP_ON_DELETE, _LazyJson, _EXTERNAL, _external_key,
+    LazyGeoPoint)
 from .exceptions import (ORMError, UniqueKeyViolation, InvalidOperation,
-    QueryError, ColumnError, MissingColumn, InvalidColumnValue, RestrictError)
-from .index import GeneralIndex, Pattern, Prefix, Suffix
-from .util import (ClassProperty, _connect, session, dt2ts, t2ts,
-    _prefix_score, _script_load, _encode_unique_constraint)
+    QueryError, ColumnError, MissingColumn, InvalidColumnValue, RestrictError,
+    NPlusOneError)
+from .index import (GeneralIndex, Pattern, Prefix, Suffix, NgramPrefix,
+    NgramSuffix, LexPattern, LexPrefix, LexSuffix, TrigramPattern, Near, _pattern_trigrams)
+from .util import (ClassProperty, Analyzer, _connect, _read_connect, session, dt2ts, t2ts, _scan_ids,
+    _add_prefix_scores, _script_load, _encode_unique_constraint, _LUA_INDEX_FUNCTIONS,
+    _record_fetch, _PROFILERS, _profiled, _record_profile, _timer)
 from django.contrib.gis.geos import Point as GeoPoint
 
 VERSION = '0.29.0'
@@ -150,7 +154,10 @@ Time, Text, Json, PrimaryKey, ManyToOne, ForeignModel, OneToMany]
 
 NUMERIC_TYPES = six.integer_types + (float, _Decimal, datetime, date, dtime)
 
-MissingColumn, InvalidOperation # silence pyflakes
+MissingColumn, InvalidOperation, NPlusOneError # silence pyflakes
+
+# extra data passed along with prefix/suffix items to the index writers
+_AFFIX_ITEM_MODES = {'ngram': ['ngram'], 'lex': [0]}
 
 USE_LUA = True
 def _enable_lua_writes():
@@ -184,6 +191,7 @@ class _ModelMetaclass(type):
         dict['_cunique'] = cunique = set()
         dict['_prefix'] = prefix = set()
         dict['_suffix'] = suffix = set()
+        dict['_external'] = external = set()
 
         dict['_columns'] = columns = {}
         pkey = None
@@ -221,6 +229,8 @@ class _ModelMetaclass(type):
                     if not USE_LUA:
                         raise ColumnError("Lua scripting must be enabled to support suffix indexes (%s.%s)"%(name, attr))
                     suffix.add(attr)
+                if getattr(col, '_external', False):
+                    external.add(attr)
                 if col._unique:
                     # We only allow one for performance when USE_LUA is False
                     if unique and not USE_LUA:
@@ -291,7 +301,13 @@ class _ModelMetaclass(type):
         key_prefix = dict.get('KEY_PREFIX') or name.lower()   # use better prefixes
         dict['_gindex'] = GeneralIndex(key_prefix)
 
+        # n-gram and trigram index entries can only be found for removal
+        # through the index record, so those indexes are always tracked
+        tracked = any('ngram' in (getattr(col, '_prefix', None), getattr(col, '_suffix', None))
+            or getattr(col, '_trigram', False) for col in columns.values())
+
         MODELS[name] = model = type.__new__(cls, name, bases, dict)
+        model._track_indexes = bool(getattr(model, 'track_indexes', False) or tracked)
         return model
 
 class Model(six.with_metaclass(_ModelMetaclass, object)):
@@ -350,13 +366,36 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         unique constrant is None in Python, the unique constraint won't apply.
         This is the typical behavior of nulls in unique constraints inside both
         MySQL and Postgres.
+
+    **Tracking index data**
+
+    To keep writes small, the Lua writer doesn't maintain keyword indexes
+    (matching on ``index=True`` text columns is handled by the ``:indexed:``
+    mappings written by ``.save()``), and doesn't keep a record of the index
+    data written for each entity. Without that record, index data that is no
+    longer current isn't removed when entities are updated or deleted.
+
+    Set ``track_indexes = True`` on a model to write keyword indexes, and to
+    keep a record of each entity's index data in the ``<prefix>::`` hash.
+    Updates then only write the index data that actually changed, and stale
+    index data is removed on update, on delete, by
+    ``util.refresh_indices()``, and by ``util.clean_old_index()``::
+
+        class Article(Model):
+            track_indexes = True
+            title = Text(index=True, prefix=True)
+
+    Models with ``prefix='ngram'``, ``suffix='ngram'``, or ``trigram=True``
+    columns always track their index data.
     '''
 
     KEY_PREFIX = None
     track_dirty_fields = False
+    track_indexes = False
     db_writable_fields = None
 
     def __init__(self, **kwargs):
+        start = _timer() if _PROFILERS else None
         self._new = not kwargs.pop('_loading', False)
         model = self._key_prefix()
         self._data = {}
@@ -378,11 +417,16 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         self._init = True
         self._reset_orig_data()
         session.add(self)
+        if start is not None:
+            _record_profile(model, None, 'init', start)
 
     def _reset_orig_data(self):
         """
         Reset _orig_data back
         """
+        if _PROFILERS:
+            self._orig_data = _profiled(self._key_prefix(), None, 'copy', copy.deepcopy, self._data)
+            return
         self._orig_data = copy.deepcopy(self._data)
 
     def refresh(self, force=False):
@@ -411,6 +455,80 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
     def _dirty_fields_key(self):
         return '{}:dirty'.format(self._pk)
 
+    @classmethod
+    def _index_entries(cls, new, attrs=None):
+        '''
+        Generates the index data for the provided column values, returning
+        the ``(keys, scores, prefix, suffix)`` that are passed to the index
+        writers. If *attrs* is provided, only index data for those columns is
+        generated.
+        '''
+        keys = set()
+        scores = {}
+        prefix = []
+        suffix = []
+        for attr in (cls._columns if attrs is None else attrs):
+            ca = cls._columns[attr]
+            nval = new.get(attr)
+            if not ca._keygen or nval is None or not (ca._index or ca._prefix or ca._suffix):
+                continue
+            if isinstance(nval, _LazyJson):
+                nval = ca.from_redis(nval.raw)
+            generated = ca._keygen(nval)
+            if isinstance(generated, (list, tuple, set)):
+                if ca._index:
+                    for k in generated:
+                        keys.add('%s:%s'%(attr, k))
+                # edge n-gram indexes are marked for the writers, and
+                # lexicographic indexes use a score of 0
+                mode = _AFFIX_ITEM_MODES.get(ca._prefix, [])
+                if ca._trigram:
+                    # prefix scores are filled in before writing
+                    mode = (mode or [None]) + ['trigram']
+                if ca._prefix:
+                    for k in generated:
+                        prefix.append([attr, k] + mode)
+                mode = _AFFIX_ITEM_MODES.get(ca._suffix, [])
+                if ca._suffix:
+                    for k in generated:
+                        if six.PY2 and isinstance(k, str) and isinstance(ca, Text):
+                            try:
+                                suffix.append([attr, k.decode('utf-8')[::-1].encode('utf-8')] + mode)
+                            except UnicodeDecodeError:
+                                suffix.append([attr, k[::-1]] + mode)
+                        else:
+                            suffix.append([attr, k[::-1]] + mode)
+            elif isinstance(generated, dict):
+                for k, v in generated.items():
+                    if not k:
+                        scores[attr] = v
+                    else:
+                        scores['%s:%s'%(attr, k)] = v
+            elif not generated:
+                pass
+            else:
+                raise ColumnError("Don't know how to turn %r into a sequence of keys"%(generated,))
+        return keys, scores, prefix, suffix
+
+    @classmethod
+    def _index_values(cls, data):
+        '''
+        Converts raw entity data from Redis into the values passed to keygen
+        functions, without fetching any referenced entities. Used when
+        rebuilding indexes.
+        '''
+        values = {}
+        for attr, value in data.items():
+            ca = cls._columns.get(attr)
+            if ca is None or not ca._keygen:
+                continue
+            if isinstance(ca, (ManyToOne, ForeignModel)):
+                # the default keygen only needs the referenced id
+                values[attr] = int(value) if value.isdigit() else value
+            else:
+                values[attr] = ca.from_redis(value)
+        return values
+
     @classmethod
     def _apply_changes(cls, old, new, full=False, delete=False):
         use_lua = USE_LUA
@@ -425,16 +543,15 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         pipe = conn.pipeline(True)
 
         columns = cls._columns
+        entries = (set(), {}, [], []) if delete else None
+
         while 1:
             changes = 0
-            keys = set()
-            scores = {}
+            indexed = []
             data = {}
             unique = {}
             deleted = []
             udeleted = {}
-            prefix = []
-            suffix = []
 
             # check for unique keys
             if len(cls._unique) > 1 and not use_lua:
@@ -475,45 +592,22 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
 
                 ca = columns[attr]
                 roval = old.get(attr)
+                nval = new.get(attr)
+                if isinstance(nval, _LazyJson) and nval.raw == roval and not full:
+                    # compressed data that was never accessed is unchanged
+                    continue
                 oval = ca._from_redis(roval) if roval is not None else None
 
-                nval = new.get(attr)
                 rnval = ca.to_redis(nval) if nval is not None else None
 
-                # Add/update standard index
-                if ca._keygen and not delete and nval is not None and (ca._index or ca._prefix or ca._suffix):
-                    generated = ca._keygen(nval)
-                    if isinstance(generated, (list, tuple, set)):
-                        if ca._index:
-                            for k in generated:
-                                keys.add('%s:%s'%(attr, k))
-                        if ca._prefix:
-                            for k in generated:
-                                prefix.append([attr, k])
-                        if ca._suffix:
-                            for k in generated:
-                                if six.PY2 and isinstance(k, str) and isinstance(cls._columns[attr], Text):
-                                    try:
-                                        suffix.append([attr, k.decode('utf-8')[::-1].encode('utf-8')])
-                                    except UnicodeDecodeError:
-                                        suffix.append([attr, k[::-1]])
-                                else:
-                                    suffix.append([attr, k[::-1]])
-                    elif isinstance(generated, dict):
-                        for k, v in generated.items():
-                            if not k:
-                                scores[attr] = v
-                            else:
-                                scores['%s:%s'%(attr, k)] = v
-                    elif not generated:
-                        pass
-                    else:
-                        raise ColumnError("Don't know how to turn %r into a sequence of keys"%(generated,))
-
-                if nval == oval and not full:
+                # GEOS points are never equal to lazy ones, so lazy points
+                # compare their coordinates
+                if (oval == nval if isinstance(oval, LazyGeoPoint) else nval == oval) and not full:
                     continue
 
                 changes += 1
+                if ca._keygen and (ca._index or ca._prefix or ca._suffix):
+                    indexed.append(attr)
 
                 # Delete removed columns
                 if nval is None and oval is not None:
@@ -523,6 +617,8 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                             udeleted[attr] = roval
                     else:
                         pipe.hdel(key, attr)
+                        if attr in cls._external:
+                            pipe.delete(_external_key(key, attr))
                         if ikey:
                             pipe.hdel(ikey, roval)
                         # Index removal will occur by virtue of no index entry
@@ -562,14 +658,28 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
 
             id_only = str(pk)
             if use_lua:
+                # Only generate index data for indexed columns that changed,
+                # the writer leaves the index data for other columns alone.
+                indexed = None if full else indexed
+                keys, scores, prefix, suffix = entries or cls._index_entries(new, indexed)
+                # keyword indexes are only written when tracking index data
+                keys = sorted(keys) if cls._track_indexes else []
                 redis_writer_lua(conn, model, id_only, unique, udeleted,
-                    deleted, data, list(keys), scores, prefix, suffix, delete)
+                    deleted, data, keys, scores, prefix, suffix, delete, indexed,
+                    sorted(cls._external), cls._track_indexes)
                 return changes
-            elif delete:
+
+            entries = entries or cls._index_entries(new)
+            keys, scores, prefix, suffix = entries
+            if delete:
                 changes += 1
                 cls._gindex._unindex(conn, pipe, id_only)
-                pipe.delete(key)
+                pipe.delete(key, *[_external_key(key, attr) for attr in cls._external])
             else:
+                for attr in cls._external.intersection(data):
+                    if data[attr] != _EXTERNAL:
+                        pipe.set(_external_key(key, attr), data[attr])
+                        data[attr] = _EXTERNAL
                 if data:
                     pipe.hmset(key, data)
                 cls._gindex.index(conn, id_only, keys, scores, prefix, suffix, pipe=pipe)
@@ -587,12 +697,18 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         for returning items to JSON-enabled APIs. If you want to copy an
         entity, you should look at the ``.copy()`` method.
         '''
-        return dict(self._data)
+        data = dict(self._data)
+        for attr, value in data.items():
+            if isinstance(value, _LazyJson):
+                data[attr] = getattr(self, attr)
+        return data
 
     def to_json(self):
         lite_dict = self._data
         print lite_dict
         for key, value in lite_dict.iteritems():
+            if isinstance(value, _LazyJson):
+                value = getattr(self, key)
             if value is not None:
                 if isinstance(self._columns[key], Point):
                     point = getattr(self, key)
@@ -609,7 +725,8 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         Saves the current entity to Redis. Will only save changed data by
         default, but you can force a full save by passing ``full=True``.
         '''
-        new = self.to_dict()
+        # compressed Json data that wasn't accessed is saved without decoding
+        new = dict(self._data)
         ret = self._apply_changes(self._last, new, full or self._new)
 
         if self.track_dirty_fields and not self._new:
@@ -657,6 +774,9 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                                 conn.hset(mappings_key, val, json.dumps(pk_list))
                     elif isinstance(cls._columns[attr], ForeignModel) or isinstance(cls._columns[attr], ManyToOne):
                         continue
+                    elif isinstance(cls._columns[attr], Point):
+                        # locations are only in the GEO index
+                        continue
                     elif isinstance(cls._columns[attr], DateTime) or isinstance(cls._columns[attr], Date):
                         conn.zadd(index_key, self.pk, dt2ts(val))
                     else:
@@ -701,6 +821,8 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                                 conn.hset(mappings_key, val, json.dumps(pk_list))
                     elif isinstance(cls._columns[attr], ForeignModel) or isinstance(cls._columns[attr], ManyToOne):
                         pass
+                    elif isinstance(cls._columns[attr], Point):
+                        pass
                     else:
                         conn.zrem(index_key, self.pk)
 
@@ -795,6 +917,32 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         x.pop(self._pkey)
         return self.__class__(**x)
 
+    @classmethod
+    def prefetch(cls, entities, *columns):
+        '''
+        Fetches the data of ``external=True`` columns for the provided
+        entities in a single round trip, instead of one round trip for each
+        entity and column when they are first accessed. Pass column names to
+        only fetch those columns. Returns the entities.
+
+        Used like::
+
+            deliveries = Delivery.prefetch(Delivery.get(ids), 'route')
+        '''
+        columns = columns or sorted(cls._external)
+        pending = []
+        pipe = _connect(cls).pipeline(False)
+        for entity in entities:
+            for attr in columns:
+                value = entity._data.get(attr)
+                if isinstance(value, _LazyJson) and value.raw == _EXTERNAL:
+                    pipe.get(_external_key(entity._pk, attr))
+                    pending.append((entity, attr))
+        if pending:
+            for (entity, attr), raw in zip(pending, pipe.execute()):
+                cls._columns[attr]._load_external(entity, raw)
+        return entities
+
     @classmethod
     def get(cls, ids):
         '''
@@ -826,6 +974,8 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                 if data is None:
                     idxs.append(i)
                     pipe.hgetall(pks[i])
+            if len(idxs) == 1:
+                _record_fetch(cls)
             # Update output list
             for i, data in zip(idxs, pipe.execute()):
                 if data:
@@ -838,21 +988,67 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
             return out[0] if out else None
         return out
 
+    @classmethod
+    def scan(cls, batch=100, partition=None):
+        '''
+        Iterates over all entities of this model without requiring an index,
+        by using Redis' ``SCAN`` command over entity keys. Entities are
+        fetched *batch* at a time in a single round trip.
+
+        Used like::
+
+            for user in User.scan(batch=500):
+                # do something with user
+                ...
+
+        To split the work between multiple threads or processes, pass
+        *partition* as an ``(index, count)`` pair. Each partition will only
+        yield those entities whose id satisfies ``id % count == index``::
+
+            # in worker 3 of 8
+            for user in User.scan(partition=(3, 8)):
+                ...
+
+        .. warning: Partitioning only splits the fetching and processing of
+          entities. ``SCAN`` can't be split, so every partition still scans
+          all of the keys in the database and discards the ids of other
+          partitions, and *count* partitions perform *count* full scans. Use
+          it when handling entities is much slower than scanning for them.
+
+        .. note: Like ``Query.iter_result()``, entities that were not already
+          modified are removed from the session as they are yielded, to avoid
+          filling up memory.
+
+        .. note: Entities may be yielded more than once if the Redis keyspace
+          is resized during the scan (a property of ``SCAN``).
+        '''
+        conn = _connect(cls)
+        for ids in _scan_ids(conn, cls._key_prefix(), max(batch, 1), partition):
+            for ent in cls.get(ids):
+                if not ent._modified:
+                    session.forget(ent)
+                yield ent
+
     @classmethod
     def all_instances(cls):
         """
-        Need to support this later
+        Returns a list of all entities of this model, see ``Model.scan()``
+        for iterating over them without loading them all at once.
         """
-        return None
+        return list(cls.scan())
 
     @classmethod
     def filter_by(cls, **kwargs):
         """
         filter_by
+
+        At least one column must be provided, filtering by nothing raises a
+        ``QueryError`` instead of loading every entity. Use ``Model.scan()``
+        to iterate over all entities.
         """
         # Need to check for None case
         if kwargs is None or len(kwargs) == 0:
-            return cls.all_instances()
+            raise QueryError("filter_by() needs at least one column to filter by, see Model.scan()")
 
         conn = _connect(cls)
 
@@ -949,10 +1145,27 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         '''
         return Query(cls)
 
-_redis_writer_lua = _script_load('''
+_redis_writer_lua = _script_load(_LUA_INDEX_FUNCTIONS + '''
+-- KEYS are the index record hash, the entity hash, and the keys of any
+-- external columns
+local records = KEYS[1]
+local ent = KEYS[2]
 local namespace = ARGV[1]
 local id = ARGV[2]
 local is_delete = cjson.decode(ARGV[11])
+-- whether keyword indexes and the index record are maintained
+local track = ARGV[14] == '1'
+-- the columns whose index data should be updated, or null for all columns
+local columns = cjson.decode(ARGV[12])
+if columns == cjson.null then
+    columns = nil
+else
+    local cols = {}
+    for i, col in ipairs(columns) do
+        cols[col] = true
+    end
+    columns = cols
+end
 
 -- check and update unique column constraints
 for i, write in ipairs({false, true}) do
@@ -978,96 +1191,82 @@ for col, value in pairs(cjson.decode(ARGV[4])) do
     end
 end
 
+-- columns stored in their own keys, with a marker in the entity hash
+local external = {}
+for i, col in ipairs(cjson.decode(ARGV[13])) do
+    external[col] = KEYS[i + 2]
+end
+
 -- remove deleted columns
 local deleted = cjson.decode(ARGV[5])
 if #deleted > 0 then
-    redis.call('HDEL', string.format('%s:%s', namespace, id), unpack(deleted))
+    redis.call('HDEL', ent, unpack(deleted))
+    for i, col in ipairs(deleted) do
+        if external[col] then
+            redis.call('DEL', external[col])
+        end
+    end
 end
 
 -- update changed/added columns
 local data = cjson.decode(ARGV[6])
-if #data > 0 then
-    redis.call('HMSET', string.format('%s:%s', namespace, id), unpack(data))
-end
-
--- remove old index data, update util.clean_index_lua when changed
-local idata = redis.call('HGET', namespace .. '::', id)
-if idata then
-    idata = cjson.decode(idata)
-    if #idata == 2 then
-        idata[3] = {}
-        idata[4] = {}
-    end
-    for i, key in ipairs(idata[1]) do
-        redis.call('SREM', string.format('%s:%s:idx', namespace, key), id)
-    end
-    for i, key in ipairs(idata[2]) do
-        redis.call('ZREM', string.format('%s:%s:idx', namespace, key), id)
-    end
-    for i, data in ipairs(idata[3]) do
-        local key = string.format('%s:%s:pre', namespace, data[1])
-        local mem = string.format('%s\0%s', data[2], id)
-        redis.call('ZREM', key, mem)
-    end
-    for i, data in ipairs(idata[4]) do
-        local key = string.format('%s:%s:suf', namespace, data[1])
-        local mem = string.format('%s\0%s', data[2], id)
-        redis.call('ZREM', key, mem)
+for i = 1, #data, 2 do
+    local key = external[data[i]]
+    if key and data[i+1] ~= '~external' then
+        redis.call('SET', key, data[i+1])
+        data[i+1] = '~external'
     end
 end
-
-if is_delete then
-    redis.call('DEL', string.format('%s:%s', namespace, id))
-    redis.call('HDEL', namespace .. '::', id)
-end
-
--- add new key index data
-
--- add new scored index data
-local nscored = {}
-for key, score in pairs(cjson.decode(ARGV[8])) do
-    redis.call('ZADD', string.format('%s:%s:idx', namespace, key), score, id)
-    nscored[#nscored + 1] = key
+if #data > 0 then
+    redis.call('HMSET', ent, unpack(data))
 end
 
--- add new prefix data
-local nprefix = {}
-for i, data in ipairs(cjson.decode(ARGV[9])) do
-    local key = string.format('%s:%s:pre', namespace, data[1])
-    local mem = string.format("%s\0%s", data[2], id)
-    redis.call('ZADD', key, data[3], mem)
-    nprefix[#nprefix + 1] = {data[1], data[2]}
+if is_delete then
+    unindex(namespace, id)
+    redis.call('DEL', ent)
+    for col, key in pairs(external) do
+        redis.call('DEL', key)
+    end
+    redis.call('HDEL', records, id)
+    return 0
 end
 
--- add new suffix data
-local nsuffix = {}
-for i, data in ipairs(cjson.decode(ARGV[10])) do
-    local key = string.format('%s:%s:suf', namespace, data[1])
-    local mem = string.format("%s\0%s", data[2], id)
-    redis.call('ZADD', key, data[3], mem)
-    nsuffix[#nsuffix + 1] = {data[1], data[2]}
+if columns and next(columns) == nil then
+    return 0
 end
 
-return #nscored + #nprefix + #nsuffix
+-- only change the index data that differs from what is already indexed
+return update_index(namespace, id, cjson.decode(ARGV[7]), cjson.decode(ARGV[8]),
+    cjson.decode(ARGV[9]), cjson.decode(ARGV[10]), columns, track, false)
 ''')
 
 def redis_writer_lua(conn, namespace, id, unique, udelete, delete, data, keys,
-                     scored, prefix, suffix, is_delete):
+                     scored, prefix, suffix, is_delete, columns=None, external=(),
+                     track=True):
     ldata = []
     for pair in data.items():
         ldata.extend(pair)
 
-    for item in prefix:
-        item.append(_prefix_score(item[-1]))
-    for item in suffix:
-        item.append(_prefix_score(item[-1]))
+    _add_prefix_scores(prefix)
+    _add_prefix_scores(suffix)
 
-    result = _redis_writer_lua(conn, [], [namespace, id] + list(map(json.dumps, [
-        unique, udelete, delete, ldata, keys, scored, prefix, suffix, is_delete])))
+    ent = '%s:%s'%(namespace, id)
+    external = list(external)
+    result = _redis_writer_lua(conn,
+        [namespace + '::', ent] + [_external_key(ent, attr) for attr in external],
+        [namespace, id] + list(map(json.dumps, [
+            unique, udelete, delete, ldata, keys, scored, prefix, suffix, is_delete,
+            columns, external])) + ['1' if track else '0'])
     if isinstance(result, six.binary_type):
         result = result.decode()
         raise UniqueKeyViolation("Value %r for %s:%s:uidx not distinct"%(unique[result], namespace, result))
 
+def _analyze(analyzer, value):
+    # a word passed to filter() is analyzed like indexed text, but words that
+    # aren't indexed (like stopwords) are left as-is, and won't match
+    words = analyzer(value)
+    return words[0] if words and len(words) == 1 else value
+
 class Query(object):
     '''
     This is a query object. It behaves a lot like other query objects. Every
@@ -1141,6 +1340,13 @@ class Query(object):
             if isinstance(value, bool):
                 value = str(bool(value))
 
+            analyzer = getattr(self._model._columns.get(attr), '_keygen', None)
+            if isinstance(analyzer, Analyzer):
+                if isinstance(value, six.string_types):
+                    value = _analyze(analyzer, value)
+                elif isinstance(value, list):
+                    value = [_analyze(analyzer, v) for v in value]
+
             if isinstance(value, NUMERIC_TYPES):
                 # for simple numeric equiality filters
                 value = (value, value)
@@ -1172,6 +1378,35 @@ class Query(object):
                 raise QueryError("Sorry, we don't know how to filter %r by %r"%(attr, value))
         return self.replace(filters=tuple(cur_filters))
 
+    def near(self, radius, unit='m', **kwargs):
+        '''
+        When provided with keyword arguments of the form ``col=(x, y)`` or
+        ``col=point``, this will limit the entities returned to those with
+        locations within *radius* of the provided longitude ``x`` and
+        latitude ``y``. The *unit* of the radius can be ``'m'`` (the default),
+        ``'km'``, ``'mi'``, or ``'ft'``. The column must be a ``Point`` column
+        with ``index=True``.
+
+        Near filters can be combined with any other filters, and unless you
+        pass an ``order_by`` clause, the results are ordered by their distance
+        from the location, nearest first::
+
+            # the 10 closest available drivers within 2 kilometers
+            Driver.query.filter(available=True) \\
+                .near(location=(-122.4194, 37.7749), radius=2, unit='km') \\
+                .limit(0, 10).all()
+        '''
+        if unit not in ('m', 'km', 'mi', 'ft'):
+            raise QueryError("Unknown distance unit %r, expected one of 'm', 'km', 'mi', or 'ft'"%(unit,))
+        new = []
+        for k, v in kwargs.items():
+            col = self._model._columns.get(k)
+            if not isinstance(col, Point) or not col._index:
+                raise QueryError("Near queries on %s require a Point column with index=True"%(k,))
+            x, y = v if isinstance(v, (tuple, list)) else (v.x, v.y)
+            new.append(Near(k, float(x), float(y), radius, unit))
+        return self.replace(filters=self._filters+tuple(new))
+
     def startswith(self, **kwargs):
         '''
         When provided with keyword arguments of the form ``col=prefix``, this
@@ -1186,7 +1421,13 @@ class Query(object):
         '''
         new = []
         for k, v in kwargs.items():
-            new.append(Prefix(k, v))
+            mode = self._affix_mode(k, '_prefix')
+            if mode == 'ngram':
+                new.append(NgramPrefix(k, v))
+            elif mode == 'lex':
+                new.append(LexPrefix(k, v))
+            else:
+                new.append(Prefix(k, v))
         return self.replace(filters=self._filters+tuple(new))
 
     def endswith(self, **kwargs):
@@ -1203,7 +1444,13 @@ class Query(object):
         '''
         new = []
         for k, v in kwargs.items():
-            new.append(Suffix(k, v[::-1]))
+            mode = self._affix_mode(k, '_suffix')
+            if mode == 'ngram':
+                new.append(NgramSuffix(k, v[::-1]))
+            elif mode == 'lex':
+                new.append(LexSuffix(k, v[::-1]))
+            else:
+                new.append(Suffix(k, v[::-1]))
         return self.replace(filters=self._filters+tuple(new))
 
     def like(self, **kwargs):
@@ -1234,12 +1481,25 @@ class Query(object):
           checked, so if you want to match a pattern that doesn't start at
           the beginning of a string, you should prefix it with one of the
           wildcard characters (like ``*`` as we did with the 'frank' pattern).
+
+        .. note: Patterns that don't start with a literal prefix check every
+          word in the prefix index. Enable ``trigram=True`` on the column to
+          only check entities that include the pattern's literal text.
         '''
         new = []
         for k, v in kwargs.items():
-            new.append(Pattern(k, v))
+            mode = self._affix_mode(k, '_prefix')
+            if mode == 'ngram':
+                raise QueryError("Pattern matching on %s requires prefix=True, not an edge n-gram index"%(k,))
+            if self._affix_mode(k, '_trigram') and _pattern_trigrams(v):
+                new.append(TrigramPattern(k, v))
+            else:
+                new.append(LexPattern(k, v) if mode == 'lex' else Pattern(k, v))
         return self.replace(filters=self._filters+tuple(new))
 
+    def _affix_mode(self, attr, option):
+        return getattr(self._model._columns.get(attr), option, None)
+
     def order_by(self, column):
         '''
         When provided with a column name, will sort the results of your query::
@@ -1272,14 +1532,55 @@ class Query(object):
             filters += (self._order_by.lstrip('-'),)
         if not filters:
             raise QueryError("You are missing filter or order criteria")
-        return self._model._gindex.count(_connect(self._model), filters)
+        return self._model._gindex.count(self._search_connection(filters), filters)
+
+    def _search_connection(self, filters, order_by=None):
+        # searches that don't write temporary keys can use a replica
+        if self._model._gindex.is_read_only(filters, order_by):
+            return _read_connect(self._model)
+        return _connect(self._model)
 
     def _search(self):
         if not (self._filters or self._order_by):
             raise QueryError("You are missing filter or order criteria")
         limit = () if not self._limit else self._limit
         return self._model._gindex.search(
-            _connect(self._model), self._filters, self._order_by, *limit)
+            self._search_connection(self._filters, self._order_by),
+            self._filters, self._order_by, *limit)
+
+    def explain(self):
+        '''
+        Returns the plan that will be used to execute this query, as a list
+        of steps with the estimated number of entities matched by each
+        filter, without executing it. See ``GeneralIndex.explain()`` for the
+        format of the steps::
+
+            for step in User.query.filter(name='frank').startswith(email='fr').explain():
+                print(step['operation'], step['filter'], step['estimate'])
+        '''
+        if not (self._filters or self._order_by):
+            raise QueryError("You are missing filter or order criteria")
+        return self._model._gindex.explain(
+            self._search_connection(self._filters, self._order_by),
+            self._filters, self._order_by)
+
+    def profile(self):
+        '''
+        Executes the query one step at a time without loading any entities,
+        returning the steps from ``explain()`` along with the number of
+        results after each step and the time spent on each step on the Redis
+        server and in the client. See ``GeneralIndex.profile()`` for the
+        details::
+
+            for step in User.query.filter(name='frank').order_by('-created_at').profile():
+                print(step['operation'], step['size'], step['server_time'], step['client_time'])
+        '''
+        if not (self._filters or self._order_by):
+            raise QueryError("You are missing filter or order criteria")
+        limit = () if not self._limit else self._limit
+        return self._model._gindex.profile(
+            self._search_connection(self._filters, self._order_by),
+            self._filters, self._order_by, *limit)
 
     def iter_result(self, timeout=30, pagesize=100):
         '''
@@ -1,15 +1,21 @@
-from django.contrib.gis.geos import Point
 from datetime import datetime, date, time as dtime
 from decimal import Decimal as _Decimal
+import base64
 import json
 import warnings
+import zlib
 
 import six
 
 from .exceptions import (ORMError, InvalidOperation, ColumnError,
     MissingColumn, InvalidColumnValue, RestrictError)
-from .util import (_numeric_keygen, _string_keygen, _many_to_one_keygen,
-    _boolean_keygen, dt2ts, ts2dt, t2ts, ts2t, session, _connect)
+from .util import (_numeric_keygen, _string_keygen, _many_to_one_keygen, _geo_keygen,
+    _boolean_keygen, dt2ts, ts2dt, t2ts, ts2t, session, _connect, _PROFILERS,
+    _profiled)
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 from django.contrib.gis.geos import Point as GeoPoint
 from doordash.driver.routing.route import Route
 from rest_framework.utils.encoders import JSONEncoder
@@ -21,6 +27,7 @@ USE_LUA = True
 NO_ACTION_DEFAULT = object()
 SKIP_ON_DELETE = object()
 ON_DELETE = ('no action', 'restrict', 'cascade')
+AFFIX_MODES = (True, 'ngram', 'lex')
 
 def _restrict(entity, attr, refs):
     name = entity.__class__.__name__
@@ -94,11 +101,29 @@ class Column(object):
         * *prefix* - can be enabled on any column that generates a list of
           strings as a result of the default or passed *keygen* function, and
           will allow the searching of prefix matches (autocomplete) over your
-          data
+          data. Pass ``prefix='ngram'`` to index every leading substring of
+          each word (up to ``rom.util.NGRAM_MAX`` bytes) in its own SET, which
+          makes prefix matches a single SET lookup that doesn't depend on the
+          number of matching words, at the cost of more memory. Pass
+          ``prefix='lex'`` to store every word with a score of 0 and search
+          with ``ZRANGEBYLEX``, which compares whole words instead of only
+          their first 7 bytes (requires Redis 2.8.9 or later). Pattern
+          matching requires ``prefix=True`` or ``prefix='lex'``
         * *suffix* - can be enabled in the same contexts as *prefix* and
           enables suffix matching over your data. Any individual string in the
           returned data will be reversed (you need to make sure this makes
           conceptual sense with your data) before being stored or used.
+          ``suffix='ngram'`` and ``suffix='lex'`` are also supported
+        * *trigram* - can be enabled along with ``prefix=True`` or
+          ``prefix='lex'``, and indexes every 3 character substring of each
+          word in its own SET. Patterns passed to ``Query.like()`` that
+          include at least 3 literal characters in a row (like
+          ``*frank*@``) will only check the entities that have all of those
+          trigrams, instead of scanning the whole prefix index
+        * *analyzer* - can be enabled on ``String`` and ``Text`` columns
+          instead of passing *keygen*, pass a ``rom.util.Analyzer`` to control
+          how words are extracted for the index, with stopword removal,
+          stemming, and other filters
 
     .. warning: Enabling prefix or suffix matching on a column only makes
        sense for columns defining a non-numeric *keygen* function.
@@ -135,15 +160,16 @@ class Column(object):
     _default_ = None
     _allow_none = False
 
-    __slots__ = '_required _default _init _unique _index _model _attr _keygen _prefix _suffix'.split()
+    __slots__ = '_required _default _init _unique _index _model _attr _keygen _prefix _suffix _trigram'.split()
 
-    def __init__(self, required=False, default=NULL, unique=False, index=False, keygen=None, prefix=False, suffix=False):
+    def __init__(self, required=False, default=NULL, unique=False, index=False, keygen=None, prefix=False, suffix=False, analyzer=None, trigram=False):
         self._required = required
         self._default = default
         self._unique = unique
         self._index = index
         self._prefix = prefix
         self._suffix = suffix
+        self._trigram = trigram
         self._init = False
         self._model = None
         self._attr = None
@@ -158,6 +184,19 @@ class Column(object):
             if not is_string:
                 raise ColumnError("Unique columns can only be strings")
 
+        for option, value in (('prefix', prefix), ('suffix', suffix)):
+            if value and value not in AFFIX_MODES:
+                raise ColumnError("%s must be one of %r, not %r"%(option, AFFIX_MODES, value))
+        if trigram and prefix not in (True, 'lex'):
+            raise ColumnError("Trigram indexes require prefix=True or prefix='lex'")
+
+        if analyzer is not None:
+            if not is_string:
+                raise ColumnError("Analyzers can only be used on string columns")
+            if keygen:
+                raise ColumnError("Cannot provide both keygen and analyzer arguments")
+            keygen = analyzer
+
         numeric = True
         if index and not isinstance(self, ManyToOne):
             if not any(isinstance(i, allowed) for i in _NUMERIC):
@@ -179,6 +218,8 @@ class Column(object):
         """
         if self._allow_none and value == '':
             return None
+        if _PROFILERS:
+            return _profiled(self._model, self._attr, 'decode', self._from_redis, value)
         return self._from_redis(value)
 
     def _from_redis(self, value):
@@ -194,6 +235,8 @@ class Column(object):
         """
         if self._allow_none and value is None:
             return ''
+        if _PROFILERS:
+            return _profiled(self._model, self._attr, 'encode', self._to_redis, value)
         return self._to_redis(value)
 
     def _to_redis(self, value):
@@ -228,7 +271,10 @@ class Column(object):
                 value = self._default
         elif not isinstance(value, self._allowed):
             try:
-                value = self._from_redis(value)
+                if _PROFILERS:
+                    value = _profiled(model, attr, 'decode', self._from_redis, value)
+                else:
+                    value = self._from_redis(value)
             except (ValueError, TypeError) as e:
                 raise InvalidColumnValue(*e.args)
 
@@ -446,6 +492,141 @@ class Text(Column):
             return value.decode('utf-8')
         return value
 
+class JsonCodec(object):
+    '''
+    Encodes and decodes plain JSON data (dicts, lists, strings, numbers,
+    booleans, and None) for ``Json`` columns with the standard library's C
+    accelerated ``json`` module. Codecs raise ``TypeError`` or ``ValueError``
+    when they can't handle a value, and the column falls back to encoding with
+    its ``encoder_kwargs``.
+    '''
+    def dumps(self, value):
+        return json.dumps(value)
+
+    def loads(self, value):
+        return json.loads(value)
+
+def _has_non_finite(value):
+    if isinstance(value, float):
+        return value != value or value in (float('inf'), float('-inf'))
+    if isinstance(value, dict):
+        return any(_has_non_finite(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(_has_non_finite(v) for v in value)
+    return False
+
+class OrjsonCodec(JsonCodec):
+    '''
+    Uses the ``orjson`` package. Datetimes and subclasses of builtin types are
+    left to the column's regular encoder, so they are stored the same way as
+    with the ``json`` codec.
+
+    ``orjson`` writes NaN and infinite floats as ``null``, so values with them
+    raise ``ValueError`` and are left to the column's regular encoder too.
+    '''
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._options = (orjson.OPT_PASSTHROUGH_DATETIME |
+            orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_PASSTHROUGH_DATACLASS)
+
+    def dumps(self, value):
+        data = self._orjson.dumps(value, option=self._options)
+        # non-finite floats are the only other way to get a null
+        if b'null' in data and _has_non_finite(value):
+            raise ValueError("orjson can't encode NaN or infinite floats")
+        return data.decode('utf-8')
+
+    def loads(self, value):
+        return self._orjson.loads(value)
+
+class UjsonCodec(JsonCodec):
+    '''
+    Uses the ``ujson`` package.
+
+    .. note: Older versions of ``ujson`` round floats when encoding, so this
+      codec is only used when asked for by name.
+    '''
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, value):
+        return self._ujson.dumps(value)
+
+    def loads(self, value):
+        return self._ujson.loads(value)
+
+JSON_CODECS = {'json': JsonCodec, 'orjson': OrjsonCodec, 'ujson': UjsonCodec}
+_JSON_CODEC_CACHE = {}
+
+def _json_codec(codec):
+    if codec is None or not isinstance(codec, six.string_types):
+        return codec
+    if codec == 'auto':
+        try:
+            return _json_codec('orjson')
+        except ImportError:
+            return _json_codec('json')
+    if codec not in JSON_CODECS:
+        raise ColumnError("Unknown JSON codec %r, expected one of %r"%(
+            codec, ['auto'] + sorted(JSON_CODECS)))
+    if codec not in _JSON_CODEC_CACHE:
+        _JSON_CODEC_CACHE[codec] = JSON_CODECS[codec]()
+    return _JSON_CODEC_CACHE[codec]
+
+# compressed Json data is stored as ~<compressor>:<base64 data>, which can't
+# be confused with JSON
+COMPRESSORS = {'zlib': (zlib.compress, zlib.decompress)}
+if lz4 is not None:
+    COMPRESSORS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+_COMPRESSED = '~'
+# the value kept in the entity hash for external columns, also used by the
+# Lua writer in rom/__init__.py
+_EXTERNAL = '~external'
+
+def _external_key(pk, attr):
+    return '%s:ext:%s'%(pk, attr)
+
+def _compress(compressor, data):
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    data = base64.b64encode(COMPRESSORS[compressor][0](data)).decode('ascii')
+    return '%s%s:%s'%(_COMPRESSED, compressor, data)
+
+def _decompress(value):
+    compressor, _, data = value[1:].partition(':')
+    if compressor not in COMPRESSORS:
+        raise ColumnError("Cannot decompress data compressed with %r, is it installed?"%(compressor,))
+    return COMPRESSORS[compressor][1](base64.b64decode(data)).decode('utf-8')
+
+class _LazyJson(object):
+    # compressed Json data loaded from Redis, decoded when first accessed
+    __slots__ = ('column', 'raw')
+
+    def __init__(self, column, raw):
+        self.column = column
+        self.raw = raw
+
+    def __eq__(self, other):
+        if isinstance(other, _LazyJson):
+            return self.raw == other.raw
+        if self.raw == _EXTERNAL:
+            # not fetched, so assume it differs
+            return False
+        return self.column._from_redis(self.raw) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
 class Json(Column):
     '''
     Allows for more complicated nested structures as attributes.
@@ -457,8 +638,54 @@ class Json(Column):
 
         class MyModel(Model):
             col = Json()
+
+    Dicts, lists, and tuples are first encoded with a fast *codec*, and only
+    data that the codec can't handle (like datetimes) is encoded with
+    RestFramework's ``JSONEncoder``. The *codec* argument can be:
+
+        * ``'json'`` (the default) - the standard library's ``json``, which
+          writes the same data as the ``JSONEncoder``
+        * ``'auto'`` - ``orjson`` if it is installed, otherwise ``'json'``
+        * ``'orjson'`` or ``'ujson'`` - one of ``JSON_CODECS``
+        * an object with ``dumps()`` and ``loads()`` methods, like
+          ``JsonCodec``
+        * ``None`` - always use ``json`` with the ``encoder_kwargs``
+
+    Passing *encoder_kwargs* without a *codec* uses ``None``, so the extra
+    arguments apply to all data.
+
+    .. note: ``orjson`` writes compact JSON without spaces, so switching an
+      existing column to ``'orjson'`` or ``'auto'`` changes the data written
+      for every entity the next time it is saved. Both forms are read the
+      same way.
+
+    Large values can be compressed by passing *compress* as ``'zlib'``,
+    ``'lz4'`` (requires the ``lz4`` package), or ``'auto'`` to use ``lz4`` if
+    it is installed and ``zlib`` otherwise. Only encoded values of at least
+    *compress_threshold* bytes (1024 by default) are compressed, and only
+    when that makes them smaller. Compressed values are read from any
+    ``Json`` column whether compression is enabled or not, and are only
+    decompressed the first time the column is accessed, so entities can be
+    loaded and saved without paying for columns that aren't used::
+
+        class Delivery(Model):
+            route = RouteCol(compress='auto', compress_threshold=4096)
+
+    With ``external=True``, values are stored in their own Redis key
+    (``<prefix>:<id>:ext:<column>``) instead of the entity hash, which only
+    keeps a short marker. Loading entities then doesn't transfer the value,
+    and keeps the entity hashes small enough for Redis' compact encoding.
+    The value is fetched the first time the column is accessed, or for many
+    entities at once with ``Model.prefetch()``. External columns can't be
+    indexed or unique::
+
+        class Delivery(Model):
+            route = RouteCol(external=True, compress='auto')
+
+        deliveries = Delivery.prefetch(Delivery.get(ids), 'route')
     '''
     _allowed = (dict, list, tuple)
+    _codec_types = (dict, list, tuple)
 
     def __init__(self, *args, **kwargs):
         # use RestFramework's JSONEncoder, to handle datetime's
@@ -467,33 +694,212 @@ class Json(Column):
         extra_encoder_kwargs = kwargs.pop('encoder_kwargs', {})
         encoder_kwargs.update(extra_encoder_kwargs)
         self.encoder_kwargs = encoder_kwargs
+        self.codec = _json_codec(kwargs.pop('codec', None if extra_encoder_kwargs else 'json'))
+
+        compress = kwargs.pop('compress', None)
+        if compress == 'auto':
+            compress = 'lz4' if 'lz4' in COMPRESSORS else 'zlib'
+        if compress and compress not in COMPRESSORS:
+            raise ColumnError("Unknown or unavailable compressor %r, expected one of %r"%(
+                compress, ['auto'] + sorted(COMPRESSORS)))
+        self.compress = compress
+        self.compress_threshold = kwargs.pop('compress_threshold', 1024)
+        self._external = kwargs.pop('external', False)
+        if self._external and any(kwargs.get(option) for option in ('index', 'prefix', 'suffix', 'unique')):
+            raise ColumnError("External columns can't be indexed or unique")
 
         super(Json, self).__init__(*args, **kwargs)
 
+    def __get__(self, obj, objtype):
+        value = Column.__get__(self, obj, objtype)
+        if isinstance(value, _LazyJson):
+            if value.raw == _EXTERNAL:
+                value = self._load_external(obj,
+                    _connect(obj).get(_external_key(obj._pk, self._attr)))
+                if value is None:
+                    return None
+            if _PROFILERS:
+                value = _profiled(self._model, self._attr, 'decode', self._from_redis, value.raw)
+            else:
+                value = self._from_redis(value.raw)
+            obj._data[self._attr] = value
+        return value
+
+    def _load_external(self, obj, raw):
+        # keeps the fetched data of an external column for decoding on access
+        attr = self._attr
+        if isinstance(raw, six.binary_type):
+            raw = raw.decode('utf-8')
+        if raw is None:
+            value = None
+            obj._last.pop(attr, None)
+        else:
+            value = _LazyJson(self, raw)
+            obj._last[attr] = raw
+        obj._data[attr] = obj._orig_data[attr] = value
+        return value
+
+    def _init_(self, obj, model, attr, value, loading):
+        if loading and isinstance(value, six.string_types) and value.startswith(_COMPRESSED):
+            self._model = model
+            self._attr = attr
+            obj._data[attr] = _LazyJson(self, value)
+            return
+        Column._init_(self, obj, model, attr, value, loading)
+
     def _to_redis(self, value):
+        if isinstance(value, _LazyJson):
+            return value.raw
+        data = self._encode(value)
+        if self.compress and len(data) >= self.compress_threshold:
+            compressed = _compress(self.compress, data)
+            if len(compressed) < len(data):
+                return compressed
+        return data
+
+    def _encode(self, value):
+        if self.codec is not None and type(value) in self._codec_types:
+            try:
+                return self.codec.dumps(value)
+            except (TypeError, ValueError, OverflowError):
+                pass
         return json.dumps(value, **self.encoder_kwargs)
 
     def _from_redis(self, value):
+        if isinstance(value, _LazyJson):
+            value = value.raw
         if isinstance(value, self._allowed):
             return value
+        if isinstance(value, six.binary_type):
+            value = value.decode('utf-8')
+        if value == _EXTERNAL:
+            return _LazyJson(self, value)
+        if value.startswith(_COMPRESSED):
+            value = _decompress(value)
+        if self.codec is not None:
+            try:
+                return self.codec.loads(value)
+            except ValueError:
+                pass
         return json.loads(value)
 
 
+class LazyGeoPoint(object):
+    """
+    Returned by ``Point(lazy=True)`` columns in place of a GEOS ``Point``,
+    which is only built the first time it is needed. The ``x`` and ``y``
+    coordinates are available without building it, and any other attribute
+    is looked up on the GEOS ``Point``, which is also available as ``point``.
+    """
+    __slots__ = ('_x', '_y', '_point')
+
+    def __init__(self, x, y):
+        self._x = x
+        self._y = y
+        self._point = None
+
+    @property
+    def point(self):
+        if self._point is None:
+            self._point = GeoPoint(x=self._x, y=self._y)
+        return self._point
+
+    @property
+    def x(self):
+        return self._x if self._point is None else self._point.x
+
+    @property
+    def y(self):
+        return self._y if self._point is None else self._point.y
+
+    def __getattr__(self, attr):
+        return getattr(self.point, attr)
+
+    def __eq__(self, other):
+        if not isinstance(other, (LazyGeoPoint, GeoPoint)):
+            return NotImplemented
+        return (self.x, self.y) == (other.x, other.y)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __copy__(self):
+        return LazyGeoPoint(self.x, self.y)
+
+    def __deepcopy__(self, memo):
+        return LazyGeoPoint(self.x, self.y)
+
+    def __repr__(self):
+        return 'LazyGeoPoint(%r, %r)'%(self.x, self.y)
+
 class Point(Column):
     """
     Column to store point type.  This is necessary for PostGIS operations.
+
+    Points are stored as JSON ``{"x": .., "y": ..}`` by default. Passing
+    ``compact=True`` stores them as ``"x,y"`` instead, which is about half the
+    size and much faster to decode. By default the shortest representation
+    that reads back as the same float is used, but you can pass a number of
+    decimal places with *precision* to round coordinates (6 places is about
+    10 centimeters for longitude and latitude). Both forms are always read,
+    so existing data doesn't need to be rewritten, though clients older than
+    this version of rom can't read the compact form.
+
+    Passing ``lazy=True`` returns ``LazyGeoPoint`` objects when loading
+    entities, which only build the GEOS ``Point`` when it is used for more
+    than its ``x`` and ``y`` coordinates.
+
+    With ``index=True``, points are added to a geospatial index (``x`` is the
+    longitude and ``y`` the latitude), which can be searched with
+    ``Query.near()``. The index is a ZSET of the same scores that Redis
+    ``GEOADD`` uses, so it can also be used with other Redis GEO commands.
+    Latitudes must be within +/-85.05112878 degrees to be indexed.
+
+    Used via::
+
+        class Driver(Model):
+            location = Point(compact=True, lazy=True, index=True)
     """
-    _allowed = Point
+    _allowed = (GeoPoint, LazyGeoPoint)
     _allow_none = True
 
+    def __init__(self, *args, **kwargs):
+        self._compact = kwargs.pop('compact', False)
+        self._precision = kwargs.pop('precision', None)
+        self._lazy = kwargs.pop('lazy', False)
+        if self._precision is not None and not self._compact:
+            raise ColumnError("Point precision requires compact=True")
+        if kwargs.get('prefix') or kwargs.get('suffix') or kwargs.get('unique'):
+            raise ColumnError("Point columns only support index=True")
+        if kwargs.get('index') and not kwargs.get('keygen'):
+            kwargs['keygen'] = _geo_keygen
+        super(Point, self).__init__(*args, **kwargs)
+
     def _to_redis(self, value):
+        if self._compact:
+            if self._precision is None:
+                return '%r,%r'%(float(value.x), float(value.y))
+            return '%.*f,%.*f'%(self._precision, value.x, self._precision, value.y)
         point_dict = {'x': value.x, 'y': value.y}
         return json.dumps(point_dict)
 
     def _from_redis(self, value):
-        point_dict = json.loads(value)
-        point = GeoPoint(x=point_dict.get('x'), y=point_dict.get('y'))
-        return point
+        if isinstance(value, self._allowed):
+            return value
+        if isinstance(value, six.binary_type):
+            value = value.decode('utf-8')
+        if value.startswith('{'):
+            point_dict = json.loads(value)
+            x, y = point_dict.get('x'), point_dict.get('y')
+        else:
+            x, y = value.split(',')
+            x, y = float(x), float(y)
+        if self._lazy:
+            return LazyGeoPoint(x, y)
+        return GeoPoint(x=x, y=y)
 
 
 class RouteCol(Json):
@@ -681,7 +1087,7 @@ class OneToMany(Column):
     there are any entities with a reference to the entity being deleted.
 
     '''
-    __slots__ = '_model _attr _ftable _required _unique _index _prefix _suffix _keygen _on_delete _column'.split()
+    __slots__ = '_model _attr _ftable _required _unique _index _prefix _suffix _trigram _keygen _on_delete _column'.split()
     def __init__(self, ftable, on_delete=NO_ACTION_DEFAULT, column=None):
         if on_delete is NO_ACTION_DEFAULT:
             import sys
@@ -694,7 +1100,7 @@ class OneToMany(Column):
             raise ColumnError("on_delete argument must be one of %r, you provided %r"%(
                 list(ON_DELETE), on_delete))
         self._ftable = ftable
-        self._required = self._unique = self._index = self._prefix = self._suffix = False
+        self._required = self._unique = self._index = self._prefix = self._suffix = self._trigram = False
         self._model = self._attr = self._keygen = None
         self._on_delete = on_delete
         self._column = column
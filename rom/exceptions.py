@@ -2,7 +2,7 @@
 __all__ = '''
     ORMError UniqueKeyViolation InvalidOperation
     QueryError ColumnError MissingColumn
-    InvalidColumnValue RestrictError'''.split()
+    InvalidColumnValue RestrictError NPlusOneError'''.split()
 
 class ORMError(Exception):
     'Base class for all ORM-related errors'
@@ -27,3 +27,6 @@ class MissingColumn(ColumnError):
 
 class InvalidColumnValue(ColumnError):
     'Raised when you attempt to pass a primary key on entity creation or when data assigned to a column is the wrong type'
+
+class NPlusOneError(ORMError):
+    'Raised by ``rom.util.detect_n_plus_one()`` when entities are repeatedly fetched one at a time from the same place'
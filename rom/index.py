@@ -2,16 +2,35 @@
 from collections import namedtuple
 import json
 import re
+import time
 import uuid
 
 import six
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-from .exceptions import QueryError
-from .util import _prefix_score, _script_load, _to_score
+from .exceptions import ORMError, QueryError
+from .util import _prefix_score, _script_load, _to_score, NGRAM_MAX, _LUA_INDEX_FUNCTIONS
 
 Prefix = namedtuple('Prefix', 'attr prefix')
 Suffix = namedtuple('Suffix', 'attr suffix')
 Pattern = namedtuple('Pattern', 'attr pattern')
+# prefix and suffix matches on columns with edge n-gram indexes
+NgramPrefix = namedtuple('NgramPrefix', 'attr prefix')
+NgramSuffix = namedtuple('NgramSuffix', 'attr suffix')
+# prefix, suffix, and pattern matches on columns with lexicographic indexes
+LexPrefix = namedtuple('LexPrefix', 'attr prefix')
+LexSuffix = namedtuple('LexSuffix', 'attr suffix')
+LexPattern = namedtuple('LexPattern', 'attr pattern')
+# pattern matches narrowed down by a trigram index
+TrigramPattern = namedtuple('TrigramPattern', 'attr pattern')
+# locations within a radius of x (longitude) and y (latitude) on Point columns
+Near = namedtuple('Near', 'attr x y radius unit')
+# filters that can be searched without writing temporary keys
+_AFFIX_FILTERS = (Prefix, Suffix, Pattern, NgramPrefix, NgramSuffix,
+    LexPrefix, LexSuffix, LexPattern, TrigramPattern)
 
 SPECIAL = re.compile('([-().%[^$])')
 def _pattern_to_lua_pattern(pat):
@@ -44,6 +63,188 @@ MAX_PREFIX_SCORE = _prefix_score(7*'\xff', True)
 def _start_end(prefix):
     return _prefix_score(prefix), (_prefix_score(prefix, True) if prefix else MAX_PREFIX_SCORE)
 
+def _literal_prefix(pat):
+    # the full literal prefix of a pattern, for lexicographic indexes
+    for i, ch in enumerate(pat):
+        if ch in '?*+!':
+            return pat[:i]
+    return pat
+
+def _lex_range(prefix):
+    '''
+    Returns the ``ZRANGEBYLEX`` endpoints that include all ``key\\0id``
+    members whose key starts with the provided prefix.
+    '''
+    if not prefix:
+        return '-', '+'
+    if isinstance(prefix, six.text_type):
+        prefix = prefix.encode('utf-8')
+    return b'[' + prefix, b'(' + prefix + b'\xff'
+
+# Index records map column names to ``[flags, tokens, suffixes, subkeys]``,
+# in the same format as the records maintained by the Lua functions in
+# ``rom.util``, though the Python side stores them as JSON.
+_KEYWORD, _PREFIX, _SUFFIX, _SCORED, _PREFIX_NGRAM, _SUFFIX_NGRAM, _TRIGRAM = 1, 2, 4, 8, 16, 32, 64
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+def _edge_ngrams(token):
+    '''
+    Returns the prefixes of the token up to ``NGRAM_MAX`` bytes long when
+    encoded as UTF-8, the same as the edge n-grams generated in Lua.
+    '''
+    text = isinstance(token, six.text_type)
+    data = bytearray(token.encode('utf-8') if text else token)
+    grams = []
+    for n in range(1, min(len(data), NGRAM_MAX) + 1):
+        if n == len(data) or not 128 <= data[n] < 192:
+            gram = bytes(data[:n])
+            grams.append(gram.decode('utf-8') if text else gram)
+    return grams
+
+def _trigrams(token):
+    '''
+    Returns the distinct 3 character substrings of the token, the same as
+    the trigrams generated in Lua.
+    '''
+    text = isinstance(token, six.text_type)
+    data = bytearray(token.encode('utf-8') if text else token)
+    starts = [i for i, b in enumerate(data) if b < 128 or b >= 192] + [len(data)]
+    grams = []
+    for i in range(len(starts) - 3):
+        gram = bytes(data[starts[i]:starts[i+3]])
+        gram = gram.decode('utf-8') if text else gram
+        if gram not in grams:
+            grams.append(gram)
+    return grams
+
+def _pattern_trigrams(pat):
+    # every match of the pattern includes the trigrams of its literal runs
+    grams = []
+    for run in re.split('[?*+!]', pat):
+        for gram in _trigrams(run):
+            if gram not in grams:
+                grams.append(gram)
+    return grams
+
+def _is_trigram(item):
+    return len(item) > 3 and item[3] == 'trigram'
+
+def _is_ngram(item):
+    # prefix and suffix entries are [attr, key] or [attr, key, score], or
+    # [attr, key, 'ngram'] for edge n-gram indexes
+    return len(item) > 2 and item[2] == 'ngram'
+
+def _ngram_lookup(namespace, fltr):
+    # the edge n-gram SET holding the matches of the filter (None for an empty
+    # affix), and whether its members need to be checked against the index
+    # records because the affix is longer than the longest n-gram
+    if isinstance(fltr, NgramPrefix):
+        kind, affix = 'pre', fltr.prefix
+    else:
+        kind, affix = 'suf', fltr.suffix
+    grams = _edge_ngrams(affix)
+    key = '%s:%s:%s:%s'%(namespace, fltr.attr, grams[-1], kind) if grams else None
+    return dict(key=key, kind=kind, affix=affix, check=not grams or grams[-1] != affix)
+
+def _build_record(keys, scores, prefix, suffix):
+    record = {}
+    seen = {}
+    def entry_for(attr, flag, token=None):
+        if attr not in record:
+            record[attr] = [0, [], [], []]
+            seen[attr] = set()
+        entry = record[attr]
+        entry[0] |= flag
+        if token is not None and token not in seen[attr]:
+            seen[attr].add(token)
+            entry[1].append(token)
+        return entry
+
+    for key in keys:
+        attr, _, token = key.partition(':')
+        entry_for(attr, _KEYWORD, token)
+    for item in prefix:
+        entry_for(item[0], _PREFIX_NGRAM if _is_ngram(item) else _PREFIX, item[1])
+        if _is_trigram(item):
+            entry_for(item[0], _TRIGRAM)
+    for item in suffix:
+        entry_for(item[0], _SUFFIX_NGRAM if _is_ngram(item) else _SUFFIX)[2].append(item[1])
+    for key in scores:
+        attr, _, sub = key.partition(':')
+        if sub:
+            entry_for(attr, 0)[3].append(sub)
+        else:
+            entry_for(attr, _SCORED)
+
+    # drop suffixes that can be recreated by reversing the tokens
+    for entry in record.values():
+        suffixes = set(entry[2])
+        if suffixes and len(suffixes) == len(entry[1]) and all(
+                token[::-1] in suffixes and not NON_ASCII.search(token)
+                for token in entry[1]):
+            entry[2] = []
+    return record
+
+def _text(value):
+    if isinstance(value, six.binary_type) and six.PY3:
+        return value.decode('utf-8')
+    if isinstance(value, dict):
+        return dict((_text(k), _text(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_text(v) for v in value]
+    return value
+
+def _decode_record(data):
+    if data[:1] == b'[':
+        old = json.loads(data.decode())
+        keys, scored = old[:2]
+        pre, suf = ([],[]) if len(old) == 2 else old[2:]
+        return _build_record(keys, dict.fromkeys(scored), pre, suf)
+    if data[:1] == b'{':
+        return json.loads(data.decode())
+    if msgpack is None:
+        raise ORMError("The msgpack package is required to read index records written by Lua")
+    record = _text(msgpack.unpackb(data))
+    # empty records are packed as empty lists
+    return record or {}
+
+def _same_record(a, b):
+    # records are the same regardless of the order of their tokens
+    def normal(record):
+        return dict((attr, [entry[0]] + [sorted(part) for part in entry[1:]])
+            for attr, entry in _text(record).items())
+    return normal(a) == normal(b)
+
+def _affix_members(namespace, id, attr, kind, tokens, zset, ngram):
+    for token in tokens:
+        if zset:
+            yield True, '%s:%s:%s'%(namespace, attr, kind), '%s\0%s'%(token, id)
+        if ngram:
+            for gram in _edge_ngrams(token):
+                yield False, '%s:%s:%s:%s'%(namespace, attr, gram, kind), id
+
+def _record_members(namespace, id, attr, entry):
+    flags, tokens, suffixes, subkeys = entry
+    if flags & _KEYWORD:
+        for token in tokens:
+            yield False, '%s:%s:%s:idx'%(namespace, attr, token), id
+    for member in _affix_members(namespace, id, attr, 'pre', tokens,
+            flags & _PREFIX, flags & _PREFIX_NGRAM):
+        yield member
+    if flags & _TRIGRAM:
+        for token in tokens:
+            for gram in _trigrams(token):
+                yield False, '%s:%s:%s:tri'%(namespace, attr, gram), id
+    if not suffixes and flags & (_SUFFIX | _SUFFIX_NGRAM):
+        suffixes = [token[::-1] for token in tokens]
+    for member in _affix_members(namespace, id, attr, 'suf', suffixes,
+            flags & _SUFFIX, flags & _SUFFIX_NGRAM):
+        yield member
+    if flags & _SCORED:
+        yield True, '%s:%s:idx'%(namespace, attr), id
+    for sub in subkeys:
+        yield True, '%s:%s:%s:idx'%(namespace, attr, sub), id
+
 class GeneralIndex(object):
     '''
     This class implements general indexing and search for the ``rom`` package.
@@ -85,29 +286,36 @@ class GeneralIndex(object):
     Pattern matching also uses a Lua script to scan over data in the prefix
     index, exploiting prefixes in patterns if they exist.
 
+    With a trigram index, the member ``1`` is also added to the SETs
+    ``MyModel:c:hel:tri``, ``MyModel:c:ell:tri``, and ``MyModel:c:llo:tri``.
+    Pattern matches intersect the SETs for the trigrams in the pattern before
+    checking the words of the remaining entities.
+
+    Indexed ``Point`` columns use the numeric ZSET ``MyModel:c:idx``, scored
+    by the same geohashes as ``GEOADD``, so locations can be searched with
+    ``GEORADIUS``.
+
     '''
     def __init__(self, namespace):
         self.namespace = namespace
 
+    def _members(self, id, record):
+        for attr, entry in record.items():
+            for member in _record_members(self.namespace, id, attr, entry):
+                yield member
+
     def _unindex(self, conn, pipe, id):
         known = conn.hget(self.namespace + '::', id)
         if not known:
             return 0
-        old = json.loads(known.decode())
-        keys, scored = old[:2]
-        pre, suf = ([],[]) if len(old) == 2 else old[2:]
-
-        for key in keys:
-            pipe.srem('%s:%s:idx'%(self.namespace, key), id)
-        for key in scored:
-            pipe.zrem('%s:%s:idx'%(self.namespace, key), id)
-        for attr, key in pre:
-            pipe.zrem('%s:%s:pre'%(self.namespace, attr), '%s\0%s'%(key, id))
-        for attr, key in suf:
-            pipe.zrem('%s:%s:suf'%(self.namespace, attr), '%s\0%s'%(key, id))
+        count = 0
+        for attr, entry in _decode_record(known).items():
+            for is_zset, key, member in _record_members(self.namespace, id, attr, entry):
+                (pipe.zrem if is_zset else pipe.srem)(key, member)
+                count += 1
 
         pipe.hdel(self.namespace + '::', id)
-        return len(keys) + len(scored)
+        return count
 
     def unindex(self, conn, id):
         '''
@@ -139,25 +347,45 @@ class GeneralIndex(object):
               suffix matching (each string is likely to be a reversed version
               of *pre*, but this is not required)
 
-        This will automatically unindex the provided id before
-        indexing/re-indexing.
-
-        Unindexing is possible because we keep a record of all keys, score
+        Index data from a previous call that is no longer current is removed,
+        and SET and affix entries that are already indexed aren't written
+        again. This is possible because we keep a record of all keys, score
         keys, pre, and suf lists that were provided.
         '''
         had_pipe = bool(pipe)
         pipe = pipe or conn.pipeline(True)
-        self._unindex(conn, pipe, id)
+        record = _build_record(keys, scores, prefix, suffix)
+        known = conn.hget(self.namespace + '::', id)
+        old = _decode_record(known) if known else {}
+        indexed = set(self._members(id, old))
+        for is_zset, key, member in indexed - set(self._members(id, record)):
+            (pipe.zrem if is_zset else pipe.srem)(key, member)
+
+        def add(key, member):
+            if (False, key, member) not in indexed:
+                pipe.sadd(key, member)
 
         for key in keys:
-            pipe.sadd('%s:%s:idx'%(self.namespace, key), id)
+            add('%s:%s:idx'%(self.namespace, key), id)
+        # scores can change without the member changing
         for key, score in scores.items():
             pipe.zadd('%s:%s:idx'%(self.namespace, key), id, _to_score(score))
-        for attr, key in prefix:
-            pipe.zadd('%s:%s:pre'%(self.namespace, attr), '%s\0%s'%(key, id), _prefix_score(key))
-        for attr, key in suffix:
-            pipe.zadd('%s:%s:suf'%(self.namespace, attr), '%s\0%s'%(key, id), _prefix_score(key))
-        pipe.hset(self.namespace + '::', id, json.dumps([list(keys), list(scores), list(prefix), list(suffix)]))
+        for kind, items in (('pre', prefix), ('suf', suffix)):
+            for item in items:
+                attr, key = item[:2]
+                if _is_ngram(item):
+                    for gram in _edge_ngrams(key):
+                        add('%s:%s:%s:%s'%(self.namespace, attr, gram, kind), id)
+                else:
+                    idx, member = '%s:%s:%s'%(self.namespace, attr, kind), '%s\0%s'%(key, id)
+                    if (True, idx, member) not in indexed:
+                        score = item[2] if len(item) > 2 and item[2] is not None else _prefix_score(key)
+                        pipe.zadd(idx, member, score)
+                if _is_trigram(item):
+                    for gram in _trigrams(key):
+                        add('%s:%s:%s:tri'%(self.namespace, attr, gram), id)
+        if not known or not _same_record(old, record):
+            pipe.hset(self.namespace + '::', id, json.dumps(record))
         if not had_pipe:
             pipe.execute()
         return len(keys) + len(scores) + len(prefix) + len(suffix)
@@ -167,67 +395,212 @@ class GeneralIndex(object):
         pipe = conn.pipeline(True)
         sfilters = filters
         if len(filters) > 1:
-            # reorder filters based on the size of the underlying set/zset
-            for fltr in filters:
-                if isinstance(fltr, six.string_types):
-                    pipe.scard('%s:%s:idx'%(self.namespace, fltr))
-                elif isinstance(fltr, Prefix):
-                    estimate_work_lua(pipe, '%s:%s:pre'%(self.namespace, fltr.attr), fltr.prefix)
-                elif isinstance(fltr, Suffix):
-                    estimate_work_lua(pipe, '%s:%s:suf'%(self.namespace, fltr.attr), fltr.suffix)
-                elif isinstance(fltr, Pattern):
-                    estimate_work_lua(pipe, '%s:%s:pre'%(self.namespace, fltr.attr), _find_prefix(fltr.pattern))
-                elif isinstance(fltr, (tuple, list)):
-                    pipe.zcard('%s:%s:idx'%(self.namespace, fltr[0]))
-                else:
-                    raise QueryError("Don't know how to handle a filter of: %r"%(fltr,))
-            sizes = list(enumerate(pipe.execute()))
-            sizes.sort(key=lambda x:x[1])
-            sfilters = [filters[x[0]] for x in sizes]
+            plan = self._plan(conn, filters)
+            if any(size == 0 for fltr, size in plan):
+                # nothing can match, so there's nothing to intersect
+                return pipe, pipe.zinterstore, temp_id
+            sfilters = [fltr for fltr, size in plan]
 
-        # the first "intersection" is actually a union to get us started
-        intersect = pipe.zunionstore
         first = True
         for fltr in sfilters:
-            if isinstance(fltr, list):
-                # or string string/tag search
-                if len(fltr) == 1:
-                    # only 1? Use the simple version.
-                    fltr = fltr[0]
-                elif not fltr:
-                    continue
-                else:
-                    temp_id2 = str(uuid.uuid4())
-                    pipe.zunionstore(temp_id2, dict(
-                        ('%s:%s:idx'%(self.namespace, fi), 0) for fi in fltr))
-                    intersect(temp_id, {temp_id:0, temp_id2:0})
-                    pipe.delete(temp_id2)
-            if isinstance(fltr, six.string_types):
-                # simple string/tag search
-                intersect(temp_id, {temp_id:0, '%s:%s:idx'%(self.namespace, fltr):0})
-            elif isinstance(fltr, Prefix):
-                redis_prefix_lua(pipe, temp_id, '%s:%s:pre'%(self.namespace, fltr.attr), fltr.prefix, first)
-            elif isinstance(fltr, Suffix):
-                redis_prefix_lua(pipe, temp_id, '%s:%s:suf'%(self.namespace, fltr.attr), fltr.suffix, first)
-            elif isinstance(fltr, Pattern):
-                redis_prefix_lua(pipe, temp_id,
-                    '%s:%s:pre'%(self.namespace, fltr.attr),
-                    _find_prefix(fltr.pattern),
-                    first, '^' + _pattern_to_lua_pattern(fltr.pattern),
-                )
-            elif isinstance(fltr, tuple):
-                # zset range search
-                if len(fltr) != 3:
-                    raise QueryError("Cannot filter range of data without 2 endpoints (%s given)"%(len(fltr)-1,))
-                fltr, mi, ma = fltr
-                intersect(temp_id, {temp_id:0, '%s:%s:idx'%(self.namespace, fltr):1})
-                if mi is not None:
-                    pipe.zremrangebyscore(temp_id, '-inf', _to_score(mi, True))
-                if ma is not None:
-                    pipe.zremrangebyscore(temp_id, _to_score(ma, True), 'inf')
-            first = False
-            intersect = pipe.zinterstore
-        return pipe, intersect, temp_id
+            if self._apply(pipe, temp_id, fltr, first):
+                first = False
+        # the first "intersection" is actually a union to get us started
+        return pipe, (pipe.zunionstore if first else pipe.zinterstore), temp_id
+
+    def _apply(self, pipe, temp_id, fltr, first):
+        # Queues the commands that apply the filter to the results in
+        # temp_id, returning whether anything was applied.
+        intersect = pipe.zunionstore if first else pipe.zinterstore
+        if isinstance(fltr, list):
+            # or string string/tag search
+            if len(fltr) == 1:
+                # only 1? Use the simple version.
+                fltr = fltr[0]
+            elif not fltr:
+                return False
+            else:
+                temp_id2 = str(uuid.uuid4())
+                pipe.zunionstore(temp_id2, dict(
+                    ('%s:%s:idx'%(self.namespace, fi), 0) for fi in fltr))
+                intersect(temp_id, {temp_id:0, temp_id2:0})
+                pipe.delete(temp_id2)
+        if isinstance(fltr, six.string_types):
+            # simple string/tag search
+            intersect(temp_id, {temp_id:0, '%s:%s:idx'%(self.namespace, fltr):0})
+        elif isinstance(fltr, (Prefix, Suffix, Pattern)):
+            redis_prefix_lua(pipe, temp_id, is_first=first, **self._affix_lookup(fltr))
+        elif isinstance(fltr, (NgramPrefix, NgramSuffix)):
+            lookup = _ngram_lookup(self.namespace, fltr)
+            if lookup['check']:
+                redis_ngram_lua(pipe, temp_id, self._ngram_keys(lookup), fltr.attr,
+                    lookup['kind'], lookup['affix'], first)
+            else:
+                intersect(temp_id, {temp_id:0, lookup['key']:0})
+        elif isinstance(fltr, (LexPrefix, LexSuffix, LexPattern)):
+            redis_lex_lua(pipe, temp_id, is_first=first, **self._affix_lookup(fltr))
+        elif isinstance(fltr, TrigramPattern):
+            redis_trigram_lua(pipe, temp_id, self._trigram_keys(fltr), fltr.attr,
+                '^' + _pattern_to_lua_pattern(fltr.pattern), first)
+        elif isinstance(fltr, Near):
+            # distances from GEORADIUS become the scores of the results
+            dest = temp_id if first else str(uuid.uuid4())
+            pipe.georadius('%s:%s:idx'%(self.namespace, fltr.attr),
+                fltr.x, fltr.y, fltr.radius, unit=fltr.unit, store_dist=dest)
+            if not first:
+                intersect(temp_id, {temp_id:0, dest:1})
+                pipe.delete(dest)
+        elif isinstance(fltr, tuple):
+            # zset range search
+            if len(fltr) != 3:
+                raise QueryError("Cannot filter range of data without 2 endpoints (%s given)"%(len(fltr)-1,))
+            fltr, mi, ma = fltr
+            intersect(temp_id, {temp_id:0, '%s:%s:idx'%(self.namespace, fltr):1})
+            if mi is not None:
+                pipe.zremrangebyscore(temp_id, '-inf', _to_score(mi, True))
+            if ma is not None:
+                pipe.zremrangebyscore(temp_id, _to_score(ma, True), 'inf')
+        return True
+
+    def _estimate(self, pipe, fltr):
+        # Queues the commands to estimate how many entities the filter can
+        # match, returning the number of commands and how to combine them.
+        if isinstance(fltr, six.string_types):
+            pipe.scard('%s:%s:idx'%(self.namespace, fltr))
+        elif isinstance(fltr, list):
+            # matching any of the values, at most the sum of their sizes
+            for fi in fltr:
+                pipe.scard('%s:%s:idx'%(self.namespace, fi))
+            return len(fltr), sum
+        elif isinstance(fltr, (Prefix, Suffix, Pattern)):
+            lookup = self._affix_lookup(fltr)
+            estimate_work_lua(pipe, lookup['index'], lookup['prefix'])
+        elif isinstance(fltr, (LexPrefix, LexSuffix, LexPattern)):
+            lookup = self._affix_lookup(fltr)
+            pipe.zlexcount(lookup['index'], *_lex_range(lookup['prefix']))
+        elif isinstance(fltr, (NgramPrefix, NgramSuffix)):
+            # an empty affix can match any entity with an index record
+            key = _ngram_lookup(self.namespace, fltr)['key']
+            if key:
+                pipe.scard(key)
+            else:
+                pipe.hlen(self.namespace + '::')
+        elif isinstance(fltr, TrigramPattern):
+            # matches have every trigram, so at most the smallest SET
+            keys = self._trigram_keys(fltr)[1:]
+            for key in keys:
+                pipe.scard(key)
+            return len(keys), min
+        elif isinstance(fltr, Near):
+            # there's no cheap count of a radius, so all indexed locations
+            pipe.zcard('%s:%s:idx'%(self.namespace, fltr.attr))
+        elif isinstance(fltr, tuple):
+            if len(fltr) != 3:
+                raise QueryError("Cannot filter range of data without 2 endpoints (%s given)"%(len(fltr)-1,))
+            attr, mi, ma = fltr
+            pipe.zcount('%s:%s:idx'%(self.namespace, attr),
+                '-inf' if mi is None else _to_score(mi),
+                'inf' if ma is None else _to_score(ma))
+        else:
+            raise QueryError("Don't know how to handle a filter of: %r"%(fltr,))
+        return 1, sum
+
+    def _plan(self, conn, filters):
+        '''
+        Estimates the number of entities matched by each of the filters with
+        a single round trip, returning ``(filter, estimate)`` pairs in the
+        order the filters should be applied, smallest first.
+        '''
+        pipe = conn.pipeline(False)
+        combine = [self._estimate(pipe, fltr) for fltr in filters]
+        return self._order_plan(filters, combine, pipe.execute())
+
+    def _order_plan(self, filters, combine, results):
+        results = iter(results)
+        plan = []
+        for fltr, (count, fn) in zip(filters, combine):
+            sizes = [int(next(results)) for i in range(count)]
+            plan.append((fltr, fn(sizes) if sizes else None))
+        # empty lists of values don't limit the results, so they go last
+        plan.sort(key=lambda step: float('inf') if step[1] is None else step[1])
+        # GEORADIUS costs the same wherever it is applied, and applying it
+        # last leaves the results ordered by distance
+        plan.sort(key=lambda step: isinstance(step[0], Near))
+        return plan
+
+    def explain(self, conn, filters, order_by=None):
+        '''
+        Returns the plan that ``search()`` would use for the provided filters
+        and ordering, without executing it. The plan is a list of dictionaries
+        in the order the steps will be performed, each with the ``filter``,
+        the ``operation`` used to apply it (one of ``'read'``, ``'union'``,
+        ``'intersect'``, or ``'order'``), and the ``estimate`` of how many
+        entities the filter can match.
+
+        .. note: If any estimate is 0, ``search()`` and ``count()`` return
+          without applying the filters.
+        '''
+        if self.is_read_only(filters, order_by):
+            operations = ['read']
+        else:
+            operations = ['union'] + (len(filters) - 1) * ['intersect']
+        steps = [dict(filter=fltr, operation=op, estimate=size)
+            for op, (fltr, size) in zip(operations, self._plan(conn, filters))]
+        if order_by:
+            steps.append(dict(filter=order_by, operation='order', estimate=None))
+        return steps
+
+    def _affix_lookup(self, fltr):
+        if isinstance(fltr, (Prefix, LexPrefix)):
+            return dict(index='%s:%s:pre'%(self.namespace, fltr.attr), prefix=fltr.prefix)
+        if isinstance(fltr, (Suffix, LexSuffix)):
+            return dict(index='%s:%s:suf'%(self.namespace, fltr.attr), prefix=fltr.suffix)
+        find = _literal_prefix if isinstance(fltr, LexPattern) else _find_prefix
+        return dict(index='%s:%s:pre'%(self.namespace, fltr.attr),
+            prefix=find(fltr.pattern), pattern='^' + _pattern_to_lua_pattern(fltr.pattern))
+
+    def _trigram_keys(self, fltr):
+        # the index records, then the trigram SETs to intersect
+        grams = _pattern_trigrams(fltr.pattern)
+        if not grams:
+            raise QueryError("Pattern %r has no trigrams to search for"%(fltr.pattern,))
+        return [self.namespace + '::'] + ['%s:%s:%s:tri'%(self.namespace, fltr.attr, gram)
+            for gram in grams]
+
+    def _ngram_keys(self, lookup):
+        # the index records, then the SET of candidates if there is one
+        return [self.namespace + '::'] + ([lookup['key']] if lookup['key'] else [])
+
+    def is_read_only(self, filters, order_by=None):
+        '''
+        Returns whether a search over the provided filters can be performed
+        without writing any temporary keys, which is the case for a single
+        prefix, suffix, or pattern filter without an *order_by* clause. These
+        searches can be sent to read-only replicas.
+        '''
+        return not order_by and len(filters) == 1 and isinstance(filters[0], _AFFIX_FILTERS)
+
+    def _read_only_query(self, conn, fltr):
+        if isinstance(fltr, (NgramPrefix, NgramSuffix)):
+            lookup = _ngram_lookup(self.namespace, fltr)
+            if not lookup['check']:
+                return conn.smembers(lookup['key'])
+            return _affix_ids_lua(conn, self._ngram_keys(lookup),
+                ['ngram', fltr.attr, lookup['kind'], lookup['affix']])
+        elif isinstance(fltr, TrigramPattern):
+            return _affix_ids_lua(conn, self._trigram_keys(fltr),
+                ['trigram', fltr.attr, '^' + _pattern_to_lua_pattern(fltr.pattern)])
+        lex = isinstance(fltr, (LexPrefix, LexSuffix, LexPattern))
+        return affix_ids_lua(conn, lex=lex, **self._affix_lookup(fltr))
+
+    def _read_only_search(self, conn, fltr):
+        # same order as the ZSET of ids with equal scores
+        return sorted(self._read_only_query(conn, fltr))
+
+    def _order(self, intersect, temp_id, order_by):
+        reverse = order_by and order_by.startswith('-')
+        order_clause = '%s:%s:idx'%(self.namespace, order_by.lstrip('-'))
+        intersect(temp_id, {temp_id:0, order_clause: -1 if reverse else 1})
 
     def search(self, conn, filters, order_by, offset=None, count=None, timeout=None):
         '''
@@ -262,6 +635,25 @@ class GeneralIndex(object):
                 6. ``Pattern('column', 'pattern')`` - will match patterns over
                    words in a text search on the column
 
+                7. ``NgramPrefix('column', 'prefix')`` and
+                   ``NgramSuffix('column', 'suffix')`` - will match prefixes
+                   and suffixes of words using edge n-gram indexes
+
+                8. ``LexPrefix('column', 'prefix')``,
+                   ``LexSuffix('column', 'suffix')``, and
+                   ``LexPattern('column', 'pattern')`` - will match prefixes,
+                   suffixes, and patterns over words using lexicographic
+                   indexes
+
+                9. ``TrigramPattern('column', 'pattern')`` - will match
+                   patterns over words, only checking entities that have all
+                   of the trigrams from the pattern's literal text
+
+                10. ``Near('column', x, y, radius, unit)`` - will match
+                    locations within *radius* (in ``'m'``, ``'km'``,
+                    ``'mi'``, or ``'ft'``) of longitude *x* and latitude *y*
+                    in a geospatial index
+
             * *order_by* - A string that names the numeric column by which to
               sort the results by. Prefixing with '-' will return results in
               descending order
@@ -273,19 +665,23 @@ class GeneralIndex(object):
             .. note: If you omit the ``order_by`` argument, results will be
               ordered by the last filter. If the last filter was a text
               filter, see the previous note. If the last filter was numeric,
-              then results will be ordered by that result.
+              then results will be ordered by that result. ``Near`` filters
+              are always applied last, so results are ordered by distance.
 
             * *offset* - A numeric starting offset for results
             * *count* - The maximum number of results to return from the query
         '''
+        if timeout is None and self.is_read_only(filters, order_by):
+            ids = self._read_only_search(conn, filters[0])
+            offset = offset if offset is not None else 0
+            return ids[offset:offset + count] if count and count > 0 else ids[offset:]
+
         # prepare the filters
         pipe, intersect, temp_id = self._prepare(conn, filters)
 
         # handle ordering
         if order_by:
-            reverse = order_by and order_by.startswith('-')
-            order_clause = '%s:%s:idx'%(self.namespace, order_by.lstrip('-'))
-            intersect(temp_id, {temp_id:0, order_clause: -1 if reverse else 1})
+            self._order(intersect, temp_id, order_by)
 
         # handle returning the temporary result key
         if timeout is not None:
@@ -299,6 +695,78 @@ class GeneralIndex(object):
         pipe.delete(temp_id)
         return pipe.execute()[-2]
 
+    def profile(self, conn, filters, order_by, offset=None, count=None):
+        '''
+        Performs the search like ``search()``, but one step at a time,
+        returning the steps from ``explain()`` with the ``size`` of the
+        results after each step, and the ``server_time`` and ``client_time``
+        in seconds spent on each step. The server time is measured with
+        ``TIME`` calls around the step's commands inside ``MULTI``/``EXEC``,
+        and the client time includes the round trip.
+
+        Extra ``'plan'`` and ``'fetch'`` steps report the time spent
+        estimating the filters and reading the requested ids, with the size
+        of the ``'fetch'`` step being the number of ids returned. Steps that
+        were skipped because an estimate was 0 have a size of 0 and no times.
+        '''
+        steps = []
+        def timed(step, queue):
+            pipe = conn.pipeline(True)
+            pipe.time()
+            queue(pipe)
+            pipe.time()
+            start = time.time()
+            results = pipe.execute()
+            step['client_time'] = time.time() - start
+            (s1, us1), (s2, us2) = results[0], results[-1]
+            step['server_time'] = (s2 - s1) + (us2 - us1) / 1000000.0
+            steps.append(step)
+            return results[1:-1]
+
+        combine = []
+        step = dict(filter=None, operation='plan', estimate=None, size=None)
+        results = timed(step, lambda pipe: combine.extend(
+            self._estimate(pipe, fltr) for fltr in filters))
+        plan = self._order_plan(filters, combine, results)
+
+        offset = offset if offset is not None else 0
+        if self.is_read_only(filters, order_by):
+            step = dict(filter=plan[0][0], operation='read', estimate=plan[0][1])
+            step['size'] = len(timed(step, lambda pipe: self._read_only_query(pipe, filters[0]))[0])
+            return steps
+
+        temp_id = "%s:%s"%(self.namespace, uuid.uuid4())
+        skip = any(size == 0 for fltr, size in plan)
+        try:
+            first = True
+            ordering = [(order_by, None, True)] if order_by else []
+            for fltr, estimate, is_order in [step + (False,) for step in plan] + ordering:
+                step = dict(filter=fltr, estimate=estimate,
+                    operation='order' if is_order else 'union' if first else 'intersect')
+                if skip:
+                    step.update(size=0, server_time=None, client_time=None)
+                    steps.append(step)
+                    first = False
+                    continue
+                applied = []
+                def queue(pipe):
+                    if is_order:
+                        self._order(pipe.zunionstore if first else pipe.zinterstore, temp_id, order_by)
+                    else:
+                        applied.append(self._apply(pipe, temp_id, fltr, first))
+                    pipe.zcard(temp_id)
+                step['size'] = timed(step, queue)[-1]
+                if applied and applied[0]:
+                    first = False
+
+            end = (offset + count - 1) if count and count > 0 else -1
+            step = dict(filter=None, operation='fetch', estimate=None)
+            step['size'] = len(timed(step, lambda pipe: pipe.zrange(temp_id, offset, end))[0])
+        finally:
+            # also cleans up after steps that fail
+            conn.delete(temp_id)
+        return steps
+
     def count(self, conn, filters):
         '''
         Returns the count of the items that match the provided filters.
@@ -306,82 +774,184 @@ class GeneralIndex(object):
         For the meaning of what the ``filters`` argument means, see the
         ``.search()`` method docs.
         '''
+        if self.is_read_only(filters):
+            return len(self._read_only_search(conn, filters[0]))
+
         pipe, intersect, temp_id = self._prepare(conn, filters)
         pipe.zcard(temp_id)
         pipe.delete(temp_id)
         return pipe.execute()[-2]
 
-_redis_prefix_lua = _script_load('''
--- first unpack most of our passed variables
-local dest = KEYS[1]
-local tkey = KEYS[2]
-local idx = KEYS[3]
-
-local start_score = ARGV[1]
-local end_score = ARGV[2]
-local prefix = ARGV[3]
-local psize = #prefix
-local is_first = tonumber(ARGV[5])
-
--- find the start offset of our matching
-local start_index = 0
-if psize > 0 then
-    -- All entries end with a null and the id, so we can go before all of them
-    -- by just adding a null.
-    local pfix = prefix .. '\\0'
-    redis.call('ZADD', idx, start_score, pfix)
-    start_index = tonumber(redis.call('ZRANK', idx, pfix))
-    redis.call('ZREM', idx, pfix)
-else
-    local start_member = redis.call('ZRANGEBYSCORE', idx, start_score, 'inf', 'limit', 0, 1)
-    if #start_member == 1 then
-        start_index = tonumber(redis.call('ZRANK', idx, start_member[1]))
-    end
+_AFFIX_LUA = _LUA_INDEX_FUNCTIONS + '''
+-- Prefix, suffix, and trigram indexes are only ever read here, so matching
+-- works the same way on masters and read-only replicas. Matching ids are
+-- passed to found() in batches.
+local function entry_id(v)
+    return string.match(v, '%z([^%z]*)$')
 end
 
--- Find the end offset of our matching. We don't bother with the prefix-based
--- ZADD/ZREM pair here because we do an endpoint check every 100 items or so,
---
-local end_member = redis.call('ZREVRANGEBYSCORE', idx, '('..end_score, '-inf', 'limit', 0, 1)
-local end_index = 0
-if #end_member == 1 then
-    end_index = tonumber(redis.call('ZRANK', idx, end_member[1]))
+local function scored_matches(idx, start_score, end_score, prefix, is_pattern, found)
+    local psize = #prefix
+    -- Entries are ordered by score first, so the number of entries scored
+    -- before our endpoints gives us the range of ranks to check.
+    local start_index = tonumber(redis.call('ZCOUNT', idx, '-inf', '(' .. start_score))
+    local end_index = tonumber(redis.call('ZCOUNT', idx, '-inf', '(' .. end_score)) - 1
+
+    -- use functions to check instead of embedding an if inside the core loop
+    local check_match
+    if is_pattern then
+        check_match = function(v) return string.match(v, prefix) end
+    else
+        check_match = function(v) return string.sub(v, 1, psize) == prefix end
+    end
+
+    local has_prefix = psize > 0 and not is_pattern
+    if has_prefix and psize > 7 then
+        -- Scores only cover 7 bytes, so the entries checked all share one
+        -- score and are ordered by member. Skip to the first entry that can
+        -- match instead of walking the entries before it.
+        local lo, hi = start_index, end_index + 1
+        while lo < hi do
+            local mid = math.floor((lo + hi) / 2)
+            local v = redis.call('ZRANGE', idx, mid, mid)[1]
+            if v and v < prefix then
+                lo = mid + 1
+            else
+                hi = mid
+            end
+        end
+        start_index = lo
+    end
+
+    for i=start_index,end_index,100 do
+        local data = redis.call('ZRANGE', idx, i, math.min(i+99, end_index))
+        if #data == 0 then
+            break
+        end
+        local ids = {}
+        for j, v in ipairs(data) do
+            if check_match(v) then
+                ids[#ids + 1] = entry_id(v)
+            end
+        end
+        found(ids)
+        -- bail early if we've passed all of the shared prefixes
+        if has_prefix and string.sub(data[#data], 1, psize) > prefix then
+            break
+        end
+    end
 end
 
--- use functions to check instead of embedding an if inside the core loop
-local check_match
-if tonumber(ARGV[4]) > 0 then
-    check_match = function(v, pattern) return string.match(v, pattern) end
-else
-    check_match = function(v, prefix) return string.sub(v, 1, psize) == prefix end
+-- Lexicographic indexes store all entries with a score of 0, so the entries
+-- that share a prefix can be read directly with ZRANGEBYLEX.
+local function lex_matches(idx, min, max, pattern, found)
+    while true do
+        local data = redis.call('ZRANGEBYLEX', idx, min, max, 'LIMIT', 0, 1000)
+        local ids = {}
+        for i, v in ipairs(data) do
+            if pattern == '' or string.match(v, pattern) then
+                ids[#ids + 1] = entry_id(v)
+            end
+        end
+        found(ids)
+        if #data < 1000 then
+            break
+        end
+        min = '(' .. data[#data]
+    end
 end
 
-local matched = 0
-local found_match = function(v)
-    local endv = #v
-    while string.sub(v, endv, endv) ~= '\\0' do
-        endv = endv - 1
+-- The words of an index record entry in the form stored in the prefix or
+-- suffix indexes, where suffixes dropped from the record are the reversed
+-- prefix tokens.
+local function record_words(entry, kind)
+    if kind == 'pre' then
+        return entry[2]
+    elseif #entry[3] > 0 then
+        return entry[3]
     end
-    return redis.call('ZADD', tkey, 0, string.sub(v, endv+1, #v))
+    local words = {}
+    for i, token in ipairs(entry[2]) do
+        words[i] = string.reverse(token)
+    end
+    return words
 end
 
--- core matching loop
-local has_prefix = psize > 0 and tonumber(ARGV[4]) == 0
-for i=start_index,end_index,100 do
-    local data = redis.call('ZRANGE', idx, i, i+99)
-    local last
-    for j, v in ipairs(data) do
-        if check_match(v, prefix) then
-            matched = matched + tonumber(found_match(v))
+-- Checks the candidate ids against the words of attr in their index records
+-- from the HASH at records, passing those where match(word, id) is true for
+-- any word to found().
+local function record_matches(records, candidates, attr, kind, match, found)
+    for i = 1, #candidates, 100 do
+        local block = {unpack(candidates, i, math.min(i + 99, #candidates))}
+        local data = redis.call('HMGET', records, unpack(block))
+        local ids = {}
+        for j, id in ipairs(block) do
+            local entry = data[j] and decode_record(data[j])[attr]
+            for k, word in ipairs(entry and record_words(entry, kind) or {}) do
+                if match(word, id) then
+                    ids[#ids + 1] = id
+                    break
+                end
+            end
         end
-        last = v
+        found(ids)
     end
-    -- bail early if we've passed all of the shared prefixes
-    if has_prefix and string.sub(last, 1, psize) > prefix then
-        break
+end
+
+-- Candidates have all of the trigrams of the pattern's literal text, and are
+-- checked against the words in their index records, in the same word\\0id
+-- form as the prefix index entries. The first key is the HASH of index
+-- records, the rest are the trigram SETs.
+local function trigram_matches(keys, attr, pattern, found)
+    record_matches(keys[1], redis.call('SINTER', unpack(keys, 2)), attr, 'pre',
+        function(word, id) return string.match(word .. '\\0' .. id, pattern) end, found)
+end
+
+-- Edge n-gram SETs only go up to NGRAM_MAX bytes, so longer affixes are
+-- checked against the index records of the entities in the SET of their
+-- longest n-gram. Without that SET (for an empty affix), every entity with
+-- an index record is checked. The first key is the HASH of index records.
+local function ngram_matches(keys, attr, kind, affix, found)
+    local candidates
+    if keys[2] then
+        candidates = redis.call('SMEMBERS', keys[2])
+    else
+        candidates = redis.call('HKEYS', keys[1])
     end
+    record_matches(keys[1], candidates, attr, kind,
+        function(word) return string.sub(word, 1, #affix) == affix end, found)
 end
 
+local function affix_matches(keys, args, found)
+    if args[1] == 'lex' then
+        lex_matches(keys[1], args[2], args[3], args[4], found)
+    elseif args[1] == 'trigram' then
+        trigram_matches(keys, args[2], args[3], found)
+    elseif args[1] == 'ngram' then
+        ngram_matches(keys, args[2], args[3], args[4], found)
+    else
+        scored_matches(keys[1], args[2], args[3], args[4], tonumber(args[5]) > 0, found)
+    end
+end
+'''
+
+_redis_affix_lua = _script_load(_AFFIX_LUA + '''
+local dest = KEYS[1]
+local tkey = KEYS[2]
+local is_first = tonumber(ARGV[1])
+
+local matched = 0
+affix_matches({unpack(KEYS, 3)}, {unpack(ARGV, 2)}, function(ids)
+    if #ids > 0 then
+        local args = {}
+        for i, id in ipairs(ids) do
+            args[2*i - 1] = 0
+            args[2*i] = id
+        end
+        matched = matched + redis.call('ZADD', tkey, unpack(args))
+    end
+end)
+
 if is_first > 0 then
     if matched > 0 then
         redis.call('RENAME', tkey, dest)
@@ -394,45 +964,83 @@ end
 return matched
 ''')
 
+_affix_ids_lua = _script_load(_AFFIX_LUA + '''
+local seen = {}
+local result = {}
+affix_matches(KEYS, ARGV, function(ids)
+    for i, id in ipairs(ids) do
+        if not seen[id] then
+            seen[id] = true
+            result[#result + 1] = id
+        end
+    end
+end)
+return result
+''')
+
+def _affix_args(prefix, pattern=None, lex=False):
+    if lex:
+        start, end = _lex_range(prefix)
+        return ['lex', start, end, pattern or '']
+    start, end = _start_end(prefix)
+    return ['score', start, end, pattern or prefix, int(pattern is not None)]
+
 def redis_prefix_lua(conn, dest, index, prefix, is_first, pattern=None):
     '''
     Performs the actual prefix, suffix, and pattern match operations. 
     '''
     tkey = '%s:%s'%(index.partition(':')[0], uuid.uuid4())
-    start, end = _start_end(prefix)
-    return _redis_prefix_lua(conn,
+    return _redis_affix_lua(conn,
         [dest, tkey, index],
-        [start, end, pattern or prefix, int(pattern is not None), int(bool(is_first))]
+        [int(bool(is_first))] + _affix_args(prefix, pattern)
     )
 
-_estimate_work_lua = _script_load('''
--- We could use the ZADD/ZREM stuff from our prefix searching if we have a
--- prefix, but this is only an estimate, and it doesn't make sense to modify
--- an index just to get a better estimate.
-local idx = KEYS[1]
-
-local start_score = ARGV[1]
-local end_score = ARGV[2]
+def redis_lex_lua(conn, dest, index, prefix, is_first, pattern=None):
+    '''
+    Performs prefix, suffix, and pattern match operations over lexicographic
+    indexes.
+    '''
+    tkey = '%s:%s'%(index.partition(':')[0], uuid.uuid4())
+    return _redis_affix_lua(conn,
+        [dest, tkey, index],
+        [int(bool(is_first))] + _affix_args(prefix, pattern, True)
+    )
 
-local start_member = redis.call('ZRANGEBYSCORE', idx, start_score, 'inf', 'limit', 0, 1)
-local start_index = 0
-if #start_member == 1 then
-    start_index = tonumber(redis.call('ZRANK', idx, start_member[1]))
-end
+def redis_trigram_lua(conn, dest, keys, attr, pattern, is_first):
+    '''
+    Performs pattern match operations over the entities found with a trigram
+    index.
+    '''
+    tkey = '%s:%s'%(keys[0].partition(':')[0], uuid.uuid4())
+    return _redis_affix_lua(conn,
+        [dest, tkey] + keys,
+        [int(bool(is_first)), 'trigram', attr, pattern]
+    )
 
-local end_member = redis.call('ZREVRANGEBYSCORE', idx, '('..end_score, '-inf', 'limit', 0, 1)
-local end_index = -1
-if #end_member == 1 then
-    end_index = tonumber(redis.call('ZRANK', idx, end_member[1]))
-end
+def redis_ngram_lua(conn, dest, keys, attr, kind, affix, is_first):
+    '''
+    Performs prefix and suffix match operations over edge n-gram indexes for
+    affixes that need to be checked against the index records.
+    '''
+    tkey = '%s:%s'%(keys[0].partition(':')[0], uuid.uuid4())
+    return _redis_affix_lua(conn,
+        [dest, tkey] + keys,
+        [int(bool(is_first)), 'ngram', attr, kind, affix]
+    )
 
-return math.max(0, end_index - start_index + 1)
-''')
+def affix_ids_lua(conn, index, prefix, pattern=None, lex=False):
+    '''
+    Returns the ids of entries matching the prefix, suffix, or pattern over
+    the given index without writing anything to Redis, so it can be run
+    against a read-only replica.
+    '''
+    return _affix_ids_lua(conn, [index], _affix_args(prefix, pattern, lex))
 
 def estimate_work_lua(conn, index, prefix):
     '''
     Estimates the total work necessary to calculate the prefix match over the
-    given index with the provided prefix.
+    given index with the provided prefix, as the number of index entries in
+    the range of scores that will be checked.
     '''
     start, end = _start_end(prefix)
-    return _estimate_work_lua(conn, [index], [start, end], force_eval=True)
+    return conn.zcount(index, start, '(' + end)
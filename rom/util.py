@@ -44,6 +44,56 @@ There are four ways to change the way that ``rom`` connects to Redis.
 
     rom.util.get_connection = my_connection
 
+Searches that don't need to write any temporary keys (a single ``startswith()``,
+``endswith()``, or ``like()`` filter without an ``order_by()``) can be sent to
+a read-only replica instead. Give a model a ``_read_conn`` attribute, or
+monkey-patch ``rom.util.get_read_connection`` in the same way as
+``get_connection`` above. By default, these searches use the normal connection.
+
+
+Instrumentation
+===============
+
+To collect metrics about the round trips that ``rom`` makes to Redis (for
+StatsD, Prometheus, or logging slow calls), register a callback with
+``rom.util.add_hook()``. The callback is passed a dictionary with the Redis
+operation, the model name, the number of commands, the approximate number of
+bytes sent and received, and the latency in seconds::
+
+    import rom.util
+
+    def record(event):
+        statsd.timing('rom.%s.%s'%(event['model'], event['operation']),
+            event['latency'] * 1000)
+
+    rom.util.add_hook(record)
+
+Finding N+1 queries
+===================
+
+Calling ``Model.get(id)`` in a loop makes one round trip to Redis for each
+entity, as does loading entities whose ``ManyToOne`` columns reference
+entities that aren't in the session yet. To find these loops during
+development or in tests, wrap the code with ``rom.util.detect_n_plus_one()``,
+which raises ``rom.exceptions.NPlusOneError`` (or warns) when the same line of
+code fetches single entities of the same model over and over::
+
+    with rom.util.detect_n_plus_one(threshold=5, action='warn'):
+        render_page()
+
+Profiling column encoding and decoding
+======================================
+
+Converting column data to and from what is stored in Redis happens on the
+client, and can be hard to tell apart from waiting on Redis in a regular
+profile. Inside a ``rom.util.profile_columns()`` block, the time spent and
+number of calls are accumulated for each model and column, so you can see
+which columns are worth making lazy or storing in a different format::
+
+    with rom.util.profile_columns() as profiler:
+        handle_request()
+    print(profiler.table(limit=10))
+
 
 Using a non-caching session object
 ==================================
@@ -78,9 +128,15 @@ global or per-thread basis.
 from __future__ import print_function
 from datetime import datetime, date, time as dtime
 from itertools import chain
+import json
+import re
 import string
+import struct
+import sys
 import threading
 import time
+import types
+import warnings
 import weakref
 
 import pytz
@@ -88,10 +144,12 @@ import redis
 from redis.client import BasePipeline
 import six
 
-from .exceptions import ORMError
+from .exceptions import ORMError, NPlusOneError, InvalidColumnValue
 
 __all__ = '''
-    get_connection Session refresh_indices set_connection_settings'''.split()
+    get_connection get_read_connection Session refresh_indices parallel_refresh_indices
+    migrate_index_records set_connection_settings Checkpoint Analyzer
+    STOPWORDS add_hook remove_hook detect_n_plus_one profile_columns'''.split()
 
 CONNECTION = redis.Redis()
 USE_LUA = True
@@ -110,6 +168,12 @@ def get_connection():
     '''
     return CONNECTION
 
+def get_read_connection():
+    '''
+    Override me to send read-only searches to a replica.
+    '''
+    return get_connection()
+
 def _connect(obj):
     '''
     Tries to get the _conn attribute from a model. Barring that, gets the
@@ -118,9 +182,126 @@ def _connect(obj):
     from .columns import MODELS
     if isinstance(obj, MODELS['Model']):
         obj = obj.__class__
-    if hasattr(obj, '_conn'):
-        return obj._conn
-    return get_connection()
+    conn = obj._conn if hasattr(obj, '_conn') else get_connection()
+    return _instrument(conn, obj) if _HOOKS else conn
+
+def _read_connect(obj):
+    '''
+    Tries to get the _read_conn attribute from a model, then the _conn
+    attribute. Barring those, gets the global read connection.
+    '''
+    from .columns import MODELS
+    if isinstance(obj, MODELS['Model']):
+        obj = obj.__class__
+    if hasattr(obj, '_read_conn'):
+        conn = obj._read_conn
+    elif hasattr(obj, '_conn'):
+        conn = obj._conn
+    else:
+        conn = get_read_connection()
+    return _instrument(conn, obj) if _HOOKS else conn
+
+_HOOKS = []
+def add_hook(callback):
+    '''
+    Registers a callback to be called with a dictionary describing each
+    round trip that ``rom`` makes to Redis, with the keys:
+
+        * *operation* - the Redis command that was sent, or ``'pipeline'``
+          or ``'transaction'`` for pipelines
+        * *model* - the name of the model the round trip was made for, or
+          ``None``
+        * *commands* - the number of commands that were sent
+        * *bytes* - the approximate size of the commands and their results
+        * *latency* - how long the round trip took, in seconds
+
+    Connections are only instrumented while a callback is registered, so
+    there is no overhead otherwise.
+    '''
+    if callback not in _HOOKS:
+        _HOOKS.append(callback)
+
+def remove_hook(callback):
+    '''
+    Unregisters a callback passed to ``add_hook()``.
+    '''
+    if callback in _HOOKS:
+        _HOOKS.remove(callback)
+
+def _size(value):
+    if isinstance(value, (six.binary_type, six.text_type)):
+        return len(value)
+    if isinstance(value, (list, tuple, set)):
+        return sum(_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    if value is None or isinstance(value, bool):
+        return 0
+    return len(str(value))
+
+def _emit(operation, model, commands, size, start):
+    event = dict(operation=operation, model=model, commands=commands,
+        bytes=size, latency=time.time() - start)
+    for callback in list(_HOOKS):
+        callback(event)
+
+class _InstrumentedConnection(object):
+    '''
+    Wraps a Redis connection, calling the registered hooks after each
+    command or pipeline. The connection's methods are bound to the wrapper,
+    so they send their commands through ``execute_command()`` here.
+    '''
+    def __init__(self, conn, model):
+        self._conn = conn
+        self._model = model
+
+    def __getattr__(self, name):
+        for cls in type(self._conn).__mro__:
+            if name in cls.__dict__:
+                value = cls.__dict__[name]
+                if isinstance(value, types.FunctionType):
+                    return types.MethodType(value, self)
+                break
+        return getattr(self._conn, name)
+
+    def execute_command(self, *args, **options):
+        start = time.time()
+        result = None
+        try:
+            result = self._conn.execute_command(*args, **options)
+            return result
+        finally:
+            _emit(str(args[0]).upper(), self._model, 1, _size(args) + _size(result), start)
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self._conn.pipeline(*args, **kwargs)
+        pipe.__class__ = _instrumented_pipeline(type(pipe))
+        pipe._rom_model = self._model
+        return pipe
+
+class _InstrumentedPipeline(object):
+    def execute(self, *args, **kwargs):
+        commands = len(self.command_stack)
+        size = sum(_size(command[0]) for command in self.command_stack)
+        start = time.time()
+        result = None
+        try:
+            result = super(_InstrumentedPipeline, self).execute(*args, **kwargs)
+            return result
+        finally:
+            _emit('transaction' if self.transaction else 'pipeline',
+                self._rom_model, commands, size + _size(result), start)
+
+_PIPELINE_CLASSES = {}
+def _instrumented_pipeline(cls):
+    if cls not in _PIPELINE_CLASSES:
+        _PIPELINE_CLASSES[cls] = type('Instrumented' + cls.__name__, (_InstrumentedPipeline, cls), {})
+    return _PIPELINE_CLASSES[cls]
+
+def _instrument(conn, obj):
+    if isinstance(conn, (_InstrumentedConnection, BasePipeline)):
+        return conn
+    return _InstrumentedConnection(conn, getattr(obj, '__name__', None))
 
 class ClassProperty(object):
     '''
@@ -181,25 +362,119 @@ def _numeric_keygen(val):
 def _boolean_keygen(val):
     return [str(bool(val))]
 
-def _string_keygen(val):
+def _split_words(val):
+    return [s.strip(string.punctuation) for s in val.lower().split()]
+
+# deletes punctuation anywhere in the text in one pass, see Analyzer
+_PUNCTUATION_TABLE = dict.fromkeys(map(ord, string.punctuation))
+
+def _split_words_translate(val):
+    val = val.lower()
+    if isinstance(val, six.text_type):
+        return val.translate(_PUNCTUATION_TABLE).split()
+    return val.translate(None, string.punctuation).split()
+
+def _string_keygen(val, words=_split_words):
     if isinstance(val, float):
         val = repr(val)
     elif val in (None, ''):
         return None
     elif not isinstance(val, six.string_types):
         val = str(val)
-    r = sorted(set([x for x in [s.lower().strip(string.punctuation) for s in val.split()] if x]))
+    r = set(words(val))
+    r.discard('')
+    # sorted, so index data doesn't depend on hash order
+    r = sorted(r)
     if isinstance(val, six.string_types) and not isinstance(val, str):  # unicode on py2k
         return [s.encode('utf-8') for s in r]
     return r
 
+STOPWORDS = frozenset('''
+    a an and are as at be but by for from has have he her his i if in into is
+    it its not of on or our she so that the their them then there these they
+    this to was we were what when which who will with you your'''.split())
+
+class Analyzer(object):
+    '''
+    Analyzers turn the text of ``String`` and ``Text`` columns into the words
+    that are indexed, and can be passed as the *analyzer* argument to those
+    columns::
+
+        class Article(Model):
+            body = Text(index=True, analyzer=Analyzer(stopwords=STOPWORDS))
+
+    Text is lowercased and split on whitespace, and punctuation is stripped
+    from the ends of each word, just like the default index. With
+    *remove_punctuation*, punctuation is instead deleted from the whole text
+    with a single ``translate()`` before splitting, which is about 2.5x
+    faster on large text, but also joins words like ``e-mail`` into
+    ``email``. Words are then passed through the following optional steps:
+
+        * *stopwords* - a collection of words that will not be indexed, like
+          ``rom.util.STOPWORDS``
+        * *min_length* - words shorter than this will not be indexed
+        * *stemmer* - a callable that is passed each word, and returns the
+          word to index in its place (like ``nltk.stem.PorterStemmer().stem``)
+        * *filters* - a sequence of callables that are each passed the list
+          of words, and return the list of words to index instead
+
+    Words passed to ``Query.filter()`` for the column go through the same
+    steps, so that they match what was indexed.
+    '''
+    def __init__(self, stopwords=(), min_length=1, stemmer=None, filters=(),
+            remove_punctuation=False):
+        self.split = _split_words_translate if remove_punctuation else _split_words
+        self.stopwords = frozenset(stopwords)
+        self.min_length = min_length
+        self.stemmer = stemmer
+        self.filters = tuple(filters)
+
+    def words(self, val):
+        words = self.split(val)
+        if self.stopwords or self.min_length > 1:
+            min_length = self.min_length
+            stopwords = self.stopwords
+            words = [w for w in words if len(w) >= min_length and w not in stopwords]
+        if self.stemmer:
+            words = [self.stemmer(w) for w in words if w]
+        for fltr in self.filters:
+            words = fltr(words)
+        return words
+
+    def __call__(self, val):
+        return _string_keygen(val, self.words)
+
 def _many_to_one_keygen(val):
     if val is None:
         return []
+    if isinstance(val, six.integer_types):
+        return {'': val}
     if hasattr(val, '_data') and hasattr(val, '_pkey'):
         return {'': val._data[val._pkey]}
     return {'': val.id}
 
+# the same 52 bit geohash scores that GEOADD uses, so that a ZSET of these
+# scores can be searched with GEORADIUS
+GEO_LAT_LIMIT = 85.05112878
+GEO_STEP = 26
+
+def _geohash_score(lon, lat):
+    if not (-180 <= lon <= 180 and -GEO_LAT_LIMIT <= lat <= GEO_LAT_LIMIT):
+        raise InvalidColumnValue("Cannot index the location %r, %r, Redis only supports longitudes of +/-180 and latitudes of +/-%s"%(
+            lon, lat, GEO_LAT_LIMIT))
+    lat = int((lat - -GEO_LAT_LIMIT) / (GEO_LAT_LIMIT - -GEO_LAT_LIMIT) * (1 << GEO_STEP))
+    lon = int((lon - -180.0) / (180.0 - -180.0) * (1 << GEO_STEP))
+    score = 0
+    for bit in range(32):
+        score |= ((lat >> bit) & 1) << (2 * bit)
+        score |= ((lon >> bit) & 1) << (2 * bit + 1)
+    return score
+
+def _geo_keygen(val):
+    if val is None:
+        return None
+    return {'': str(_geohash_score(float(val.x), float(val.y)))}
+
 def _to_score(v, s=False):
     v = repr(v) if isinstance(v, float) else str(v)
     if s:
@@ -209,18 +484,42 @@ def _to_score(v, s=False):
 
 # borrowed and modified from:
 # https://gist.github.com/josiahcarlson/8459874
+_QWORD = struct.Struct('<Q')
+_DOUBLE = struct.Struct('<d')
 def _bigint_to_float(v):
     assert isinstance(v, six.integer_types)
     sign = -1 if v < 0 else 1
     v *= sign
     assert v < 0x7fe0000000000000
-    exponent, mantissa = divmod(v, 2**52)
-    return sign * (2**52 + mantissa) * 2.0**(exponent-52-1022)
+    # with the implicit leading 1 added, these are the bits of the double
+    return sign * _DOUBLE.unpack(_QWORD.pack(v + 2**52))[0]
 
+_PREFIX_SCORES = {}
+_PREFIX_SCORES_SIZE = 65536
 def _prefix_score(v, next=False):
+    # We only get 7 characters of score-based prefix, so the scores for
+    # those characters are memoized in a bounded cache.
+    key = v[:7], next
+    score = _PREFIX_SCORES.get(key)
+    if score is None:
+        if len(_PREFIX_SCORES) >= _PREFIX_SCORES_SIZE:
+            _PREFIX_SCORES.clear()
+        score = _PREFIX_SCORES[key] = _calc_prefix_score(*key)
+    return score
+
+def _add_prefix_scores(items):
+    # prefix and suffix entries for the default index mode are [attr, key]
+    # or [attr, key, None, 'trigram'], other modes already include what the
+    # writers need
+    for item in items:
+        if len(item) == 2:
+            item.append(_prefix_score(item[1]))
+        elif item[2] is None:
+            item[2] = _prefix_score(item[1])
+
+def _calc_prefix_score(v, next):
     if isinstance(v, six.text_type):
         v = v.encode('utf-8')
-    # We only get 7 characters of score-based prefix.
     score = 0
     for ch in six.iterbytes(v[:7]):
         score *= 258
@@ -466,7 +765,52 @@ def use_rom_session():
 
 session = Session()
 
-def refresh_indices(model, block_size=100):
+GLOB_SPECIAL = re.compile(r'([*?\[\]\\])')
+def _scan_ids(conn, prefix, block_size=100, partition=None):
+    '''
+    Uses ``SCAN`` to discover the ids of all entities stored under the
+    provided key prefix, yielding lists of at most *block_size* ids at a time.
+
+    Index, unique, and id counter keys share the entity key prefix, so only
+    keys of the form ``<prefix>:<digits>`` are considered to be entities.
+
+    If *partition* is provided as an ``(index, count)`` pair, only those ids
+    where ``id % count == index`` will be yielded. The whole keyspace is still
+    scanned for each partition.
+
+    .. note: As with all uses of ``SCAN``, an entity that exists for the
+      duration of the scan is guaranteed to be returned, but may be returned
+      more than once if the keyspace is resized during the scan.
+    '''
+    if partition is not None:
+        pindex, pcount = partition
+        if not 0 <= pindex < pcount:
+            raise ORMError("Invalid partition %r, must be (index, count) with 0 <= index < count"%(
+                partition,))
+    match = '%s:[0-9]*'%GLOB_SPECIAL.sub(r'\\\1', prefix)
+    plen = len(prefix) + 1
+    block = []
+    cursor = None
+    while cursor != 0:
+        cursor, keys = conn.scan(cursor or 0, match=match, count=block_size)
+        cursor = int(cursor)
+        for key in keys:
+            id = key[plen:]
+            if not isinstance(id, str):
+                id = id.decode('latin-1')
+            if not id.isdigit():
+                continue
+            id = int(id)
+            if partition is not None and id % pcount != pindex:
+                continue
+            block.append(id)
+            if len(block) >= block_size:
+                yield block
+                block = []
+    if block:
+        yield block
+
+def refresh_indices(model, block_size=100, columns=None, checkpoint=False, rate=None):
     '''
     This utility function will iterate over all entities of a provided model,
     refreshing their indices. This is primarily useful after adding an index
@@ -477,6 +821,14 @@ def refresh_indices(model, block_size=100):
         * *model* - the model whose entities you want to reindex
         * *block_size* - the maximum number of entities you want to fetch from
           Redis at a time, defaulting to 100
+        * *columns* - an optional list of column names to limit reindexing
+          to, useful after adding an index to a column. Index data for other
+          columns is left as-is, and only the listed columns are read.
+        * *checkpoint* - pass ``True`` to record progress in Redis after each
+          block, and to resume from a previously recorded checkpoint for the
+          same job (see ``Checkpoint`` for details)
+        * *rate* - an optional maximum number of entities to process per
+          second, to avoid starving other clients of the same Redis server
 
     This function will yield its progression through re-indexing all of your
     entities.
@@ -486,32 +838,189 @@ def refresh_indices(model, block_size=100):
         for progress, total in refresh_indices(MyModel, block_size=200):
             print "%s of %s"%(progress, total)
 
-    .. note: This uses the session object to handle index refresh via calls to
-      ``.commit()``. If you have any outstanding entities known in the
-      session, they will be committed.
+        # after adding index=True to MyModel.email
+        show_progress(refresh_indices(MyModel, columns=['email']))
+
+        # resumable, and limited to 5000 entities/second
+        show_progress(refresh_indices(MyModel, checkpoint=True, rate=5000))
+
+    .. note: With Lua enabled, only index data is written, using a single
+      script call per block. Entity data, unique indexes, and other data
+      written by ``Model.save()`` are not touched. Stale index data is only
+      removed for models with ``track_indexes`` enabled (see ``Model``).
+
+    .. note: With Lua disabled, this uses the session object to handle index
+      refresh via calls to ``.commit()``. If you have any outstanding entities
+      known in the session, they will be committed.
     '''
     conn = _connect(model)
-    max_id = int(conn.get('%s:%s:'%(model.__name__, model._pkey)) or '0')
+    max_id = int(conn.get('%s:%s:'%(model._key_prefix(), model._pkey)) or '0')
     block_size = max(block_size, 10)
-    for i in range(1, max_id+1, block_size):
-        # fetches entities, keeping a record in the session
-        models = model.get(list(range(i, i+block_size)))
-        models # for pyflakes
-        # re-save un-modified data, resulting in index-only updates
-        session.commit(all=True)
+    if USE_LUA:
+        columns = _reindex_columns(model, columns)
+    elif columns:
+        raise ORMError("Lua must be enabled to reindex specific columns")
+
+    check = Checkpoint(conn, model, 'refresh_indices', columns) if checkpoint else None
+    start = int((check and check.load()) or 0)
+    throttle = _Throttle(rate)
+    for i in range(start+1, max_id+1, block_size):
+        ids = list(range(i, min(i+block_size, max_id+1)))
+        if USE_LUA:
+            _reindex_ids(model, ids, columns)
+        else:
+            # fetches entities, keeping a record in the session
+            models = model.get(ids)
+            models # for pyflakes
+            # re-save un-modified data, resulting in index-only updates
+            session.commit(all=True)
+        if check:
+            check.save(ids[-1])
+        throttle.wait(len(ids))
         yield min(i+block_size, max_id), max_id
 
-def clean_old_index(model, block_size=100):
+    if check:
+        check.clear()
+
+def _reindex_columns(model, columns):
+    if not columns:
+        return None
+    if isinstance(columns, six.string_types):
+        columns = [columns]
+    for attr in columns:
+        col = model._columns.get(attr)
+        if col is None or not col._keygen:
+            raise ORMError("Cannot reindex %s.%s, it is not an indexed column"%(
+                model.__name__, attr))
+    return list(columns)
+
+def _reindex_ids(model, ids, columns=None):
+    '''
+    Rebuilds the index data for the entities with the provided ids in a
+    single round trip to fetch the entity data, and a single call to a Lua
+    script that only writes index data. If *columns* is provided, only those
+    columns are read and reindexed. Returns the number of entities that were
+    reindexed.
+    '''
+    conn = _connect(model)
+    namespace = model._key_prefix()
+    indexed = columns or [attr for attr, col in model._columns.items() if col._keygen]
+    pipe = conn.pipeline(False)
+    for id in ids:
+        if columns:
+            pipe.hmget('%s:%s'%(namespace, id), columns)
+        else:
+            pipe.hgetall('%s:%s'%(namespace, id))
+
+    keys = [namespace + '::']
+    args = [namespace, json.dumps(columns or []), '1' if model._track_indexes else '0']
+    for id, data in zip(ids, pipe.execute()):
+        if columns:
+            # we can't tell a missing entity from missing columns, the
+            # script checks that the entity exists
+            data = dict((k, v) for k, v in zip(columns, data) if v is not None)
+        elif not data:
+            continue
+        if six.PY3:
+            data = dict((k if isinstance(k, str) else k.decode(), v.decode()) for k, v in data.items())
+        # the script verifies that these columns are unchanged before writing
+        check = []
+        for attr in indexed:
+            check.extend([attr, data.get(attr, '')])
+        ikeys, scores, prefix, suffix = model._index_entries(model._index_values(data))
+        _add_prefix_scores(chain(prefix, suffix))
+        keys.append('%s:%s'%(namespace, id))
+        ikeys = sorted(ikeys) if model._track_indexes else []
+        args.extend([id, json.dumps([check, ikeys, scores, prefix, suffix])])
+
+    if len(keys) == 1:
+        return 0
+    return _reindex_lua(conn, keys, args)
+
+def _reindex_range(block):
+    from .columns import MODELS
+    name, start, end, columns = block
+    _reindex_ids(MODELS[name], list(range(start, end)), columns)
+    return end - start
+
+def parallel_refresh_indices(model, workers=4, block_size=100, processes=False, columns=None):
+    '''
+    This utility function will refresh the indices of all entities of a
+    provided model like ``refresh_indices()``, but splits the work between
+    multiple workers. Each worker fetches a block of entities in one round
+    trip, then rewrites their index data with a single Lua script call that
+    does not touch entity data.
+
+    Arguments:
+
+        * *model* - the model whose entities you want to reindex
+        * *workers* - the number of worker threads or processes, defaulting
+          to 4
+        * *block_size* - the maximum number of entities each worker will
+          reindex at a time, defaulting to 100
+        * *processes* - pass ``True`` to use a ``multiprocessing`` pool
+          instead of threads
+        * *columns* - an optional list of column names to limit reindexing
+          to, see ``refresh_indices()``
+
+    This function will yield its aggregate progression through re-indexing
+    all of your entities, and can be passed to ``show_progress()``.
+
+    Work is split into blocks of ids from 1 to the highest id assigned, so
+    unlike ``Model.scan(partition=...)``, workers don't repeat any work.
+
+    Example use::
+
+        show_progress(parallel_refresh_indices(MyModel, workers=8))
+
+    .. note: When using *processes*, your models must be defined in the
+      worker processes, which is the case when using the default 'fork'
+      start method on Unix-like systems.
+    '''
+    if not USE_LUA:
+        raise ORMError("Lua must be enabled to reindex in parallel")
+
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+
+    conn = _connect(model)
+    max_id = int(conn.get('%s:%s:'%(model._key_prefix(), model._pkey)) or '0')
+    block_size = max(block_size, 10)
+    columns = _reindex_columns(model, columns)
+    blocks = ((model.__name__, i, min(i+block_size, max_id+1), columns)
+        for i in range(1, max_id+1, block_size))
+
+    pool = (Pool if processes else ThreadPool)(max(workers, 1))
+    try:
+        done = 0
+        for count in pool.imap_unordered(_reindex_range, blocks):
+            done += count
+            yield done, max_id
+    finally:
+        pool.terminate()
+        pool.join()
+
+def clean_old_index(model, block_size=100, checkpoint=False, rate=None):
     '''
     This utility function will clean out old index data that was accidentally
     left during item deletion in rom versions <= 0.27.0 . You should run this
     after you have upgraded all of your clients to version 0.28.0 or later.
 
+    Only entities with an index record in the ``<prefix>::`` hash can have
+    index data left over, so this walks that hash with ``HSCAN``, checks which
+    entities still exist in batches, and cleans the index data of the rest.
+    The cost of cleaning is proportional to the number of indexed entities,
+    not the highest id ever assigned.
+
     Arguments:
 
         * *model* - the model whose entities you want to reindex
         * *block_size* - the maximum number of items to check at a time
           defaulting to 100
+        * *checkpoint* - pass ``True`` to record progress in Redis after each
+          block, and to resume from a previously recorded checkpoint (see
+          ``Checkpoint`` for details)
+        * *rate* - an optional maximum number of items to check per second
 
     This function will yield its progression through re-checking all of the
     data that could be left over.
@@ -526,25 +1035,316 @@ def clean_old_index(model, block_size=100):
         raise Exception("Lua must be enabled to clean out old indexes")
 
     conn = _connect(model)
-    pipe = conn.pipeline(True)
-    prefix = '%s:'%model.__name__
-    index = prefix + ':'
-    max_id = int(conn.get('%s%s:'%(prefix, model._pkey)) or '0')
+    pipe = conn.pipeline(False)
+    namespace = model._key_prefix()
+    index = namespace + '::'
+    total = conn.hlen(index)
     block_size = max(block_size, 10)
 
-    for i in range(1, max_id+1, block_size):
-        ids = list(range(i, min(i+block_size, max_id+1)))
+    check = Checkpoint(conn, model, 'clean_old_index') if checkpoint else None
+    position = check and check.load()
+    # the position is the HSCAN cursor and the count of checked records
+    cursor, done = map(int, position.split(':')) if position else (0, 0)
+    throttle = _Throttle(rate)
+    while True:
+        cursor, records = conn.hscan(index, cursor, count=block_size)
+        cursor = int(cursor)
+        ids = [id if isinstance(id, str) else id.decode() for id in records]
         for id in ids:
-            pipe.exists(prefix + str(id))
-            pipe.hexists(index, id)
-        result = iter(pipe.execute())
-        remove = [id for id, ent, ind in zip(ids, result, result) if ind and not ent]
-        if remove:
-            _clean_index_lua(conn, [model.__name__], remove)
+            pipe.exists('%s:%s'%(namespace, id))
+        remove = [id for id, ent in zip(ids, pipe.execute()) if not ent]
+        for i in range(0, len(remove), block_size):
+            _clean_index_lua(conn, [namespace], remove[i:i+block_size])
+
+        done += len(ids)
+        throttle.wait(len(ids))
+        if not cursor:
+            break
+        if check:
+            check.save('%s:%s'%(cursor, done))
+        yield min(done, total), total
+
+    if check:
+        check.clear()
+    yield total, total
+
+def migrate_index_records(model, block_size=100, checkpoint=False, rate=None):
+    '''
+    This utility function will convert the index records of a model that are
+    still stored in the older and larger JSON formats into the compact
+    MessagePack format written by current versions of ``rom``. Old records are
+    read transparently, and are converted whenever an entity is saved or
+    reindexed, so this only needs to be run to reclaim memory for entities
+    that are rarely updated.
+
+    Arguments:
+
+        * *model* - the model whose index records you want to convert
+        * *block_size* - the maximum number of records to check at a time
+          defaulting to 100
+        * *checkpoint* - pass ``True`` to record progress in Redis after each
+          block, and to resume from a previously recorded checkpoint (see
+          ``Checkpoint`` for details)
+        * *rate* - an optional maximum number of records to check per second
+
+    This function will yield its progression through all of the records.
+
+    Example use::
+
+        for progress, total in migrate_index_records(MyModel):
+            print "%s of %s"%(progress, total)
+    '''
+
+    if not USE_LUA:
+        raise Exception("Lua must be enabled to migrate index records")
+
+    conn = _connect(model)
+    index = model._key_prefix() + '::'
+    total = conn.hlen(index)
+    block_size = max(block_size, 10)
+
+    check = Checkpoint(conn, model, 'migrate_index_records') if checkpoint else None
+    position = check and check.load()
+    cursor, done = map(int, position.split(':')) if position else (0, 0)
+    throttle = _Throttle(rate)
+    while True:
+        cursor, records = conn.hscan(index, cursor, count=block_size)
+        cursor = int(cursor)
+        ids = [id if isinstance(id, str) else id.decode()
+            for id, data in records.items() if data[:1] in (b'[', b'{')]
+        if ids:
+            _migrate_index_lua(conn, [index], ids)
+
+        done += len(records)
+        throttle.wait(len(records))
+        if not cursor:
+            break
+        if check:
+            check.save('%s:%s'%(cursor, done))
+        yield min(done, total), total
+
+    if check:
+        check.clear()
+    yield total, total
+
+_DETECTORS = threading.local()
+_PACKAGE = __name__.rpartition('.')[0]
+
+def _call_site():
+    # the file and line outside of rom that led to the current call
+    frame = sys._getframe(1)
+    while frame:
+        name = frame.f_globals.get('__name__', '')
+        if name != _PACKAGE and not name.startswith(_PACKAGE + '.'):
+            return frame.f_code.co_filename, frame.f_lineno
+        frame = frame.f_back
+    return None, None
+
+def _record_fetch(model):
+    # called by Model.get() whenever a single entity is loaded from Redis
+    detectors = getattr(_DETECTORS, 'active', None)
+    if detectors:
+        site = _call_site()
+        for detector in detectors:
+            detector._record(model, site)
+
+_PROFILERS = []
+_timer = getattr(time, 'perf_counter', time.time)
+
+def _record_profile(model, column, operation, start):
+    elapsed = _timer() - start
+    for profiler in _PROFILERS:
+        profiler._add((model, column, operation), elapsed)
+
+def _profiled(model, column, operation, function, value):
+    # only called while a profiler is active, see profile_columns
+    start = _timer()
+    try:
+        return function(value)
+    finally:
+        _record_profile(model, column, operation, start)
+
+class profile_columns(object):
+    '''
+    Accumulates the client-side time spent converting column data to and
+    from Redis, for all threads, while active. Use it as a context manager,
+    or call ``start()`` and ``stop()`` to turn profiling on and off. Timings
+    are kept for each model (by key prefix), column, and operation:
+
+        * *encode* - ``Column.to_redis()``, called when saving
+        * *decode* - turning data from Redis into Python values when entities
+          are loaded, or when reading them for index updates
+        * *init* - all of ``Model.__init__()`` (column is ``None``), which
+          includes decoding every column
+        * *copy* - the copy of entity data made to track modifications
+          (column is ``None``)
+
+    .. note: Decoding a ``ManyToOne`` column fetches the referenced entity if
+      it isn't in the session, so its time can include a round trip to Redis.
+
+    Example::
+
+        with rom.util.profile_columns() as profiler:
+            users = User.get(ids)
+        for row in profiler.report(limit=5):
+            print(row['model'], row['column'], row['operation'], row['seconds'])
+    '''
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self not in _PROFILERS:
+            _PROFILERS.append(self)
+        return self
+
+    def stop(self):
+        if self in _PROFILERS:
+            _PROFILERS.remove(self)
+        return self
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+    __enter__ = start
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _add(self, key, elapsed):
+        with self._lock:
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = [0, 0.0]
+            stat[0] += 1
+            stat[1] += elapsed
+
+    def report(self, limit=None):
+        '''
+        Returns a list of dictionaries with the ``model``, ``column``,
+        ``operation``, number of ``calls``, total ``seconds``, and ``mean``
+        seconds per call, with the most expensive first.
+        '''
+        with self._lock:
+            rows = [{'model': model, 'column': column, 'operation': operation,
+                     'calls': calls, 'seconds': seconds, 'mean': seconds / calls}
+                for (model, column, operation), (calls, seconds) in self.stats.items()]
+        rows.sort(key=lambda row: -row['seconds'])
+        return rows[:limit] if limit else rows
+
+    def table(self, limit=None):
+        '''
+        Returns the report as a human-readable table.
+        '''
+        lines = ["%-20s %-20s %-9s %9s %11s %11s"%(
+            'model', 'column', 'operation', 'calls', 'total ms', 'mean us')]
+        for row in self.report(limit):
+            lines.append("%-20s %-20s %-9s %9i %11.3f %11.3f"%(
+                row['model'], row['column'] or '', row['operation'], row['calls'],
+                row['seconds'] * 1000, row['mean'] * 1000000))
+        return '\n'.join(lines)
+
+class detect_n_plus_one(object):
+    '''
+    Context manager for development and tests that watches for code loading
+    entities one at a time in a loop, like calling ``Model.get(id)`` for each
+    id in a list, or loading entities whose ``ManyToOne`` columns each fetch
+    the entity they reference. Fetches are
+    counted for each model and each line of code outside of ``rom`` that
+    caused them, and when more than *threshold* single entity fetches come
+    from the same place, an ``NPlusOneError`` is raised (or a
+    ``RuntimeWarning`` is issued when ``action='warn'``)::
+
+        with rom.util.detect_n_plus_one():
+            for id in post_ids:
+                print(Post.get(id).title)   # raises NPlusOneError
+
+    Entities already in the session don't count, and neither do fetches of
+    several entities at once with ``Model.get([...])``. After the block, the
+    counts are available as the ``counts`` dictionary, which maps
+    ``(model name, filename, line)`` to the number of single entity
+    fetches.
+    '''
+    def __init__(self, threshold=3, action='raise'):
+        if action not in ('raise', 'warn'):
+            raise ValueError("action must be 'raise' or 'warn', not %r"%(action,))
+        self.threshold = threshold
+        self.action = action
+        self.counts = {}
+
+    def __enter__(self):
+        if not hasattr(_DETECTORS, 'active'):
+            _DETECTORS.active = []
+        _DETECTORS.active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _DETECTORS.active.remove(self)
+
+    def _record(self, model, site):
+        key = (model.__name__,) + site
+        count = self.counts[key] = self.counts.get(key, 0) + 1
+        if count != self.threshold + 1:
+            return
+        message = "%s entities were fetched one at a time %i times from %s:%s, fetch them together with %s.get([...]) instead"%(
+            model.__name__, count, site[0], site[1], model.__name__)
+        if self.action == 'raise':
+            raise NPlusOneError(message)
+        warnings.warn_explicit(message, RuntimeWarning, site[0] or '<unknown>', site[1] or 0)
+
+class Checkpoint(object):
+    '''
+    Stores the progress of a long-running maintenance job like
+    ``refresh_indices()`` or ``clean_old_index()`` in Redis, so that an
+    interrupted job can resume where it left off instead of starting over.
+
+    Progress is stored in a hash at ``<prefix>:<job>:checkpoint`` along with
+    the parameters of the job. A checkpoint is only resumed when the job
+    parameters match, and is deleted when the job completes. To force a job
+    to start over, call ``.clear()``::
+
+        Checkpoint(conn, MyModel, 'refresh_indices').clear()
+    '''
+    def __init__(self, conn, model, job, params=None):
+        self.conn = conn
+        self.key = '%s:%s:checkpoint'%(model._key_prefix(), job)
+        self.params = json.dumps(params)
+
+    def load(self):
+        '''
+        Returns the last recorded position for this job, or None if there is
+        no checkpoint for a job with the same parameters.
+        '''
+        params, position = self.conn.hmget(self.key, ['params', 'position'])
+        if isinstance(params, six.binary_type):
+            params = params.decode()
+        if params != self.params or position is None:
+            return None
+        return position.decode() if isinstance(position, six.binary_type) else position
+
+    def save(self, position):
+        self.conn.hmset(self.key, {'params': self.params, 'position': position})
 
-        yield min(i+block_size, max_id-1), max_id
+    def clear(self):
+        self.conn.delete(self.key)
+
+class _Throttle(object):
+    '''
+    Limits the rate at which a job processes items by sleeping as necessary.
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.done = 0
 
-    yield max_id, max_id
+    def wait(self, count):
+        if not self.rate:
+            return
+        self.done += count
+        delay = self.done / float(self.rate) - (time.time() - self.start)
+        if delay > 0:
+            time.sleep(delay)
 
 def show_progress(job):
     '''
@@ -606,37 +1406,433 @@ def _script_load(script):
 
     return call
 
-_clean_index_lua = _script_load('''
--- remove old index data
-local namespace = KEYS[1]
-local cleaned = 0
-for _, id in ipairs(ARGV) do
+# These Lua functions maintain the per-entity index records stored in the
+# <namespace>:: hash, and are shared by the writer, reindexing, and index
+# cleaning scripts so that they all agree on the format of those records.
+#
+# Records are MessagePack encoded maps of column name to an entry of
+# ``{flags, tokens, suffixes, subkeys}``. Keyword and prefix indexes on a
+# column share the column's tokens, suffixes are only stored when they aren't
+# the byte reversal of those tokens, and ``subkeys`` lists the ``k`` of any
+# ``column:k`` scored indexes. The older JSON list records are still read.
+#
+# Prefix and suffix entries passed to the scripts are ``[attr, key, score]``,
+# or ``[attr, key, 'ngram']`` for edge n-gram indexes.
+NGRAM_MAX = 30
+_LUA_INDEX_FUNCTIONS = '''
+local KEYWORD, PREFIX, SUFFIX, SCORED, PREFIX_NGRAM, SUFFIX_NGRAM, TRIGRAM = 1, 2, 4, 8, 16, 32, 64
+local NGRAM_MAX = %d
+'''%NGRAM_MAX + '''
+
+local function has_flag(flags, flag)
+    return math.floor(flags / flag) % 2 == 1
+end
+
+-- split an index key of the form column:key
+local function split_key(key)
+    return string.match(key, '^([^:]*):?(.*)$')
+end
+
+-- build an index record from the arguments passed to index()
+local function build_record(keys, scored, prefix, suffix)
+    local record = {}
+    local seen = {}
+    local function entry_for(attr, flag, token)
+        local entry = record[attr]
+        if not entry then
+            entry = {0, {}, {}, {}}
+            record[attr] = entry
+            seen[attr] = {}
+        end
+        if flag > 0 and not has_flag(entry[1], flag) then
+            entry[1] = entry[1] + flag
+        end
+        if token and not seen[attr][token] then
+            seen[attr][token] = true
+            table.insert(entry[2], token)
+        end
+        return entry
+    end
+
+    for i, key in ipairs(keys) do
+        local attr, token = split_key(key)
+        entry_for(attr, KEYWORD, token)
+    end
+    for i, data in ipairs(prefix) do
+        entry_for(data[1], data[3] == 'ngram' and PREFIX_NGRAM or PREFIX, data[2])
+        if data[4] == 'trigram' then
+            entry_for(data[1], TRIGRAM)
+        end
+    end
+    for i, data in ipairs(suffix) do
+        local flag = data[3] == 'ngram' and SUFFIX_NGRAM or SUFFIX
+        table.insert(entry_for(data[1], flag)[3], data[2])
+    end
+    for key in pairs(scored) do
+        local attr, sub = split_key(key)
+        if sub == '' then
+            entry_for(attr, SCORED)
+        else
+            table.insert(entry_for(attr, 0)[4], sub)
+        end
+    end
+
+    -- drop suffixes that can be recreated by reversing the tokens
+    for attr, entry in pairs(record) do
+        if #entry[3] > 0 then
+            local suffixes = {}
+            local count = 0
+            for i, token in ipairs(entry[3]) do
+                if not suffixes[token] then
+                    suffixes[token] = true
+                    count = count + 1
+                end
+            end
+            local reversible = count == #entry[2]
+            for i, token in ipairs(entry[2]) do
+                if not reversible then
+                    break
+                end
+                reversible = suffixes[string.reverse(token)] and
+                    not string.find(token, '[\\128-\\255]')
+            end
+            if reversible then
+                entry[3] = {}
+            end
+        end
+        -- tokens come from sets, sort them so records can be compared
+        for i = 2, 4 do
+            table.sort(entry[i])
+        end
+    end
+    return record
+end
+
+-- whether two index records hold the same index data; map keys are packed in
+-- table order, so packed records can differ even when their data doesn't
+local function same_record(a, b)
+    for attr, entry in pairs(a) do
+        local other = b[attr]
+        if not other or entry[1] ~= other[1] then
+            return false
+        end
+        for i = 2, 4 do
+            if #entry[i] ~= #other[i] then
+                return false
+            end
+            for j, value in ipairs(entry[i]) do
+                if value ~= other[i][j] then
+                    return false
+                end
+            end
+        end
+    end
+    for attr in pairs(b) do
+        if not a[attr] then
+            return false
+        end
+    end
+    return true
+end
+
+-- decode a stored index record, converting older JSON records as necessary
+local function decode_record(data)
+    local first = string.sub(data, 1, 1)
+    if first == '{' then
+        return cjson.decode(data)
+    elseif first ~= '[' then
+        return cmsgpack.unpack(data)
+    end
+    data = cjson.decode(data)
+    local scored = {}
+    for i, key in ipairs(data[2]) do
+        scored[key] = true
+    end
+    return build_record(data[1], scored, data[3] or {}, data[4] or {})
+end
+
+-- the edge n-grams of a token, ending on utf-8 character boundaries
+local function edge_ngrams(token)
+    local grams = {}
+    for n = 1, math.min(#token, NGRAM_MAX) do
+        local following = string.byte(token, n + 1)
+        if not following or following < 128 or following >= 192 then
+            grams[#grams + 1] = string.sub(token, 1, n)
+        end
+    end
+    return grams
+end
+
+-- the distinct 3 character substrings of a token
+local function trigrams(token)
+    local starts = {}
+    for i = 1, #token do
+        local b = string.byte(token, i)
+        if b < 128 or b >= 192 then
+            starts[#starts + 1] = i
+        end
+    end
+    starts[#starts + 1] = #token + 1
+    local grams = {}
+    local seen = {}
+    for i = 1, #starts - 3 do
+        local gram = string.sub(token, starts[i], starts[i + 3] - 1)
+        if not seen[gram] then
+            seen[gram] = true
+            grams[#grams + 1] = gram
+        end
+    end
+    return grams
+end
+
+local function trigram_key(namespace, attr, gram)
+    return string.format('%s:%s:%s:tri', namespace, attr, gram)
+end
+
+-- call fn(is_zset, key, member) for each prefix or suffix index entry
+local function each_affix(namespace, id, attr, kind, tokens, zset, ngram, fn)
+    local key = string.format('%s:%s:%s', namespace, attr, kind)
+    for i, token in ipairs(tokens) do
+        if zset then
+            fn(true, key, string.format('%s\\0%s', token, id))
+        end
+        if ngram then
+            for j, gram in ipairs(edge_ngrams(token)) do
+                fn(false, string.format('%s:%s:%s:%s', namespace, attr, gram, kind), id)
+            end
+        end
+    end
+end
+
+-- call fn(is_zset, key, member) for each index entry of a record entry
+local function each_member(namespace, id, attr, entry, fn)
+    local flags = entry[1]
+    if has_flag(flags, KEYWORD) then
+        for i, token in ipairs(entry[2]) do
+            fn(false, string.format('%s:%s:%s:idx', namespace, attr, token), id)
+        end
+    end
+    each_affix(namespace, id, attr, 'pre', entry[2],
+        has_flag(flags, PREFIX), has_flag(flags, PREFIX_NGRAM), fn)
+    if has_flag(flags, TRIGRAM) then
+        for i, token in ipairs(entry[2]) do
+            for j, gram in ipairs(trigrams(token)) do
+                fn(false, trigram_key(namespace, attr, gram), id)
+            end
+        end
+    end
+
+    local suffixes = entry[3]
+    local suffix, suffix_ngram = has_flag(flags, SUFFIX), has_flag(flags, SUFFIX_NGRAM)
+    if #suffixes == 0 and (suffix or suffix_ngram) then
+        suffixes = {}
+        for i, token in ipairs(entry[2]) do
+            suffixes[i] = string.reverse(token)
+        end
+    end
+    each_affix(namespace, id, attr, 'suf', suffixes, suffix, suffix_ngram, fn)
+
+    if has_flag(flags, SCORED) then
+        fn(true, string.format('%s:%s:idx', namespace, attr), id)
+    end
+    for i, sub in ipairs(entry[4]) do
+        fn(true, string.format('%s:%s:%s:idx', namespace, attr, sub), id)
+    end
+end
+
+local function remove_member(is_zset, key, member)
+    redis.call(is_zset and 'ZREM' or 'SREM', key, member)
+end
+
+-- Remove the index data referenced by an entity's index record.
+local function unindex(namespace, id)
     local idata = redis.call('HGET', namespace .. '::', id)
-    if idata then
-        cleaned = cleaned + 1
-        idata = cjson.decode(idata)
-        if #idata == 2 then
-            idata[3] = {}
-            idata[4] = {}
+    if not idata then
+        return false
+    end
+    for attr, entry in pairs(decode_record(idata)) do
+        each_member(namespace, id, attr, entry, remove_member)
+    end
+    return true
+end
+
+-- Update the index data for an entity to match the provided index data. If a
+-- table of columns is provided, the index data for other columns is left
+-- alone. When reindexing, every index entry is written again, in case the
+-- index data was lost or damaged, and the record only decides what to remove.
+--
+-- When tracking, keyword indexes are also written, and the entity's index
+-- record is kept up to date, so that only the members that have actually
+-- changed since it was written are added and removed. Otherwise, a record
+-- written while tracking was enabled is only used to remove stale index data
+-- for the columns being updated, which are then dropped from the record.
+local function update_index(namespace, id, keys, scored, prefix, suffix, columns, track, reindex)
+    local record = track and build_record(keys, scored, prefix, suffix) or {}
+    local old = {}
+    local idata = redis.call('HGET', namespace .. '::', id)
+    local stored = idata and decode_record(idata)
+    if stored then
+        for attr, entry in pairs(stored) do
+            if columns and not columns[attr] then
+                record[attr] = record[attr] or entry
+            else
+                each_member(namespace, id, attr, entry, function(is_zset, key, member)
+                    old[key] = old[key] or {}
+                    old[key][member] = is_zset
+                end)
+            end
+        end
+    end
+    if not track then
+        keys = {}
+    end
+
+    -- returns whether the member was already indexed, and marks it as kept
+    local function indexed(key, member)
+        local members = old[key]
+        if members and members[member] ~= nil then
+            members[member] = nil
+            return true
+        end
+        return false
+    end
+
+    local changed = 0
+    for i, key in ipairs(keys) do
+        key = string.format('%s:%s:idx', namespace, key)
+        if not indexed(key, id) or reindex then
+            redis.call('SADD', key, id)
+            changed = changed + 1
+        end
+    end
+
+    for key, score in pairs(scored) do
+        key = string.format('%s:%s:idx', namespace, key)
+        indexed(key, id)
+        if tonumber(redis.call('ZSCORE', key, id)) ~= tonumber(score) then
+            redis.call('ZADD', key, score, id)
+            changed = changed + 1
         end
-        for i, key in ipairs(idata[1]) do
-            redis.call('SREM', string.format('%s:%s:idx', namespace, key), id)
+    end
+
+    for i, affix in ipairs({{'pre', prefix}, {'suf', suffix}}) do
+        local kind = affix[1]
+        for j, data in ipairs(affix[2]) do
+            if data[3] == 'ngram' then
+                for k, gram in ipairs(edge_ngrams(data[2])) do
+                    local key = string.format('%s:%s:%s:%s', namespace, data[1], gram, kind)
+                    if not indexed(key, id) or reindex then
+                        redis.call('SADD', key, id)
+                        changed = changed + 1
+                    end
+                end
+            else
+                local key = string.format('%s:%s:%s', namespace, data[1], kind)
+                local member = string.format('%s\\0%s', data[2], id)
+                if not indexed(key, member) or reindex then
+                    redis.call('ZADD', key, data[3], member)
+                    changed = changed + 1
+                end
+            end
+            if data[4] == 'trigram' then
+                for k, gram in ipairs(trigrams(data[2])) do
+                    local key = trigram_key(namespace, data[1], gram)
+                    if not indexed(key, id) or reindex then
+                        redis.call('SADD', key, id)
+                        changed = changed + 1
+                    end
+                end
+            end
         end
-        for i, key in ipairs(idata[2]) do
-            redis.call('ZREM', string.format('%s:%s:idx', namespace, key), id)
+    end
+
+    -- anything left over is no longer indexed
+    for key, members in pairs(old) do
+        for member, is_zset in pairs(members) do
+            remove_member(is_zset, key, member)
+            changed = changed + 1
         end
-        for i, data in ipairs(idata[3]) do
-            local key = string.format('%s:%s:pre', namespace, data[1])
-            local mem = string.format('%s\0%s', data[2], id)
-            redis.call('ZREM', key, mem)
+    end
+
+    if next(record) == nil then
+        if idata then
+            redis.call('HDEL', namespace .. '::', id)
         end
-        for i, data in ipairs(idata[4]) do
-            local key = string.format('%s:%s:suf', namespace, data[1])
-            local mem = string.format('%s\0%s', data[2], id)
-            redis.call('ZREM', key, mem)
+    else
+        -- older JSON records are rewritten in the compact format
+        local first = string.sub(idata or '', 1, 1)
+        if first == '[' or first == '{' or not stored or not same_record(record, stored) then
+            redis.call('HSET', namespace .. '::', id, cmsgpack.pack(record))
         end
+    end
+    return changed
+end
+'''
+
+_clean_index_lua = _script_load(_LUA_INDEX_FUNCTIONS + '''
+-- remove old index data
+local namespace = KEYS[1]
+local cleaned = 0
+for _, id in ipairs(ARGV) do
+    if unindex(namespace, id) then
+        cleaned = cleaned + 1
         redis.call('HDEL', namespace .. '::', id)
     end
 end
 return cleaned
 ''')
+
+_reindex_lua = _script_load(_LUA_INDEX_FUNCTIONS + '''
+-- rewrite the index data for a block of entities without touching the
+-- entity data itself, optionally limited to a set of columns
+local namespace = ARGV[1]
+local columns = nil
+for i, col in ipairs(cjson.decode(ARGV[2])) do
+    columns = columns or {}
+    columns[col] = true
+end
+local track = ARGV[3] == '1'
+
+-- KEYS[1] is the index record hash, followed by one entity key per entity
+local reindexed = 0
+for i = 2, #KEYS do
+    local ent = KEYS[i]
+    local id = ARGV[2*i]
+    local idata = cjson.decode(ARGV[2*i+1])
+    -- only reindex if the indexed columns haven't changed since they were
+    -- read, otherwise the writer has already indexed more recent data
+    local current = true
+    if #idata[1] > 0 then
+        local fields = {}
+        for j = 1, #idata[1], 2 do
+            fields[#fields + 1] = idata[1][j]
+        end
+        for j, value in ipairs(redis.call('HMGET', ent, unpack(fields))) do
+            if (value or '') ~= idata[1][2*j] then
+                current = false
+                break
+            end
+        end
+    end
+    if current and redis.call('EXISTS', ent) == 1 then
+        update_index(namespace, id, idata[2], idata[3], idata[4], idata[5], columns, track, true)
+        reindexed = reindexed + 1
+    end
+end
+return reindexed
+''')
+
+_migrate_index_lua = _script_load(_LUA_INDEX_FUNCTIONS + '''
+-- rewrite JSON index records in the compact format
+local records = KEYS[1]
+local migrated = 0
+for i, id in ipairs(ARGV) do
+    local data = redis.call('HGET', records, id)
+    local first = data and string.sub(data, 1, 1)
+    if first == '[' or first == '{' then
+        redis.call('HSET', records, id, cmsgpack.pack(decode_record(data)))
+        migrated = migrated + 1
+    end
+end
+return migrated
+''')
@@ -1,8 +1,10 @@
 from __future__ import print_function
 from datetime import datetime, timedelta
 from decimal import Decimal as _Decimal
+import json
 import time
 import unittest
+import warnings
 
 import redis
 import six
@@ -28,6 +30,19 @@ def global_setup():
         if v is not Model:
             del MODELS[k]
 
+def clean_keys(*models):
+    c = connect(None)
+    for model in models:
+        keys = c.keys(model._key_prefix() + '*')
+        if keys:
+            c.delete(*keys)
+
+def index_writes():
+    # the number of commands that have written index data so far
+    stats = connect(None).info('commandstats')
+    return sum(stats.get('cmdstat_' + cmd, {}).get('calls', 0)
+        for cmd in ('sadd', 'srem', 'zadd', 'zrem', 'hset', 'hdel'))
+
 def get_state():
     c = connect(None)
     data = []
@@ -232,6 +247,117 @@ class TestORM(unittest.TestCase):
         self.assertEqual(conn.zcard(key), 1)
         conn.delete(key)
 
+    def test_explain(self):
+        class RomTestExplain(Model):
+            track_indexes = True
+            tag = Text(index=True)
+            num = Integer(index=True)
+
+        clean_keys(RomTestExplain)
+        for i in range(30):
+            RomTestExplain(tag='t%i'%(i % 3), num=i)
+        session.commit()
+
+        query = RomTestExplain.query.filter(tag=['t1', 't2'], num=(10, 14)).order_by('-num')
+        plan = query.explain()
+        self.assertEqual([step['operation'] for step in plan], ['union', 'intersect', 'order'])
+        self.assertEqual([step['estimate'] for step in plan], [5, 20, None])
+        self.assertEqual([x.num for x in query.all()], [14, 13, 11, 10])
+
+        steps = query.limit(1, 2).profile()
+        self.assertEqual([step['operation'] for step in steps], ['plan', 'union', 'intersect', 'order', 'fetch'])
+        self.assertEqual([step['size'] for step in steps], [None, 5, 4, 4, 2])
+        self.assertTrue(all(step['server_time'] >= 0 and step['client_time'] >= 0 for step in steps))
+        self.assertEqual(connect(None).keys('romtestexplain:*-*'), [])
+
+        # temporary results are removed when a step fails
+        def fail(*args):
+            raise redis.exceptions.ResponseError('failed')
+        RomTestExplain._gindex._order = fail
+        try:
+            self.assertRaises(redis.exceptions.ResponseError, query.profile)
+        finally:
+            del RomTestExplain._gindex._order
+        self.assertEqual(connect(None).keys('romtestexplain:*-*'), [])
+
+        # a filter that can't match anything means no work is done
+        query = RomTestExplain.query.filter(tag='t1', num=(100, None))
+        self.assertEqual(query.explain()[0]['estimate'], 0)
+        self.assertEqual(query.count(), 0)
+        self.assertEqual(query.all(), [])
+
+    def test_hooks(self):
+        class RomTestHooks(Model):
+            col = Text(index=True)
+
+        events = []
+        util.add_hook(events.append)
+        try:
+            x = RomTestHooks(col='hello')
+            x.save()
+            session.rollback()
+            RomTestHooks.get(x.id)
+            RomTestHooks.query.filter(col='hello').count()
+        finally:
+            util.remove_hook(events.append)
+
+        self.assertTrue(events)
+        self.assertEqual(set(e['model'] for e in events), set(['RomTestHooks']))
+        self.assertTrue(all(e['commands'] >= 1 and e['bytes'] > 0 and e['latency'] >= 0 for e in events))
+        count = len(events)
+        RomTestHooks.get(x.id)
+        self.assertEqual(len(events), count)
+
+    def test_profile_columns(self):
+        class RomTestProfile(Model):
+            col = Integer()
+            data = Json()
+
+        with util.profile_columns() as profiler:
+            x = RomTestProfile(col=5, data={'a': [1, 2, 3]})
+            x.save()
+            session.rollback()
+            RomTestProfile.get(x.id)
+        RomTestProfile.get(x.id)
+
+        stats = dict(((row['column'], row['operation']), row['calls']) for row in profiler.report())
+        self.assertTrue(stats[('data', 'encode')] >= 1)
+        self.assertEqual(stats[('data', 'decode')], 1)
+        self.assertEqual(stats[('col', 'decode')], 1)
+        self.assertEqual(stats[(None, 'init')], 2)
+        self.assertTrue(stats[(None, 'copy')] >= 2)
+        report = profiler.report()
+        self.assertEqual(report, sorted(report, key=lambda row: -row['seconds']))
+        self.assertEqual(len(profiler.table(limit=2).splitlines()), 3)
+
+    def test_detect_n_plus_one(self):
+        class RomTestNPlusOne(Model):
+            col = Text()
+
+        ids = [RomTestNPlusOne(col=str(i)).id for i in range(5)]
+        session.commit()
+        session.rollback()
+
+        with util.detect_n_plus_one(threshold=3) as detector:
+            self.assertRaises(NPlusOneError, lambda: [RomTestNPlusOne.get(id) for id in ids])
+        self.assertEqual(list(detector.counts.values()), [4])
+
+        session.rollback()
+        with util.detect_n_plus_one(threshold=3) as detector:
+            RomTestNPlusOne.get(ids)
+            [RomTestNPlusOne.get(id) for id in ids]
+        self.assertEqual(detector.counts, {})
+
+        session.rollback()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with util.detect_n_plus_one(threshold=3, action='warn') as detector:
+                for id in ids:
+                    RomTestNPlusOne.get(id)
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(issubclass(caught[0].category, RuntimeWarning))
+        self.assertEqual(list(detector.counts.values()), [5])
+
     def test_alternate_models(self):
         ctr = [0]
         class RomTestAlternate(object):
@@ -324,6 +450,198 @@ class TestORM(unittest.TestCase):
             x.save(full=True)
             session.rollback()
 
+    def test_json_codec(self):
+        class RomTestJsonCodec(Model):
+            fast = Json()
+            plain = Json(codec='json')
+            slow = Json(codec=None)
+            kwargs = Json(encoder_kwargs={'sort_keys': True})
+
+        from rom.columns import JsonCodec
+        self.assertTrue(isinstance(RomTestJsonCodec._columns['plain'].codec, JsonCodec))
+        # the default writes the same data as the column's regular encoder
+        fast = RomTestJsonCodec._columns['fast']
+        self.assertTrue(type(fast.codec) is JsonCodec)
+        self.assertEqual(fast._encode({'a': [1, 2.5]}), json.dumps({'a': [1, 2.5]}, **fast.encoder_kwargs))
+        self.assertEqual(RomTestJsonCodec._columns['slow'].codec, None)
+        self.assertEqual(RomTestJsonCodec._columns['kwargs'].codec, None)
+        self.assertRaises(ColumnError, lambda: Json(codec='unknown'))
+
+        when = datetime(2015, 1, 2, 3, 4, 5)
+        d = {'hello': 'world', 'n': [1, 2.5, None, True]}
+        x = RomTestJsonCodec(fast=d, plain=d, slow=d, kwargs=d)
+        x.save()
+        y = RomTestJsonCodec(fast={'when': when}, plain={'when': when})
+        y.save()
+        session.rollback()
+
+        x = RomTestJsonCodec.get(x.id)
+        for attr in ('fast', 'plain', 'slow', 'kwargs'):
+            self.assertEqual(getattr(x, attr), d)
+        y = RomTestJsonCodec.get(y.id)
+        self.assertEqual(y.fast, {'when': '2015-01-02T03:04:05'})
+        self.assertEqual(y.plain, y.fast)
+
+        # no codec may turn non-finite floats into null
+        z = RomTestJsonCodec(fast={'n': [float('inf'), float('nan')]})
+        z.save()
+        session.rollback()
+        inf, nan = RomTestJsonCodec.get(z.id).fast['n']
+        self.assertEqual(inf, float('inf'))
+        self.assertTrue(nan != nan)
+
+    def test_json_compress(self):
+        class RomTestJsonCompress(Model):
+            small = Json(compress='zlib')
+            large = Json(compress='zlib', compress_threshold=100)
+            other = Integer()
+
+        self.assertRaises(ColumnError, lambda: Json(compress='unknown'))
+        small = {'a': 1}
+        large = [{'lat': 37.77, 'lng': -122.41, 't': i} for i in range(100)]
+        x = RomTestJsonCompress(small=small, large=large, other=1)
+        x.save()
+        session.rollback()
+
+        conn = connect(RomTestJsonCompress)
+        self.assertEqual(json.loads(conn.hget(x._pk, 'small').decode()), small)
+        raw = conn.hget(x._pk, 'large').decode()
+        self.assertTrue(raw.startswith('~zlib:'))
+        self.assertTrue(len(raw) < len(json.dumps(large)) / 4)
+
+        # saving without accessing the column doesn't decompress or rewrite it
+        y = RomTestJsonCompress.get(x.id)
+        y.other = 2
+        y.save()
+        self.assertEqual(conn.hget(x._pk, 'large').decode(), raw)
+        self.assertEqual(y.large, large)
+        self.assertEqual(y.to_dict()['large'], large)
+
+        y.large = large[:50]
+        y.save()
+        session.rollback()
+        self.assertEqual(RomTestJsonCompress.get(x.id).large, large[:50])
+
+        # compressed data is readable without compression enabled
+        class RomTestJsonCompressRead(Model):
+            data = Json()
+        z = RomTestJsonCompressRead(data={})
+        z.save()
+        conn.hset(z._pk, 'data', raw)
+        session.rollback()
+        self.assertEqual(RomTestJsonCompressRead.get(z.id).data, large)
+
+    def test_json_external(self):
+        class RomTestJsonExternal(Model):
+            route = Json(external=True)
+            other = Integer()
+
+        self.assertRaises(ColumnError, lambda: Json(external=True, index=True, keygen=lambda v: []))
+        route = [{'lat': 37.77, 'lng': -122.41, 't': i} for i in range(10)]
+        x = RomTestJsonExternal(route=route, other=1)
+        x.save()
+        session.rollback()
+
+        conn = connect(RomTestJsonExternal)
+        self.assertEqual(conn.hget(x._pk, 'route').decode(), '~external')
+        self.assertEqual(json.loads(conn.get(x._pk + ':ext:route').decode()), route)
+
+        # the value is only fetched when accessed
+        y = RomTestJsonExternal.get(x.id)
+        y.other = 2
+        y.save()
+        self.assertEqual(y.route, route)
+        y.route = route[:2]
+        y.save()
+        session.rollback()
+        self.assertEqual(RomTestJsonExternal.get(x.id).route, route[:2])
+
+        session.rollback()
+        ys = RomTestJsonExternal.prefetch(RomTestJsonExternal.get([x.id]), 'route')
+        conn.delete(x._pk + ':ext:route')
+        self.assertEqual(ys[0].route, route[:2])
+
+        ys[0].delete()
+        self.assertEqual(conn.keys(x._pk + '*'), [])
+
+    def test_point_compact(self):
+        from django.contrib.gis.geos import Point as GeoPoint
+        from rom.columns import Point, LazyGeoPoint
+        class RomTestPoint(Model):
+            old = Point()
+            compact = Point(compact=True, lazy=True)
+            rounded = Point(compact=True, precision=2)
+
+        self.assertRaises(ColumnError, lambda: Point(precision=2))
+        p = GeoPoint(x=-122.4194155, y=37.7749295)
+        x = RomTestPoint(old=p, compact=p, rounded=p)
+        x.save()
+        session.rollback()
+
+        conn = connect(RomTestPoint)
+        self.assertEqual(json.loads(conn.hget(x._pk, 'old').decode()), {'x': p.x, 'y': p.y})
+        self.assertEqual(conn.hget(x._pk, 'compact').decode(), '-122.4194155,37.7749295')
+        self.assertEqual(conn.hget(x._pk, 'rounded').decode(), '-122.42,37.77')
+
+        y = RomTestPoint.get(x.id)
+        self.assertTrue(isinstance(y.old, GeoPoint))
+        self.assertTrue(isinstance(y.compact, LazyGeoPoint))
+        self.assertEqual((y.compact.x, y.compact.y), (p.x, p.y))
+        self.assertEqual(y.compact, p)
+        self.assertEqual(y.compact.coords, p.coords)
+        self.assertEqual((y.rounded.x, y.rounded.y), (-122.42, 37.77))
+
+        # an equal GEOS point over a lazy one isn't a change
+        y.compact = GeoPoint(x=p.x, y=p.y)
+        self.assertEqual(y.save(), 0)
+        y.compact = GeoPoint(x=p.y, y=p.x)
+        self.assertEqual(y.save(), 1)
+
+        # existing JSON data is still readable
+        conn.hset(x._pk, 'compact', json.dumps({'x': 1.5, 'y': 2.5}))
+        session.rollback()
+        y = RomTestPoint.get(x.id)
+        self.assertEqual((y.compact.x, y.compact.y), (1.5, 2.5))
+        y.save(full=True)
+        self.assertEqual(conn.hget(x._pk, 'compact').decode(), '1.5,2.5')
+
+    def test_point_index(self):
+        from django.contrib.gis.geos import Point as GeoPoint
+        from rom.columns import Point
+        class RomTestGeo(Model):
+            track_indexes = True
+            location = Point(index=True, compact=True)
+            available = Boolean(index=True)
+
+        clean_keys(RomTestGeo)
+        self.assertRaises(ColumnError, lambda: Point(prefix=True))
+        origin = (-122.4194, 37.7749)
+        far = RomTestGeo(location=GeoPoint(x=-122.5, y=37.9), available=True)
+        near = RomTestGeo(location=GeoPoint(x=-122.4184, y=37.7749), available=True)
+        nearer = RomTestGeo(location=GeoPoint(x=-122.4194, y=37.7750), available=False)
+        session.commit()
+
+        conn = connect(RomTestGeo)
+        self.assertEqual(conn.georadius('romtestgeo:location:idx', origin[0], origin[1], 1,
+            unit='km', sort='ASC'), [str(nearer.id).encode(), str(near.id).encode()])
+
+        query = RomTestGeo.query.near(location=origin, radius=1, unit='km')
+        self.assertEqual([x.id for x in query.all()], [nearer.id, near.id])
+        self.assertEqual(query.filter(available=True).all(), [near])
+        self.assertEqual(query.filter(available=True).count(), 1)
+        self.assertEqual(RomTestGeo.query.near(location=GeoPoint(x=origin[0], y=origin[1]),
+            radius=100).count(), 2)
+        self.assertRaises(QueryError, lambda: RomTestGeo.query.near(available=origin, radius=1))
+        self.assertRaises(QueryError, lambda: query.near(location=origin, radius=1, unit='yd'))
+
+        # moving or deleting entities updates the index
+        near.location = GeoPoint(x=-122.6, y=37.9)
+        near.save()
+        nearer.delete()
+        self.assertEqual(query.all(), [])
+        self.assertRaises(InvalidColumnValue, lambda: RomTestGeo(location=GeoPoint(x=0, y=89)).save())
+        session.rollback()
+
     def test_boolean(self):
         class RomTestBooleanTest(Model):
             col = Boolean(index=True)
@@ -439,6 +757,42 @@ class TestORM(unittest.TestCase):
         self.assertEqual(RomTestPSP.query.like(col='oin').count(), 0)
         self.assertEqual(RomTestPSP.query.like(col='+oin').like(col='wor!d').count(), 1)
 
+    def test_read_only_search(self):
+        import rom
+        if not rom.USE_LUA:
+            return
+
+        commands = []
+        class ReadConnection(redis.Redis):
+            def execute_command(self, *args, **kwargs):
+                commands.append(args[0])
+                return redis.Redis.execute_command(self, *args, **kwargs)
+
+        class RomTestReadOnly(Model):
+            _read_conn = ReadConnection(db=15)
+            col = Text(prefix=True, suffix=True)
+
+        clean_keys(RomTestReadOnly)
+        RomTestReadOnly(col='hello world').save()
+        RomTestReadOnly(col='help').save()
+        c = connect(None)
+        keys = set(c.keys('*'))
+        index = c.zrange('romtestreadonly:col:pre', 0, -1, withscores=True)
+
+        self.assertEqual(RomTestReadOnly.query.startswith(col='hel').count(), 2)
+        self.assertEqual(RomTestReadOnly.query.startswith(col='hel').limit(1, 1).count(), 2)
+        self.assertEqual(len(RomTestReadOnly.query.startswith(col='hel').limit(1, 5).all()), 1)
+        self.assertEqual(RomTestReadOnly.query.endswith(col='lp').all()[0].col, 'help')
+        self.assertEqual(RomTestReadOnly.query.like(col='wor*').count(), 1)
+        self.assertTrue(commands)
+        self.assertEqual(set(c.keys('*')), keys)
+        self.assertEqual(c.zrange('romtestreadonly:col:pre', 0, -1, withscores=True), index)
+
+        # searches that need temporary keys use the normal connection
+        del commands[:]
+        self.assertEqual(RomTestReadOnly.query.startswith(col='hel').endswith(col='ld').count(), 1)
+        self.assertEqual(commands, [])
+
     def test_unicode_text(self):
         import rom
         ch = unichr(0xfeff) if six.PY2 else chr(0xfeff)
@@ -683,6 +1037,25 @@ class TestORM(unittest.TestCase):
 
         self.assertEqual(RomTestPerson.query.like(name='*asao*').count(), 5)
 
+    def test_prefix_long(self):
+        if not util.USE_LUA:
+            return
+        class RomTestPrefixLong(Model):
+            col = Text(prefix=True)
+
+        clean_keys(RomTestPrefixLong)
+        # all of these share the 7 bytes that scores cover
+        for i in range(250):
+            RomTestPrefixLong(col='abcdefg%03d'%i)
+        session.commit()
+        self.assertEqual(RomTestPrefixLong.query.startswith(col='abcdefg').count(), 250)
+        self.assertEqual(RomTestPrefixLong.query.startswith(col='abcdefg1').count(), 100)
+        self.assertEqual(RomTestPrefixLong.query.startswith(col='abcdefg12').count(), 10)
+        self.assertEqual([x.col for x in RomTestPrefixLong.query.startswith(col='abcdefg249').all()],
+            ['abcdefg249'])
+        self.assertEqual(RomTestPrefixLong.query.startswith(col='abcdefg25').count(), 0)
+        self.assertEqual(RomTestPrefixLong.query.startswith(col='abcdefg/').count(), 0)
+
     def test_prefix_suffix2(self):
         from rom import columns
         if not columns.USE_LUA:
@@ -709,6 +1082,162 @@ class TestORM(unittest.TestCase):
         self.assertEqual(RomTestPerson2.query.startswith(idPerson='89375').filter(description="ayuntamientodeburgos").count(), 1)
         self.assertEqual(RomTestPerson2.query.like(idPerson='*94*').filter(description="ayuntamientodeburgos").count(), 2)
 
+    def test_prefix_suffix_ngram(self):
+        self.assertRaises(ColumnError, lambda: Text(prefix='bogus'))
+        if not util.USE_LUA:
+            return
+
+        class RomTestNgram(Model):
+            name = Text(index=True, prefix='ngram', suffix='ngram')
+
+        clean_keys(RomTestNgram)
+        names = ['Melody Prohaska', 'Mr. Willow Goldner', 'Maria Williamson',
+            'Beau Streich', 'Willa Mohr']
+        for name in names:
+            RomTestNgram(name=name)
+        session.commit()
+
+        self.assertEqual(RomTestNgram.query.startswith(name='will').count(), 3)
+        self.assertEqual(RomTestNgram.query.startswith(name='willo').count(), 1)
+        self.assertEqual(RomTestNgram.query.startswith(name='m').count(), 4)
+        self.assertEqual(RomTestNgram.query.startswith(name='m').filter(name='willa').count(), 1)
+        self.assertEqual(RomTestNgram.query.endswith(name='son').count(), 1)
+        self.assertEqual(RomTestNgram.query.endswith(name='ska').count(), 1)
+        self.assertRaises(QueryError, lambda: RomTestNgram.query.like(name='*ill*'))
+
+        x = RomTestNgram.query.filter(name='beau').first()
+        x.name = 'Beau Williams'
+        x.save()
+        self.assertEqual(RomTestNgram.query.startswith(name='will').count(), 4)
+        self.assertEqual(RomTestNgram.query.startswith(name='stre').count(), 0)
+        x.delete()
+        self.assertEqual(RomTestNgram.query.startswith(name='will').count(), 3)
+
+        # longer than the longest n-gram, so checked against the index records
+        long = 'x' * 30
+        RomTestNgram(name=long + 'yz')
+        RomTestNgram(name='yz' + long)
+        session.commit()
+        self.assertEqual(RomTestNgram.query.startswith(name=long).count(), 1)
+        self.assertEqual(RomTestNgram.query.startswith(name=long + 'y').count(), 1)
+        self.assertEqual(len(RomTestNgram.query.startswith(name=long + 'yq').all()), 0)
+        self.assertEqual(RomTestNgram.query.endswith(name=long).count(), 1)
+        self.assertEqual(RomTestNgram.query.endswith(name='z' + long).count(), 1)
+        self.assertEqual(len(RomTestNgram.query.endswith(name='q' + long).all()), 0)
+        # an empty prefix matches every word, the same as the scored index
+        self.assertEqual(RomTestNgram.query.startswith(name='').count(), 6)
+        self.assertEqual(len(RomTestNgram.query.endswith(name='').all()), 6)
+        self.assertEqual(RomTestNgram.query.startswith(name='').filter(name='willa').count(), 1)
+
+    def test_prefix_suffix_lex(self):
+        if not util.USE_LUA:
+            return
+        class RomTestLex(Model):
+            track_indexes = True
+            name = Text(prefix='lex', suffix='lex')
+
+        clean_keys(RomTestLex)
+        names = ['Willowbrook Amberson', 'Willowbrooke Ambersen', 'Maria Williamson',
+            'Beau Streich', 'Willa Mohr']
+        for name in names:
+            RomTestLex(name=name)
+        session.commit()
+
+        c = connect(None)
+        self.assertEqual(set(s for m, s in c.zrange('romtestlex:name:pre', 0, -1, withscores=True)), set([0]))
+        self.assertEqual(RomTestLex.query.startswith(name='will').count(), 4)
+        # longer than the 7 bytes that scored prefix indexes can compare
+        self.assertEqual(RomTestLex.query.startswith(name='willowbrooke').count(), 1)
+        self.assertEqual(RomTestLex.query.endswith(name='amberson').count(), 1)
+        self.assertEqual(RomTestLex.query.endswith(name='son').count(), 2)
+        self.assertEqual(RomTestLex.query.startswith(name='m').endswith(name='son').count(), 1)
+        self.assertEqual(RomTestLex.query.like(name='will*brook').count(), 2)
+        self.assertEqual(RomTestLex.query.like(name='*ber*').count(), 2)
+
+        x = RomTestLex.query.startswith(name='beau').first()
+        x.name = 'Beau Williams'
+        x.save()
+        self.assertEqual(RomTestLex.query.startswith(name='will').count(), 5)
+        self.assertEqual(RomTestLex.query.startswith(name='stre').count(), 0)
+        x.delete()
+        self.assertEqual(RomTestLex.query.startswith(name='will').count(), 4)
+
+    def test_trigram(self):
+        import rom
+        if not rom.USE_LUA:
+            return
+        self.assertRaises(ColumnError, lambda: Text(trigram=True))
+        self.assertRaises(ColumnError, lambda: Text(prefix='ngram', trigram=True))
+
+        class RomTestTrigram(Model):
+            email = Text(prefix=True, trigram=True, keygen=lambda v: [v.lower()])
+
+        clean_keys(RomTestTrigram)
+        for email in ['frank@example.com', 'lil.frankie@example.com',
+                'FRANKLIN@test.com', 'bob@frank.com', 'alice@example.com']:
+            RomTestTrigram(email=email)
+        session.commit()
+
+        c = connect(None)
+        self.assertEqual(len(c.smembers('romtesttrigram:email:fra:tri')), 4)
+        self.assertEqual(RomTestTrigram.query.like(email='*frank*@').count(), 3)
+        self.assertEqual(RomTestTrigram.query.like(email='*@example*').count(), 3)
+        self.assertEqual(RomTestTrigram.query.like(email='*frank*@').like(email='*test*').count(), 1)
+        # too short for trigrams, falls back to the prefix index
+        self.assertEqual(RomTestTrigram.query.like(email='*@t*').count(), 1)
+
+        x = RomTestTrigram.query.like(email='bob@*').first()
+        x.email = 'bob@example.com'
+        x.save()
+        self.assertEqual(RomTestTrigram.query.like(email='*frank*').count(), 3)
+        x.delete()
+        self.assertEqual(RomTestTrigram.query.like(email='*@example*').count(), 3)
+        self.assertEqual(c.smembers('romtesttrigram:email:bob:tri'), set())
+
+    def test_analyzer(self):
+        analyzer = util.Analyzer(stopwords=util.STOPWORDS, stemmer=lambda w: w.rstrip('s'))
+        self.assertRaises(ColumnError, lambda: Integer(index=True, analyzer=analyzer))
+        self.assertRaises(ColumnError, lambda: Text(index=True, analyzer=analyzer, keygen=util._string_keygen))
+        self.assertEqual(analyzer('the dogs chase cats'), ['cat', 'chase', 'dog'])
+        self.assertEqual(util.Analyzer()("Don't e-mail (me)!"), ["don't", 'e-mail', 'me'])
+        remove = util.Analyzer(remove_punctuation=True)
+        self.assertEqual(remove("Don't e-mail (me)!"), ['dont', 'email', 'me'])
+        self.assertEqual(remove(six.u("Don't e-mail (me)!")), ['dont', 'email', 'me'])
+
+        class RomTestAnalyzer(Model):
+            track_indexes = True
+            col = Text(index=True, analyzer=analyzer)
+
+        clean_keys(RomTestAnalyzer)
+        RomTestAnalyzer(col='The cats and the dogs.').save()
+        RomTestAnalyzer(col='A cat!').save()
+        c = connect(None)
+        self.assertFalse(c.exists('romtestanalyzer:col:the:idx'))
+        self.assertEqual(RomTestAnalyzer.query.filter(col='cat').count(), 2)
+        self.assertEqual(RomTestAnalyzer.query.filter(col='Cats').count(), 2)
+        self.assertEqual(RomTestAnalyzer.query.filter(col=['dog', 'mouse']).count(), 1)
+        self.assertEqual(RomTestAnalyzer.query.filter(col='the').count(), 0)
+
+    def test_prefix_score(self):
+        score = lambda *args: float(util._prefix_score(*args))
+        self.assertTrue(score('') < score('a'))
+        self.assertTrue(score('a') < score('ab') < score('b'))
+        self.assertTrue(score('ab') < score('ab', True) <= score('ac'))
+        self.assertEqual(score('abcdefgh'), score('abcdefgz'))
+        e_acute = six.unichr(0xe9)
+        self.assertEqual(score(e_acute), score(e_acute.encode('utf-8')))
+        # utf-8 encoded text sorts after ascii
+        self.assertTrue(score('z', True) <= score(e_acute))
+
+        old_size = util._PREFIX_SCORES_SIZE
+        util._PREFIX_SCORES_SIZE = 10
+        try:
+            for i in range(25):
+                util._prefix_score(str(i))
+            self.assertTrue(len(util._PREFIX_SCORES) <= 10)
+        finally:
+            util._PREFIX_SCORES_SIZE = old_size
+
     def test_null_session(self):
         class RomTestNullSession(Model):
             data = String() if six.PY2 else Text()
@@ -806,6 +1335,312 @@ class TestORM(unittest.TestCase):
         # also test order-by on the indexed primary key
         self.assertEqual(len(RomTestIterResult.query.order_by('_id').all()), 50)
 
+    def test_scan(self):
+        class RomTestScan(Model):
+            col1 = Integer(index=True)
+            col2 = Text()
+
+        clean_keys(RomTestScan)
+        for i in range(1, 51):
+            RomTestScan(col1=i, col2='hello world')
+        session.commit()
+        session.rollback()
+        RomTestScan.get(7).delete()
+
+        seen = set(ent.id for ent in RomTestScan.scan(batch=10))
+        self.assertEqual(seen, set(range(1, 51)) - set([7]))
+        self.assertEqual(len(RomTestScan.all_instances()), 49)
+        self.assertRaises(QueryError, RomTestScan.filter_by)
+
+        parts = [set(ent.id for ent in RomTestScan.scan(partition=(i, 3))) for i in range(3)]
+        self.assertEqual(set().union(*parts), seen)
+        self.assertEqual(sum(len(p) for p in parts), 49)
+        self.assertRaises(ORMError, lambda: list(RomTestScan.scan(partition=(3, 3))))
+
+    def test_parallel_refresh_indices(self):
+        from rom import util
+        if not util.USE_LUA:
+            return
+
+        class RomTestParallelRefresh(Model):
+            track_indexes = True
+            col1 = Integer(index=True)
+            col2 = Text(index=True, prefix=True)
+
+        clean_keys(RomTestParallelRefresh)
+        for i in range(1, 101):
+            RomTestParallelRefresh(col1=i, col2='hello world %i'%(i % 10))
+        session.commit()
+        session.rollback()
+
+        c = connect(None)
+        keys = c.keys('romtestparallelrefresh:*:idx') + c.keys('romtestparallelrefresh:*:pre')
+        c.delete('romtestparallelrefresh::', *keys)
+        self.assertEqual(RomTestParallelRefresh.query.filter(col1=(None, None)).count(), 0)
+        data = c.hgetall('romtestparallelrefresh:5')
+
+        progress = list(util.parallel_refresh_indices(RomTestParallelRefresh, workers=3, block_size=10))
+        self.assertEqual(progress[-1], (100, 100))
+        self.assertEqual(c.hlen('romtestparallelrefresh::'), 100)
+        self.assertEqual(c.hgetall('romtestparallelrefresh:5'), data)
+        self.assertEqual(RomTestParallelRefresh.query.filter(col1=(None, None)).count(), 100)
+        self.assertEqual(RomTestParallelRefresh.query.filter(col2='7').count(), 10)
+        self.assertEqual(RomTestParallelRefresh.query.startswith(col2='hel').count(), 100)
+
+    def test_refresh_indices_columns(self):
+        from rom import util
+        if not util.USE_LUA:
+            return
+
+        class RomTestRefreshColumns(Model):
+            track_indexes = True
+            col1 = Integer(index=True)
+            col2 = Text(index=True)
+            col3 = Text()
+
+        clean_keys(RomTestRefreshColumns)
+        for i in range(1, 31):
+            RomTestRefreshColumns(col1=i, col2='word%i'%(i % 3), col3='data')
+        session.commit()
+        session.rollback()
+
+        c = connect(None)
+        c.delete(*c.keys('romtestrefreshcolumns:col2:*:idx'))
+        c.zrem('romtestrefreshcolumns:col1:idx', 1)
+        self.assertEqual(RomTestRefreshColumns.query.filter(col2='word1').count(), 0)
+
+        self.assertRaises(ORMError, lambda: list(util.refresh_indices(RomTestRefreshColumns, columns=['col3'])))
+        all(util.refresh_indices(RomTestRefreshColumns, columns=['col2']))
+        self.assertEqual(RomTestRefreshColumns.query.filter(col2='word1').count(), 10)
+        # col1 index data was not rewritten, but is still known for removal
+        self.assertEqual(RomTestRefreshColumns.query.filter(col1=(None, None)).count(), 29)
+        RomTestRefreshColumns.get(2).delete()
+        self.assertEqual(RomTestRefreshColumns.query.filter(col1=(None, None)).count(), 28)
+
+        all(util.refresh_indices(RomTestRefreshColumns))
+        self.assertEqual(RomTestRefreshColumns.query.filter(col1=(None, None)).count(), 29)
+        self.assertEqual(RomTestRefreshColumns.get(1).col3, 'data')
+
+    def test_checkpointed_jobs(self):
+        class RomTestCheckpoint(Model):
+            track_indexes = True
+            col1 = Integer(index=True)
+
+        clean_keys(RomTestCheckpoint)
+        for i in range(1, 101):
+            RomTestCheckpoint(col1=i)
+        session.commit()
+        session.rollback()
+
+        c = connect(None)
+        key = 'romtestcheckpoint:refresh_indices:checkpoint'
+        # interrupt the job after 3 blocks
+        job = util.refresh_indices(RomTestCheckpoint, block_size=10, checkpoint=True)
+        self.assertEqual([next(job) for i in range(3)][-1], (31, 100))
+        job.close()
+        self.assertEqual(c.hget(key, 'position'), b'30')
+
+        progress = list(util.refresh_indices(RomTestCheckpoint, block_size=10, checkpoint=True))
+        self.assertEqual(progress[0], (41, 100))
+        self.assertEqual(progress[-1], (100, 100))
+        self.assertFalse(c.exists(key))
+
+        # a job with different parameters starts over
+        job = util.refresh_indices(RomTestCheckpoint, block_size=10, checkpoint=True)
+        next(job)
+        job.close()
+        if util.USE_LUA:
+            self.assertEqual(next(util.refresh_indices(RomTestCheckpoint, block_size=10,
+                columns=['col1'], checkpoint=True)), (11, 100))
+        util.Checkpoint(c, RomTestCheckpoint, 'refresh_indices').clear()
+        self.assertFalse(c.exists(key))
+
+        if not util.USE_LUA:
+            return
+        # 100 records at 500 per second should be spread over .2 seconds
+        sleeps = []
+        sleep, time.sleep = time.sleep, sleeps.append
+        try:
+            all(util.clean_old_index(RomTestCheckpoint, block_size=10, rate=500))
+        finally:
+            time.sleep = sleep
+        self.assertTrue(.15 <= max(sleeps) <= .2)
+
+    def test_clean_old_index_sparse(self):
+        from rom import util
+        if not util.USE_LUA:
+            return
+
+        class RomTestCleanSparse(Model):
+            track_indexes = True
+            col1 = Integer(index=True)
+
+        clean_keys(RomTestCleanSparse)
+        for i in range(1, 201):
+            RomTestCleanSparse(col1=i)
+        session.commit()
+        session.rollback()
+
+        c = connect(None)
+        # a huge id counter shouldn't matter, only indexed entities are checked
+        c.set('romtestcleansparse:id:', 10**12)
+        c.delete(*['romtestcleansparse:%i'%i for i in range(1, 201, 2)])
+
+        progress = list(util.clean_old_index(RomTestCleanSparse, block_size=20))
+        self.assertEqual(progress[-1], (200, 200))
+        self.assertEqual(c.hlen('romtestcleansparse::'), 100)
+        self.assertEqual(c.zcard('romtestcleansparse:col1:idx'), 100)
+        self.assertEqual(RomTestCleanSparse.query.filter(col1=(1, 1)).count(), 0)
+        self.assertEqual(RomTestCleanSparse.query.filter(col1=(2, 2)).count(), 1)
+
+    def test_index_record_format(self):
+        from rom import util
+        if not util.USE_LUA:
+            return
+
+        class RomTestRecords(Model):
+            track_indexes = True
+            col1 = Text(index=True, prefix=True, suffix=True)
+            col2 = Integer(index=True)
+
+        clean_keys(RomTestRecords)
+        for i in range(10):
+            RomTestRecords(col1='hello world %i'%i, col2=i)
+        session.commit()
+        session.rollback()
+
+        c = connect(None)
+        record = c.hget('romtestrecords::', '1')
+        self.assertFalse(record[:1] in (b'[', b'{'))
+
+        # records written by older versions are still used when unindexing
+        old = [['col1:hello', 'col1:world', 'col1:1'], ['col2'],
+            [['col1', 'hello'], ['col1', 'world'], ['col1', '1']],
+            [['col1', 'olleh'], ['col1', 'dlrow'], ['col1', '1']]]
+        c.hset('romtestrecords::', '2', json.dumps(old))
+        RomTestRecords.get(2).delete()
+        self.assertEqual(RomTestRecords.query.filter(col1='1').count(), 0)
+        self.assertEqual(RomTestRecords.query.startswith(col1='hell').count(), 9)
+        self.assertEqual(RomTestRecords.query.endswith(col1='orld').count(), 9)
+        self.assertEqual(c.zcard('romtestrecords:col2:idx'), 9)
+
+        for i in range(3, 7):
+            c.hset('romtestrecords::', str(i), json.dumps([
+                ['col1:hello', 'col1:world', 'col1:%i'%(i-1)], ['col2'],
+                [['col1', 'hello'], ['col1', 'world'], ['col1', str(i-1)]],
+                [['col1', 'olleh'], ['col1', 'dlrow'], ['col1', str(i-1)]]]))
+        progress = list(util.migrate_index_records(RomTestRecords, block_size=10))
+        self.assertEqual(progress[-1], (9, 9))
+        for i in range(3, 7):
+            self.assertFalse(c.hget('romtestrecords::', str(i))[:1] in (b'[', b'{'))
+        RomTestRecords.get(3).delete()
+        self.assertEqual(RomTestRecords.query.filter(col1='2').count(), 0)
+        self.assertEqual(RomTestRecords.query.startswith(col1='hell').count(), 8)
+        self.assertEqual(c.zcard('romtestrecords:col2:idx'), 8)
+
+    def test_index_update(self):
+        if not util.USE_LUA:
+            return
+        class RomTestIndexUpdate(Model):
+            track_indexes = True
+            col1 = Text(index=True, prefix=True, suffix=True)
+            col2 = Boolean(index=True)
+            col3 = Integer(index=True)
+
+        clean_keys(RomTestIndexUpdate)
+        x = RomTestIndexUpdate(col1='hello world', col2=False, col3=1)
+        x.save()
+        c = connect(None)
+        before = c.zrange('romtestindexupdate:col1:pre', 0, -1, withscores=True)
+
+        x.col2 = True
+        x.save()
+        self.assertEqual(c.zrange('romtestindexupdate:col1:pre', 0, -1, withscores=True), before)
+        self.assertEqual(RomTestIndexUpdate.query.filter(col2=True).count(), 1)
+        self.assertEqual(RomTestIndexUpdate.query.filter(col2=False).count(), 0)
+
+        x.col1 = 'hello there'
+        x.col3 = 5
+        x.save()
+        self.assertEqual(RomTestIndexUpdate.query.filter(col1='world').count(), 0)
+        self.assertEqual(RomTestIndexUpdate.query.filter(col1='hello').filter(col1='there').count(), 1)
+        self.assertEqual(RomTestIndexUpdate.query.startswith(col1='wor').count(), 0)
+        self.assertEqual(RomTestIndexUpdate.query.endswith(col1='ere').count(), 1)
+        self.assertEqual(RomTestIndexUpdate.query.filter(col3=(1, 1)).count(), 0)
+        self.assertEqual(RomTestIndexUpdate.query.filter(col3=(5, 5)).count(), 1)
+
+        class RomTestIndexWrites(Model):
+            track_indexes = True
+            col = Text(prefix=True, suffix=True)
+
+        clean_keys(RomTestIndexWrites)
+        y = RomTestIndexWrites(col='hello world')
+        y.save()
+        start = index_writes()
+        y.col = 'hello there'
+        y.save()
+        # one prefix and suffix member each added and removed, and the record
+        self.assertEqual(index_writes() - start, 5)
+        start = index_writes()
+        y.save(full=True)
+        self.assertEqual(index_writes() - start, 0)
+
+    def test_index_update_python(self):
+        # the index data written without Lua
+        from rom.index import GeneralIndex
+        idx = GeneralIndex('romtestindexpython')
+        c = connect(None)
+        keys = c.keys('romtestindexpython*')
+        if keys:
+            c.delete(*keys)
+
+        start = index_writes()
+        idx.index(c, '1', ['col1:hello', 'col1:world'], {'col2': 1}, [], [])
+        self.assertEqual(index_writes() - start, 4)
+        start = index_writes()
+        idx.index(c, '1', ['col1:world', 'col1:hello'], {'col2': 1}, [], [])
+        # scores are always written, keywords and the record are unchanged
+        self.assertEqual(index_writes() - start, 1)
+        start = index_writes()
+        idx.index(c, '1', ['col1:hello', 'col1:there'], {'col2': 2}, [], [])
+        # one keyword added and removed, the score, and the record
+        self.assertEqual(index_writes() - start, 4)
+        self.assertEqual(c.smembers('romtestindexpython:col1:world:idx'), set())
+        self.assertEqual(c.smembers('romtestindexpython:col1:there:idx'), set([b'1']))
+        self.assertEqual(c.zscore('romtestindexpython:col2:idx', '1'), 2)
+        idx.unindex(c, '1')
+        self.assertEqual(c.keys('romtestindexpython*'), [])
+
+    def test_index_unchanged_columns(self):
+        calls = []
+        def keygen(val):
+            calls.append(val)
+            return util._string_keygen(val)
+
+        class RomTestIndexUnchanged(Model):
+            track_indexes = True
+            col1 = Text(index=True, keygen=keygen)
+            col2 = Integer(index=True)
+
+        clean_keys(RomTestIndexUnchanged)
+        x = RomTestIndexUnchanged(col1='hello world', col2=1)
+        x.save()
+        self.assertEqual(len(calls), 1)
+
+        x.col2 = 2
+        x.save()
+        if util.USE_LUA:
+            # unchanged columns aren't re-tokenized or reindexed
+            self.assertEqual(len(calls), 1)
+        self.assertEqual(RomTestIndexUnchanged.query.filter(col1='hello').count(), 1)
+        self.assertEqual(RomTestIndexUnchanged.query.filter(col2=(2, 2)).count(), 1)
+
+        x.col1 = 'goodbye'
+        x.save()
+        self.assertEqual(RomTestIndexUnchanged.query.filter(col1='hello').count(), 0)
+        self.assertEqual(RomTestIndexUnchanged.query.filter(col1='goodbye').count(), 1)
+        self.assertEqual(RomTestIndexUnchanged.query.filter(col2=(2, 2)).count(), 1)
+
     def test_foreign_model_references(self):
         class RomTestM2O(Model):
             col1 = ManyToOne('RomTestO2M')